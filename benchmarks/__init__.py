@@ -0,0 +1 @@
+"""Offline benchmarks of the bot, run against an in-process fake homeserver."""
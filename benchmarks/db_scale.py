@@ -0,0 +1,604 @@
+#!/usr/bin/env python3
+"""Latency of every repository method on a database seeded at production volumes.
+
+The database is migrated to the latest version, seeded with deterministic rows and each method is
+called with keys drawn from the seeded rows. Writes are rolled back, so every method sees the same
+data. On SQLite, the statements of each method are explained and full table scans reported.
+
+Usage: python -m benchmarks.db_scale [options], see --help.
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import types
+import zlib
+from typing import Any, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+from feedback_bot.models.Repositories.Repositories import Repositories
+from feedback_bot.models.Repositories.TicketRepository import TicketStatus
+from feedback_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+SERVER_NAME = "bench.local"
+# Fixed, so timestamps and the rows they select are the same in every run
+BASE_TS = 1_700_000_000_000
+SEED_BATCH_SIZE = 10000
+
+# Rows per table at --scale 1
+VOLUMES = {
+    "users": 200_000,
+    "tickets": 300_000,
+    "messages": 2_000_000,
+    "event_pairs": 2_000_000,
+    "incoming_events": 200_000,
+    "room_key_sessions": 100_000,
+    "encrypted_events": 50_000,
+    "staff": 50,
+    "support": 20,
+    "spare_rooms": 100,
+}
+# Counts that do not grow with the user base
+UNSCALED = ("staff", "support", "spare_rooms")
+
+
+class Dataset(object):
+    def __init__(self, volumes: Dict[str, int]):
+        """Row counts and the key of every seeded row, derived from its index.
+
+        Relations are derived from the indexes too, so keys are drawn without querying the
+        database and are the same in every run with the same volumes.
+        """
+        self.volumes = volumes
+        self.users = volumes["users"]
+        self.tickets = volumes["tickets"]
+        self.staff = volumes["staff"]
+        self.support = volumes["support"]
+        self.chats = max(self.users // 20, 1)
+        # Users with a backlog of incoming events, and rooms with room key sessions
+        self.backlogged_users = max(self.users // 50, 1)
+        self.active_rooms = max(self.users // 10, 1)
+        self.fresh_ids = 0
+
+    def user_id(self, i: int) -> str:
+        return f"@user{i}:{SERVER_NAME}"
+
+    @staticmethod
+    def anon_id(i: int) -> str:
+        return f"anon-{i}"
+
+    @staticmethod
+    def user_room(i: int) -> str:
+        return f"!dm{i}:{SERVER_NAME}"
+
+    @staticmethod
+    def staff_id(k: int) -> str:
+        return f"@staff{k}:{SERVER_NAME}"
+
+    @staticmethod
+    def support_id(k: int) -> str:
+        return f"@support{k}:{SERVER_NAME}"
+
+    @staticmethod
+    def ticket_room(ticket_id: int) -> str:
+        return f"!ticket{ticket_id}:{SERVER_NAME}"
+
+    @staticmethod
+    def chat_room(c: int) -> str:
+        return f"!chat{c}:{SERVER_NAME}"
+
+    @staticmethod
+    def ticket_status(ticket_id: int) -> str:
+        if ticket_id % 100 < 5:
+            return TicketStatus.OPEN.value
+        if ticket_id % 100 < 7:
+            return TicketStatus.IN_PROGRESS.value
+        return TicketStatus.CLOSED.value
+
+    @staticmethod
+    def closed_at(ticket_id: int) -> int:
+        return BASE_TS + ticket_id * 60_000
+
+    def ticket_user(self, ticket_id: int) -> int:
+        return ticket_id % self.users
+
+    def ticket_staff(self, ticket_id: int) -> List[int]:
+        staff = [ticket_id % self.staff]
+        if ticket_id % 3 == 0 and self.staff > 1:
+            staff.append((ticket_id + 1) % self.staff)
+        return staff
+
+    def session_room(self, k: int) -> int:
+        return k % self.active_rooms
+
+    @staticmethod
+    def session_id(k: int) -> str:
+        return f"session{k}"
+
+    def fresh(self) -> int:
+        """An index no seeded row has, for inserts."""
+        self.fresh_ids += 1
+        return 10 ** 9 + self.fresh_ids
+
+    # Rows of each table
+
+    def rows(self) -> Dict[str, Tuple[str, Iterable[tuple]]]:
+        """Table -> (columns, rows), in the order of their foreign keys."""
+        v = self.volumes
+        return {
+            "Users": ("user_id, anon_id, room_id", (
+                (self.user_id(i), self.anon_id(i), self.user_room(i)) for i in range(self.users)
+            )),
+            "Staff": ("user_id", ((self.staff_id(k),) for k in range(self.staff))),
+            "Support": ("user_id", ((self.support_id(k),) for k in range(self.support))),
+            # Inserted in order, so their IDs are 1..n
+            "Tickets": ("user_id, user_room_id, status, ticket_name, closed_at", (
+                (
+                    self.anon_id(self.ticket_user(j)), self.ticket_room(j), self.ticket_status(j), f"Ticket {j}",
+                    self.closed_at(j) if self.ticket_status(j) == TicketStatus.CLOSED.value else None,
+                ) for j in range(1, self.tickets + 1)
+            )),
+            "TicketsStaffRelation": ("ticket_id, staff_id", (
+                (j, self.staff_id(k)) for j in range(1, self.tickets + 1) for k in self.ticket_staff(j)
+            )),
+            "TicketsSupportRelation": ("ticket_id, support_id", (
+                (j, self.support_id(j % self.support)) for j in range(10, self.tickets + 1, 10)
+            )),
+            "Chats": ("chat_room_id, user_id", (
+                (self.chat_room(c), self.user_id(c * 20 % self.users)) for c in range(self.chats)
+            )),
+            "ChatsStaffRelation": ("chat_room_id, staff_id", (
+                (self.chat_room(c), self.staff_id(c % self.staff)) for c in range(self.chats)
+            )),
+            "messages": ("event_id, management_event_id, room_id", (
+                (f"$m{m}:{SERVER_NAME}", f"$mm{m}:{SERVER_NAME}", self.user_room(m % self.users))
+                for m in range(v["messages"])
+            )),
+            "EventPairs": ("room_id, event_id, clone_room_id, clone_event_id", (
+                (
+                    self.user_room(p % self.users), f"$e{p}:{SERVER_NAME}",
+                    self.ticket_room(p % self.tickets + 1), f"$c{p}:{SERVER_NAME}",
+                ) for p in range(v["event_pairs"])
+            )),
+            "IncomingEvents": ("user_id, room_id, event_id", (
+                (
+                    self.anon_id(q % self.backlogged_users * 50), self.user_room(q % self.backlogged_users * 50),
+                    f"$i{q}:{SERVER_NAME}",
+                ) for q in range(v["incoming_events"])
+            )),
+            "RoomKeySessions": ("session_id, room_id, first_seen", (
+                (self.session_id(k), self.user_room(self.session_room(k)), BASE_TS + k * 1000)
+                for k in range(v["room_key_sessions"])
+            )),
+            "ForwardedRoomKeys": ("session_id, user_id, device_id", (
+                (self.session_id(k), self.staff_id(k % self.staff), f"DEVICE{d}")
+                for k in range(v["room_key_sessions"]) for d in range(2)
+            )),
+            "encrypted_events": ("device_id, event_id, room_id, session_id, user_id, server_timestamp, source", (
+                self.encrypted_event(e) for e in range(v["encrypted_events"])
+            )),
+            "SpareRooms": ("room_id", ((f"!spare{s}:{SERVER_NAME}",) for s in range(v["spare_rooms"]))),
+            "RoomSenders": ("room_id, sender_id", (
+                (self.ticket_room(j), f"@sender{j % 4}:{SERVER_NAME}") for j in range(1, self.tickets + 1)
+            )),
+        }
+
+    def encrypted_event(self, e: int) -> tuple:
+        # Events of a few sessions each, like the backlog of a device missing room keys
+        session_id = self.session_id(e // 50)
+        room_id = self.user_room(self.session_room(e // 50))
+        source = {
+            "type": "m.room.encrypted",
+            "event_id": f"$enc{e}:{SERVER_NAME}",
+            "sender": self.user_id(e % self.users),
+            "origin_server_ts": BASE_TS + e,
+            "room_id": room_id,
+            "content": {
+                "algorithm": "m.megolm.v1.aes-sha2",
+                "ciphertext": "A" * 256,
+                "sender_key": "senderkey",
+                "device_id": "DEVICE",
+                "session_id": session_id,
+            },
+        }
+        return (
+            "DEVICE", source["event_id"], room_id, session_id, source["sender"], source["origin_server_ts"],
+            zlib.compress(json.dumps(source).encode()),
+        )
+
+
+def _batches(rows: Iterable[tuple], size: int) -> Iterator[List[tuple]]:
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _raw_execute(store: Storage, cursor, query: str, params: tuple = ()):
+    # Bypasses Storage._execute, so seeding and bookkeeping are not measured as queries of the bot
+    if store.db_type == "postgres":
+        query = query.replace("?", "%s")
+    cursor.execute(query, params)
+
+
+def is_seeded(store: Storage) -> bool:
+    _raw_execute(store, store.cursor, "SELECT count(*) FROM Users")
+    return store.cursor.fetchone()[0] > 0
+
+
+def seed(store: Storage, data: Dataset):
+    cursor = store.conn.cursor()
+    for table, (columns, rows) in data.rows().items():
+        start = time.perf_counter()
+        placeholders = ", ".join("?" for _ in columns.split(","))
+        query = f"INSERT INTO {table} ({columns}) VALUES ({placeholders})"
+        if store.db_type == "postgres":
+            query = query.replace("?", "%s")
+        count = 0
+        _raw_execute(store, cursor, "BEGIN")
+        for batch in _batches(rows, SEED_BATCH_SIZE):
+            cursor.executemany(query, batch)
+            count += len(batch)
+        _raw_execute(store, cursor, "COMMIT")
+        logger.info(f"Seeded {count} rows of {table} in {time.perf_counter() - start:.1f}s")
+    if store.db_type == "postgres":
+        # Autovacuum would have analyzed tables this size in production
+        _raw_execute(store, cursor, "ANALYZE")
+    cursor.close()
+
+
+def table_counts(store: Storage, data: Dataset) -> Dict[str, int]:
+    counts = {}
+    for table in data.rows():
+        _raw_execute(store, store.cursor, f"SELECT count(*) FROM {table}")
+        counts[table] = store.cursor.fetchone()[0]
+    return counts
+
+
+class Case(NamedTuple):
+    # "<attribute of Repositories>.<method>", the storage itself for methods of Storage
+    method: str
+    args: Callable[[Dataset, random.Random], tuple]
+    writes: bool = False
+
+
+def _user(data: Dataset, rng: random.Random) -> int:
+    return rng.randrange(data.users)
+
+
+def _ticket(data: Dataset, rng: random.Random) -> int:
+    return rng.randrange(1, data.tickets + 1)
+
+
+def _open_ticket(data: Dataset, rng: random.Random) -> int:
+    return rng.randrange(max(data.tickets // 100, 1)) * 100 + rng.randrange(1, 5)
+
+
+def _session(data: Dataset, rng: random.Random) -> int:
+    return rng.randrange(data.volumes["room_key_sessions"])
+
+
+CASES = [
+    # Storage
+    Case("storage.get_message_by_management_event_id",
+         lambda d, r: (f"$mm{r.randrange(d.volumes['messages'])}:{SERVER_NAME}",)),
+    Case("storage.store_message",
+         lambda d, r: (f"$m{d.fresh()}:{SERVER_NAME}", f"$mm{d.fresh()}:{SERVER_NAME}", d.user_room(_user(d, r))),
+         writes=True),
+    Case("storage.get_encrypted_event_counts", lambda d, r: ()),
+    Case("storage.iter_encrypted_events",
+         lambda d, r: (d.session_id(r.randrange(max(d.volumes["encrypted_events"] // 50, 1))),)),
+    Case("storage.remove_encrypted_events_of_session",
+         lambda d, r: (d.session_id(r.randrange(max(d.volumes["encrypted_events"] // 50, 1))),), writes=True),
+    # Users
+    Case("userRep.get_user", lambda d, r: (d.user_id(_user(d, r)),)),
+    Case("userRep.get_by_anon_id", lambda d, r: (d.anon_id(_user(d, r)),)),
+    Case("userRep.get_anon_id", lambda d, r: (d.user_id(_user(d, r)),)),
+    Case("userRep.get_user_room", lambda d, r: (d.user_id(_user(d, r)),)),
+    Case("userRep.get_user_current_ticket_id", lambda d, r: (d.anon_id(_user(d, r)),)),
+    Case("userRep.get_user_current_chat_room_id", lambda d, r: (d.user_id(_user(d, r)),)),
+    Case("userRep.get_all_fields", lambda d, r: (d.user_id(_user(d, r)),)),
+    Case("userRep.create_user", lambda d, r: (d.user_id(d.fresh()), d.anon_id(d.fresh())), writes=True),
+    Case("userRep.set_user_room", lambda d, r: (d.user_id(_user(d, r)), d.user_room(d.fresh())), writes=True),
+    Case("userRep.set_user_current_ticket_id", lambda d, r: (d.anon_id(_user(d, r)), _ticket(d, r)), writes=True),
+    Case("userRep.set_user_current_chat_room_id",
+         lambda d, r: (d.user_id(_user(d, r)), d.chat_room(r.randrange(d.chats))), writes=True),
+    Case("userRep.delete_user", lambda d, r: (d.user_id(_user(d, r)),), writes=True),
+    # Tickets
+    Case("ticketRep.get_ticket", lambda d, r: (_ticket(d, r),)),
+    Case("ticketRep.get_ticket_id", lambda d, r: (d.anon_id(_user(d, r)), d.user_room(_user(d, r)))),
+    Case("ticketRep.get_ticket_status", lambda d, r: (_ticket(d, r),)),
+    Case("ticketRep.get_ticket_name", lambda d, r: (_ticket(d, r),)),
+    Case("ticketRep.get_ticket_room_id", lambda d, r: (_ticket(d, r),)),
+    Case("ticketRep.get_ticket_id_of_room", lambda d, r: (d.ticket_room(_ticket(d, r)),)),
+    Case("ticketRep.get_ticket_rooms", lambda d, r: ()),
+    Case("ticketRep.get_ticket_rooms_closed_before", lambda d, r: (d.closed_at(d.tickets // 100),)),
+    Case("ticketRep.get_all_fields", lambda d, r: (_ticket(d, r),)),
+    Case("ticketRep.get_assigned_staff", lambda d, r: (_ticket(d, r),)),
+    Case("ticketRep.get_assigned_support", lambda d, r: (_ticket(d, r),)),
+    Case("ticketRep.get_open_tickets", lambda d, r: ()),
+    Case("ticketRep.get_open_tickets_of_staff", lambda d, r: (d.staff_id(r.randrange(d.staff)),)),
+    Case("ticketRep.create_ticket", lambda d, r: (d.anon_id(_user(d, r)), "Ticket"), writes=True),
+    Case("ticketRep.set_ticket_status",
+         lambda d, r: (_open_ticket(d, r), TicketStatus.CLOSED.value), writes=True),
+    Case("ticketRep.set_ticket_name", lambda d, r: (_ticket(d, r), "Renamed"), writes=True),
+    Case("ticketRep.set_ticket_room_id", lambda d, r: (_ticket(d, r), d.ticket_room(d.fresh())), writes=True),
+    Case("ticketRep.assign_staff_to_ticket",
+         lambda d, r: (lambda j: (j, d.staff_id((j + 2) % d.staff)))(_ticket(d, r)), writes=True),
+    Case("ticketRep.remove_staff_from_ticket",
+         lambda d, r: (lambda j: (j, d.staff_id(d.ticket_staff(j)[0])))(_ticket(d, r)), writes=True),
+    # Event pairs
+    Case("eventPairsRep.get_room_event", lambda d, r: (
+        lambda p: (d.user_room(p % d.users), f"$e{p}:{SERVER_NAME}"))(r.randrange(d.volumes["event_pairs"]))),
+    Case("eventPairsRep.get_room_clone_event", lambda d, r: (
+        lambda p: (d.ticket_room(p % d.tickets + 1), f"$c{p}:{SERVER_NAME}"))(r.randrange(d.volumes["event_pairs"]))),
+    Case("eventPairsRep.put_clone_event", lambda d, r: (
+        d.user_room(_user(d, r)), f"$e{d.fresh()}:{SERVER_NAME}", d.ticket_room(_ticket(d, r)),
+        f"$c{d.fresh()}:{SERVER_NAME}", f"@sender0:{SERVER_NAME}",
+    ), writes=True),
+    Case("eventPairsRep.delete_event", lambda d, r: (
+        lambda p: (d.user_room(p % d.users), f"$e{p}:{SERVER_NAME}"))(r.randrange(d.volumes["event_pairs"])),
+         writes=True),
+    Case("eventPairsRep.delete_room_events", lambda d, r: (d.user_room(_user(d, r)),), writes=True),
+    Case("eventPairsRep.delete_room_clone_events", lambda d, r: (d.ticket_room(_ticket(d, r)),), writes=True),
+    # Incoming events
+    Case("incomingEventsRep.get_incoming_events",
+         lambda d, r: (d.anon_id(r.randrange(d.backlogged_users) * 50),)),
+    Case("incomingEventsRep.put_incoming_event",
+         lambda d, r: (d.anon_id(_user(d, r)), d.user_room(_user(d, r)), f"$i{d.fresh()}:{SERVER_NAME}"),
+         writes=True),
+    Case("incomingEventsRep.delete_user_incoming_events",
+         lambda d, r: (d.anon_id(r.randrange(d.backlogged_users) * 50),), writes=True),
+    # Chats
+    Case("chatRep.get_chat", lambda d, r: (d.chat_room(r.randrange(d.chats)),)),
+    Case("chatRep.get_chat_rooms", lambda d, r: ()),
+    Case("chatRep.get_assigned_staff", lambda d, r: (d.chat_room(r.randrange(d.chats)),)),
+    Case("chatRep.get_all_fields", lambda d, r: (d.chat_room(r.randrange(d.chats)),)),
+    Case("chatRep.create_chat", lambda d, r: (d.user_id(_user(d, r)), d.chat_room(d.fresh())), writes=True),
+    Case("chatRep.assign_staff_to_chat",
+         lambda d, r: (d.chat_room(r.randrange(d.chats)), d.staff_id(d.fresh())), writes=True),
+    # Staff, support and spare rooms
+    Case("staffRep.get_staff", lambda d, r: (d.staff_id(r.randrange(d.staff)),)),
+    Case("supportRep.get_support", lambda d, r: (d.support_id(r.randrange(d.support)),)),
+    Case("spareRoomRep.get_spare_rooms", lambda d, r: ()),
+    Case("roomSenderRep.get_room_senders", lambda d, r: ()),
+    Case("roomSenderRep.put_room_sender",
+         lambda d, r: (d.ticket_room(d.fresh()), f"@sender0:{SERVER_NAME}"), writes=True),
+    # Room keys
+    Case("roomKeyRep.get_sessions_since",
+         lambda d, r: (d.user_room(r.randrange(d.active_rooms)), BASE_TS)),
+    Case("roomKeyRep.get_forwarded_keys", lambda d, r: (
+        [d.session_id(k) for k in range(r.randrange(d.active_rooms), d.volumes["room_key_sessions"], d.active_rooms)],
+        d.staff_id(r.randrange(d.staff)),
+    )),
+    Case("roomKeyRep.put_session",
+         lambda d, r: (d.session_id(d.fresh()), d.user_room(_user(d, r)), BASE_TS), writes=True),
+    Case("roomKeyRep.put_forwarded_keys", lambda d, r: (
+        [(d.session_id(_session(d, r)), d.staff_id(r.randrange(d.staff)), f"DEVICE{d.fresh()}") for _ in range(10)],
+    ), writes=True),
+    Case("roomKeyRep.delete_room_sessions", lambda d, r: (
+        [d.user_room(r.randrange(d.active_rooms))], [d.session_id(_session(d, r))],
+    ), writes=True),
+]
+
+
+def _resolve(repositories: Repositories, method: str) -> Tuple[str, Callable]:
+    owner_name, method_name = method.split(".")
+    owner = getattr(repositories, owner_name)
+    return f"{type(owner).__name__}.{method_name}", getattr(owner, method_name)
+
+
+def _row_count(result: Any) -> int:
+    if result is None:
+        return 0
+    if isinstance(result, (list, set, tuple, dict)):
+        return len(result)
+    return 1
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+class Runner(object):
+    def __init__(self, store: Storage, data: Dataset, args: argparse.Namespace):
+        """Times the cases, one method at a time, with keys from a generator seeded per case."""
+        self.store = store
+        self.repositories = store.repositories
+        self.data = data
+        self.args = args
+
+    def _call(self, method: Callable, args: tuple, writes: bool) -> Tuple[float, Any]:
+        if writes:
+            _raw_execute(self.store, self.store.cursor, "BEGIN")
+        try:
+            start = time.perf_counter()
+            result = method(*args)
+            if isinstance(result, types.GeneratorType):
+                result = list(result)
+            return time.perf_counter() - start, result
+        finally:
+            if writes:
+                _raw_execute(self.store, self.store.cursor, "ROLLBACK")
+
+    def scans(self, method: Callable, args: tuple, writes: bool) -> Optional[List[str]]:
+        """Full table scans in the query plans of the statements a call runs, SQLite only."""
+        if self.store.db_type != "sqlite":
+            return None
+        statements = []
+        self.store.conn.set_trace_callback(statements.append)
+        try:
+            self._call(method, args, writes)
+        finally:
+            self.store.conn.set_trace_callback(None)
+        scans = []
+        cursor = self.store.conn.cursor()
+        for statement in statements:
+            if statement.split(None, 1)[0].upper() in ("BEGIN", "ROLLBACK"):
+                continue
+            cursor.execute(f"EXPLAIN QUERY PLAN {statement}")
+            for row in cursor.fetchall():
+                detail = row[-1]
+                if detail.startswith("SCAN") and detail not in scans:
+                    scans.append(detail)
+        cursor.close()
+        return scans
+
+    def run(self, case: Case) -> Dict[str, Any]:
+        name, method = _resolve(self.repositories, case.method)
+        rng = random.Random(f"{self.args.seed}:{case.method}")
+        result = {"case": name}
+        try:
+            result["scans"] = self.scans(method, case.args(self.data, rng), case.writes)
+            timings, rows = [], 0
+            deadline = time.perf_counter() + self.args.max_seconds
+            while len(timings) < self.args.iterations:
+                elapsed, returned = self._call(method, case.args(self.data, rng), case.writes)
+                timings.append(elapsed)
+                rows += _row_count(returned)
+                if len(timings) >= self.args.min_iterations and time.perf_counter() > deadline:
+                    break
+        except Exception as e:
+            result["error"] = f"{type(e).__name__}: {e}"
+            return result
+        result.update({
+            "iterations": len(timings),
+            "p50_ms": round(_percentile(timings, 0.5) * 1000, 4),
+            "p95_ms": round(_percentile(timings, 0.95) * 1000, 4),
+            "mean_ms": round(sum(timings) / len(timings) * 1000, 4),
+            "rows": round(rows / len(timings), 1),
+        })
+        return result
+
+
+def load_baseline(path: str) -> Dict[str, Dict[str, Any]]:
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    return {line["case"]: line for line in lines if "case" in line}
+
+
+def compare(result: Dict[str, Any], baseline: Optional[Dict[str, Any]], threshold: float) -> List[str]:
+    """Regressions of a result against the same case of a baseline run."""
+    if not baseline or "p50_ms" not in baseline:
+        return []
+    if "error" in result:
+        return ["fails"]
+    regressions = []
+    ratio = result["p50_ms"] / baseline["p50_ms"] if baseline["p50_ms"] else 1
+    result["p50_ratio"] = round(ratio, 2)
+    if ratio > threshold:
+        regressions.append(f"p50 {ratio:.2f}x")
+    new_scans = [scan for scan in result["scans"] or [] if scan not in (baseline.get("scans") or [])]
+    if new_scans:
+        regressions.append(f"new {', '.join(new_scans)}")
+    return regressions
+
+
+def format_result(result: Dict[str, Any]) -> str:
+    if "error" in result:
+        line = f"{result['case']:<56} {result['error']}"
+    else:
+        line = (
+            f"{result['case']:<56} {result['p50_ms']:>9.3f} {result['p95_ms']:>9.3f} {result['mean_ms']:>9.3f}"
+            f" {result['rows']:>9}"
+        )
+        if "p50_ratio" in result:
+            line += f" {result['p50_ratio']:>6.2f}x"
+        if result["scans"]:
+            line += f"  {'; '.join(result['scans'])}"
+    if result.get("regressions"):
+        line += f"  REGRESSION: {'; '.join(result['regressions'])}"
+    return line
+
+
+def _database_config(url: Optional[str], directory: str) -> Dict[str, Any]:
+    # Every method is timed here, the slow query log would only repeat the seeding batches
+    if url is None:
+        return {"type": "sqlite", "connection_string": os.path.join(directory, "bench.db"), "slow_query_ms": 0}
+    if url.startswith("sqlite://"):
+        return {"type": "sqlite", "connection_string": url[len("sqlite://"):], "slow_query_ms": 0}
+    if url.startswith("postgres://"):
+        return {"type": "postgres", "connection_string": url, "slow_query_ms": 0}
+    raise ValueError(f"Invalid database URL '{url}', expected sqlite:// or postgres://")
+
+
+def run(args: argparse.Namespace) -> int:
+    volumes = {
+        table: count if table in UNSCALED else max(int(count * args.scale), 1) for table, count in VOLUMES.items()
+    }
+    data = Dataset(volumes)
+    directory = tempfile.mkdtemp(prefix="feedback-bot-db-bench-")
+    try:
+        store = Storage(_database_config(args.database, directory))
+        store.set_repositories(Repositories(store))
+        if is_seeded(store):
+            logger.warning("Database already seeded, reusing its rows")
+        else:
+            start = time.perf_counter()
+            seed(store, data)
+            logger.warning(f"Seeded the database in {time.perf_counter() - start:.1f}s")
+
+        header = {"db": store.db_type, "scale": args.scale, "seed": args.seed, "tables": table_counts(store, data)}
+        if args.json:
+            print(json.dumps(header), flush=True)
+        else:
+            print(f"{store.db_type}, rows: {', '.join(f'{t} {c}' for t, c in header['tables'].items())}")
+            print(f"{'method':<56} {'p50 ms':>9} {'p95 ms':>9} {'mean ms':>9} {'rows':>9}")
+
+        baseline = load_baseline(args.baseline) if args.baseline else {}
+        runner = Runner(store, data, args)
+        regressed = 0
+        for case in CASES:
+            if args.filter and args.filter not in _resolve(store.repositories, case.method)[0]:
+                continue
+            result = runner.run(case)
+            regressions = compare(result, baseline.get(result["case"]), args.threshold)
+            if regressions:
+                result["regressions"] = regressions
+                regressed += 1
+            print(json.dumps(result) if args.json else format_result(result), flush=True)
+        store.conn.close()
+        return 1 if regressed else 0
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--database", default=None,
+        help="sqlite://<path> or postgres://<connection string>, seeded unless it has users already. "
+             "A temporary SQLite database by default",
+    )
+    parser.add_argument("--scale", type=float, default=1, help="Multiplier of the seeded row counts")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the keys each method is called with")
+    parser.add_argument("--iterations", type=int, default=200, help="Calls per method")
+    parser.add_argument("--min-iterations", type=int, default=5, help="Calls per method, even past --max-seconds")
+    parser.add_argument("--max-seconds", type=float, default=2, help="Time spent per method before stopping early")
+    parser.add_argument("--filter", default=None, help="Only methods containing this string")
+    parser.add_argument("--baseline", default=None, help="--json output of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=1.5, help="p50 ratio to the baseline reported as regression")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per method")
+    parser.add_argument("--log-level", default="WARNING", help="Log level")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    logging.basicConfig(format="%(asctime)s | %(name)s [%(levelname)s] %(message)s", level=args.log_level)
+    sys.exit(run(args))
+
+
+if __name__ == "__main__":
+    main()
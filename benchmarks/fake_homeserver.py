@@ -0,0 +1,412 @@
+import asyncio
+import itertools
+import logging
+import random
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# noinspection PyPackageRequirements
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+API_PREFIXES = ("/_matrix/client/r0", "/_matrix/client/v3")
+# Requests the injected rate limits and failures apply to, the /sync long-poll is never failed
+INJECTABLE_REQUESTS = ("send", "create_room", "invite", "kick", "get_event", "join", "put_state", "redact")
+
+
+def _error(status: int, errcode: str, error: str, **fields) -> web.Response:
+    return web.json_response(dict(errcode=errcode, error=error, **fields), status=status)
+
+
+class FakeRoom(object):
+    def __init__(self, room_id: str):
+        self.room_id = room_id
+        # (event type, state key) -> latest state event
+        self.state: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.events: Dict[str, Dict[str, Any]] = {}
+
+    def membership(self, user_id: str) -> Optional[str]:
+        event = self.state.get(("m.room.member", user_id))
+        return event["content"]["membership"] if event else None
+
+    def joined(self) -> List[str]:
+        return [
+            state_key for (event_type, state_key), event in self.state.items()
+            if event_type == "m.room.member" and event["content"]["membership"] == "join"
+        ]
+
+
+class FakeHomeserver(object):
+    def __init__(
+            self, server_name: str = "bench.local", latency_ms: float = 0, jitter_ms: float = 0,
+            ratelimit_rate: float = 0, retry_after_ms: int = 100, failure_rate: float = 0, seed: Optional[int] = None,
+    ):
+        """In-process Matrix homeserver for benchmarks, implementing the client-server API the bot uses.
+
+        Rooms live in memory and every event gets a position in a single stream, which /sync serves
+        incrementally and long-polls on. Simulated users do not make requests, their events are added
+        directly with `send_event`.
+
+        Args:
+            server_name (str): Domain of the room, event and user IDs
+
+            latency_ms (float): Delay added to every request
+
+            jitter_ms (float): Random delay of up to this much added on top of the latency
+
+            ratelimit_rate (float): Share of outbound requests rejected with M_LIMIT_EXCEEDED
+
+            retry_after_ms (int): retry_after_ms of the injected rate limits
+
+            failure_rate (float): Share of outbound requests failed with a 500 response
+
+            seed (int): Seed of the random rate limits, failures and jitter
+        """
+        self.server_name = server_name
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.ratelimit_rate = ratelimit_rate
+        self.retry_after_ms = retry_after_ms
+        self.failure_rate = failure_rate
+        self.random = random.Random(seed)
+
+        self.rooms: Dict[str, FakeRoom] = {}
+        self.aliases: Dict[str, str] = {}
+        # access token -> user ID
+        self.tokens: Dict[str, str] = {}
+        # (room ID, event), an event's stream position is its index + 1
+        self.stream: List[Tuple[str, Dict[str, Any]]] = []
+        self.positions: Dict[str, int] = {}
+        # (user ID, transaction ID) -> event ID, for idempotent retries
+        self.transactions: Dict[Tuple[str, str], str] = {}
+        self.ids = itertools.count(1)
+        self.send_listeners: List[Callable[[str, Dict[str, Any]], None]] = []
+
+        self.requests: Counter = Counter()
+        self.ratelimited = 0
+        self.failed = 0
+
+        self.new_events: Optional[asyncio.Event] = None
+        self.runner: Optional[web.AppRunner] = None
+        self.url = ""
+
+    # Server
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Listen on host and port, any free port by default, and return the homeserver URL."""
+        self.new_events = asyncio.Event()
+
+        app = web.Application(middlewares=[self.middleware])
+        for prefix in API_PREFIXES:
+            app.router.add_get(f"{prefix}/sync", self.on_sync)
+            app.router.add_put(f"{prefix}/rooms/{{room_id}}/send/{{event_type}}/{{txn_id}}", self.on_send)
+            app.router.add_post(f"{prefix}/createRoom", self.on_create_room)
+            app.router.add_post(f"{prefix}/rooms/{{room_id}}/invite", self.on_invite)
+            app.router.add_post(f"{prefix}/rooms/{{room_id}}/kick", self.on_kick)
+            app.router.add_get(f"{prefix}/rooms/{{room_id}}/event/{{event_id}}", self.on_get_event)
+            app.router.add_get(f"{prefix}/directory/room/{{alias}}", self.on_resolve_alias)
+            app.router.add_post(f"{prefix}/join/{{room}}", self.on_join)
+            app.router.add_get(f"{prefix}/rooms/{{room_id}}/joined_members", self.on_joined_members)
+            app.router.add_put(f"{prefix}/rooms/{{room_id}}/state/{{event_type}}", self.on_put_state)
+            app.router.add_put(f"{prefix}/rooms/{{room_id}}/state/{{event_type}}/{{state_key}}", self.on_put_state)
+            app.router.add_put(f"{prefix}/rooms/{{room_id}}/redact/{{event_id}}/{{txn_id}}", self.on_redact)
+        app.router.add_route("*", "/{path:.*}", self.on_unrecognized)
+
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        host, port = self.runner.addresses[0][:2]
+        self.url = f"http://{host}:{port}"
+        logger.info(f"Fake homeserver listening on {self.url}")
+        return self.url
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    @web.middleware
+    async def middleware(self, request: web.Request, handler) -> web.Response:
+        name = handler.__name__[len("on_"):]
+        self.requests[name] += 1
+
+        if self.latency_ms or self.jitter_ms:
+            await asyncio.sleep((self.latency_ms + self.random.uniform(0, self.jitter_ms)) / 1000)
+
+        if name in INJECTABLE_REQUESTS:
+            if self.ratelimit_rate and self.random.random() < self.ratelimit_rate:
+                self.ratelimited += 1
+                return _error(429, "M_LIMIT_EXCEEDED", "Too Many Requests", retry_after_ms=self.retry_after_ms)
+            if self.failure_rate and self.random.random() < self.failure_rate:
+                self.failed += 1
+                return _error(500, "M_UNKNOWN", "Injected failure")
+
+        token = request.query.get("access_token")
+        authorization = request.headers.get("Authorization", "")
+        if not token and authorization.startswith("Bearer "):
+            token = authorization[len("Bearer "):]
+        request["user_id"] = self.tokens.get(token)
+        if request["user_id"] is None and name not in ("resolve_alias", "unrecognized"):
+            return _error(401, "M_UNKNOWN_TOKEN", "Unrecognised access token")
+
+        try:
+            return await handler(request)
+        except ConnectionResetError:
+            # The client gave up on the request, e.g. timed out while the latency was simulated
+            return web.Response(status=499)
+
+    # In-process API for setting up rooms and simulating users
+
+    def register_user(self, user_id: str) -> str:
+        """Add a user, returning its access token."""
+        token = f"token-{next(self.ids)}"
+        self.tokens[token] = user_id
+        return token
+
+    def send_event(
+            self, room_id: str, sender: str, event_type: str, content: Dict[str, Any], state_key: Optional[str] = None,
+            **fields,
+    ) -> Dict[str, Any]:
+        """Add an event to a room, delivering it to the next /sync of its members."""
+        room = self.rooms[room_id]
+        event = {
+            "event_id": f"${next(self.ids)}:{self.server_name}",
+            "type": event_type,
+            "sender": sender,
+            "room_id": room_id,
+            "origin_server_ts": int(time.time() * 1000),
+            "content": content,
+            "unsigned": {},
+        }
+        event.update(fields)
+        if state_key is not None:
+            event["state_key"] = state_key
+            previous = room.state.get((event_type, state_key))
+            if previous:
+                event["unsigned"]["prev_content"] = previous["content"]
+            room.state[(event_type, state_key)] = event
+
+        room.events[event["event_id"]] = event
+        self.stream.append((room_id, event))
+        self.positions[event["event_id"]] = len(self.stream)
+        self._notify()
+        return event
+
+    def send_message(self, room_id: str, sender: str, body: str, **content) -> Dict[str, Any]:
+        return self.send_event(room_id, sender, "m.room.message", dict(content, msgtype="m.text", body=body))
+
+    def set_membership(self, room_id: str, user_id: str, membership: str, sender: Optional[str] = None, **content):
+        return self.send_event(
+            room_id, sender or user_id, "m.room.member", dict(content, membership=membership), user_id,
+        )
+
+    def create_room(
+            self, creator: str, name: Optional[str] = None, invite: Iterable[str] = (), join: Iterable[str] = (),
+            alias: Optional[str] = None, is_direct: bool = False, initial_state: Iterable[Dict[str, Any]] = (),
+    ) -> str:
+        room_id = f"!{next(self.ids)}:{self.server_name}"
+        self.rooms[room_id] = FakeRoom(room_id)
+        self.send_event(room_id, creator, "m.room.create", {"creator": creator, "room_version": "9"}, "")
+        self.set_membership(room_id, creator, "join")
+        self.send_event(room_id, creator, "m.room.power_levels", {"users": {creator: 100}}, "")
+        self.send_event(room_id, creator, "m.room.join_rules", {"join_rule": "invite"}, "")
+        if name:
+            self.send_event(room_id, creator, "m.room.name", {"name": name}, "")
+        for state in initial_state:
+            self.send_event(room_id, creator, state["type"], state.get("content", {}), state.get("state_key", ""))
+        if alias:
+            self.aliases[alias] = room_id
+            self.send_event(room_id, creator, "m.room.canonical_alias", {"alias": alias}, "")
+        for user_id in join:
+            self.set_membership(room_id, user_id, "join")
+        for user_id in invite:
+            self.set_membership(room_id, user_id, "invite", creator, is_direct=is_direct)
+        return room_id
+
+    def _notify(self):
+        # Wake up the pending long-polls, later ones wait on a new event
+        if self.new_events:
+            self.new_events.set()
+            self.new_events = asyncio.Event()
+
+    # Client-server API
+
+    def sync_response(self, user_id: str, since: Optional[int], full_state: bool) -> Dict[str, Any]:
+        timelines: Dict[str, List[Dict[str, Any]]] = {}
+        if since is not None:
+            for room_id, event in self.stream[since:]:
+                timelines.setdefault(room_id, []).append(event)
+
+        join: Dict[str, Any] = {}
+        invite: Dict[str, Any] = {}
+        for room in self.rooms.values():
+            membership = room.membership(user_id)
+            if membership is None:
+                continue
+            member_event = room.state[("m.room.member", user_id)]
+            is_new = since is None or self.positions[member_event["event_id"]] > since
+
+            if membership == "join":
+                # The timeline of the initial sync is left empty, the bot would handle old events as new ones
+                timeline = timelines.get(room.room_id, [])
+                if not timeline and not is_new and not full_state:
+                    continue
+                join[room.room_id] = {
+                    "timeline": {"events": timeline, "limited": False, "prev_batch": f"s{since or 0}"},
+                    "state": {"events": list(room.state.values()) if is_new or full_state else []},
+                    "ephemeral": {"events": []},
+                    "account_data": {"events": []},
+                }
+            elif membership == "invite" and is_new:
+                stripped = [
+                    {key: event[key] for key in ("type", "state_key", "sender", "content")}
+                    for (event_type, _), event in room.state.items()
+                    if event_type in ("m.room.create", "m.room.name", "m.room.join_rules", "m.room.canonical_alias")
+                ]
+                invite[room.room_id] = {"invite_state": {"events": stripped + [member_event]}}
+
+        return {
+            "next_batch": f"s{len(self.stream)}",
+            "rooms": {"join": join, "invite": invite, "leave": {}},
+            "to_device": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {},
+            "presence": {"events": []},
+        }
+
+    async def on_sync(self, request: web.Request) -> web.Response:
+        since = request.query.get("since")
+        since = int(since[1:]) if since else None
+        timeout_s = int(request.query.get("timeout", 0)) / 1000
+
+        if since is not None and timeout_s:
+            deadline = time.monotonic() + timeout_s
+            while len(self.stream) <= since and time.monotonic() < deadline:
+                try:
+                    await asyncio.wait_for(self.new_events.wait(), deadline - time.monotonic())
+                except asyncio.TimeoutError:
+                    break
+
+        full_state = request.query.get("full_state") == "true"
+        return web.json_response(self.sync_response(request["user_id"], since, full_state))
+
+    def _room_for_member(self, request: web.Request) -> Tuple[Optional[FakeRoom], Optional[web.Response]]:
+        room = self.rooms.get(request.match_info["room_id"])
+        if not room:
+            return None, _error(404, "M_NOT_FOUND", "Unknown room")
+        if room.membership(request["user_id"]) != "join":
+            return None, _error(403, "M_FORBIDDEN", "User not in room")
+        return room, None
+
+    async def on_send(self, request: web.Request) -> web.Response:
+        room, error = self._room_for_member(request)
+        if error:
+            return error
+
+        transaction = (request["user_id"], request.match_info["txn_id"])
+        if transaction in self.transactions:
+            return web.json_response({"event_id": self.transactions[transaction]})
+
+        event = self.send_event(room.room_id, request["user_id"], request.match_info["event_type"], await request.json())
+        self.transactions[transaction] = event["event_id"]
+        for listener in self.send_listeners:
+            listener(room.room_id, event)
+        return web.json_response({"event_id": event["event_id"]})
+
+    async def on_create_room(self, request: web.Request) -> web.Response:
+        body = await request.json()
+        alias = f"#{body['room_alias_name']}:{self.server_name}" if body.get("room_alias_name") else None
+        if alias in self.aliases:
+            return _error(400, "M_ROOM_IN_USE", "Room alias already taken")
+        room_id = self.create_room(
+            request["user_id"],
+            name=body.get("name"),
+            invite=body.get("invite", []),
+            alias=alias,
+            is_direct=body.get("is_direct", False),
+            initial_state=body.get("initial_state", []),
+        )
+        return web.json_response({"room_id": room_id})
+
+    async def on_invite(self, request: web.Request) -> web.Response:
+        room, error = self._room_for_member(request)
+        if error:
+            return error
+        user_id = (await request.json())["user_id"]
+        if room.membership(user_id) in ("join", "invite"):
+            return _error(403, "M_FORBIDDEN", f"{user_id} is already in the room")
+        self.set_membership(room.room_id, user_id, "invite", request["user_id"])
+        return web.json_response({})
+
+    async def on_kick(self, request: web.Request) -> web.Response:
+        room, error = self._room_for_member(request)
+        if error:
+            return error
+        body = await request.json()
+        if room.membership(body["user_id"]) not in ("join", "invite"):
+            return _error(403, "M_FORBIDDEN", f"{body['user_id']} is not in the room")
+        content = {"reason": body["reason"]} if body.get("reason") else {}
+        self.set_membership(room.room_id, body["user_id"], "leave", request["user_id"], **content)
+        return web.json_response({})
+
+    async def on_get_event(self, request: web.Request) -> web.Response:
+        room, error = self._room_for_member(request)
+        if error:
+            return error
+        event = room.events.get(request.match_info["event_id"])
+        if not event:
+            return _error(404, "M_NOT_FOUND", "Event not found")
+        return web.json_response(event)
+
+    async def on_resolve_alias(self, request: web.Request) -> web.Response:
+        room_id = self.aliases.get(request.match_info["alias"])
+        if not room_id:
+            return _error(404, "M_NOT_FOUND", "Room alias not found")
+        return web.json_response({"room_id": room_id, "servers": [self.server_name]})
+
+    async def on_join(self, request: web.Request) -> web.Response:
+        room_id = self.aliases.get(request.match_info["room"], request.match_info["room"])
+        room = self.rooms.get(room_id)
+        if not room:
+            return _error(404, "M_NOT_FOUND", "Unknown room")
+        membership = room.membership(request["user_id"])
+        if membership not in ("join", "invite"):
+            return _error(403, "M_FORBIDDEN", "You are not invited to this room")
+        if membership == "invite":
+            self.set_membership(room_id, request["user_id"], "join")
+        return web.json_response({"room_id": room_id})
+
+    async def on_joined_members(self, request: web.Request) -> web.Response:
+        room, error = self._room_for_member(request)
+        if error:
+            return error
+        return web.json_response({
+            "joined": {user_id: {"display_name": None, "avatar_url": None} for user_id in room.joined()},
+        })
+
+    async def on_put_state(self, request: web.Request) -> web.Response:
+        room, error = self._room_for_member(request)
+        if error:
+            return error
+        event = self.send_event(
+            room.room_id, request["user_id"], request.match_info["event_type"], await request.json(),
+            request.match_info.get("state_key", ""),
+        )
+        return web.json_response({"event_id": event["event_id"]})
+
+    async def on_redact(self, request: web.Request) -> web.Response:
+        room, error = self._room_for_member(request)
+        if error:
+            return error
+        body = await request.json() if request.can_read_body else {}
+        content = {"reason": body["reason"]} if body.get("reason") else {}
+        event = self.send_event(
+            room.room_id, request["user_id"], "m.room.redaction", content, redacts=request.match_info["event_id"],
+        )
+        return web.json_response({"event_id": event["event_id"]})
+
+    async def on_unrecognized(self, request: web.Request) -> web.Response:
+        logger.warning(f"Fake homeserver does not implement {request.method} {request.path}")
+        return _error(404, "M_UNRECOGNIZED", "Unrecognized request")
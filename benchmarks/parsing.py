@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+"""Time spent extracting the fields of a message event, the former utils helpers against MessageContent.
+
+Every message needs its reply and edit relations, the reply text without its fallback, the !reply and
+!raise sections, whether the bot is mentioned and the quoted reply sender. The helpers the handlers
+called before MessageContent are kept here to compare with, both are checked to agree on every message.
+
+Usage: python -m benchmarks.parsing [options], see --help.
+"""
+import argparse
+import json
+import re
+import sys
+import timeit
+from typing import Any, Callable, Dict, List, Optional
+
+# noinspection PyPackageRequirements
+from nio import RoomMessageText
+
+from feedback_bot.utils import USER_ID_REGEX, MessageContent
+
+SERVER_NAME = "bench.local"
+BOT_USER_ID = f"@bot:{SERVER_NAME}"
+STAFF_USER_ID = f"@staff:{SERVER_NAME}"
+RELAYED_EVENT_ID = f"$relayed:{SERVER_NAME}"
+
+
+# The helpers, as the handlers called them before MessageContent
+
+reply_regex = re.compile(r"<mx-reply><blockquote>.*</blockquote></mx-reply>(.*)", flags=re.RegexFlag.DOTALL)
+reply_rx_pattern = r"> <@([^:>]+):([^>]+)> ([^\s]+)"
+
+
+def get_in_reply_to(event: RoomMessageText) -> Optional[str]:
+    return event.source.get("content", {}).get("m.relates_to", {}).get("m.in_reply_to", {}).get("event_id")
+
+
+def get_mentions(text: str) -> List[str]:
+    matches = re.finditer(USER_ID_REGEX, text, re.MULTILINE)
+    return list({match.group() for match in matches})
+
+
+def get_replaces(event: RoomMessageText) -> Optional[str]:
+    rel_type = event.source.get("content", {}).get("m.relates_to", {}).get("rel_type")
+    if rel_type == "m.replace":
+        return event.source.get("content").get("m.relates_to").get("event_id")
+
+
+def _get_reply_msg(event: RoomMessageText) -> Optional[str]:
+    if get_replaces(event):
+        msg_plain = event.source.get("content", {}).get("m.new_content", {}).get("body")
+        msg_formatted = event.source.get("content", {}).get("m.new_content", {}).get("formatted_body")
+    else:
+        msg_plain = event.source.get("content", {}).get("body")
+        msg_formatted = event.source.get("content", {}).get("formatted_body")
+
+    if msg_formatted and (reply_msg := reply_regex.findall(msg_formatted)):
+        return reply_msg[0]
+    elif msg_formatted:
+        return msg_formatted
+    else:
+        message_parts = msg_plain.split('\n\n', 1)
+        if len(message_parts) > 1:
+            return '\n\n'.join(message_parts[1:])
+        return msg_plain
+
+
+def get_reply_msg(event: RoomMessageText, reply_to: Optional[str], replaces: Optional[str]) -> Optional[str]:
+    if reply_to or replaces:
+        if reply_section := _get_reply_msg(event):
+            if any([reply_section.startswith(x) for x in ("!reply ", "<p>!reply ")]):
+                return reply_section
+
+
+def get_raise_msg(event: RoomMessageText, reply_to: Optional[str], replaces: Optional[str]) -> Optional[str]:
+    if reply_to or replaces:
+        if reply_section := _get_reply_msg(event):
+            if any([reply_section.startswith(x) for x in ("!raise ", "<p>!raise ")]):
+                return reply_section
+
+
+def _event(content: Dict[str, Any], sender: str = STAFF_USER_ID) -> RoomMessageText:
+    return RoomMessageText.from_dict({
+        "event_id": f"$event:{SERVER_NAME}",
+        "type": "m.room.message",
+        "sender": sender,
+        "origin_server_ts": 1700000000000,
+        "room_id": f"!room:{SERVER_NAME}",
+        "content": dict(content, msgtype="m.text"),
+    })
+
+
+def _reply(quoted: str, text: str, quoted_html: Optional[str] = None) -> Dict[str, Any]:
+    """A reply with the fallbacks Element sends, quoting a message of the bot."""
+    quoted_lines = "\n".join(f"> {line}" for line in f"<{BOT_USER_ID}> {quoted}".split("\n"))
+    return {
+        "body": f"{quoted_lines}\n\n{text}",
+        "format": "org.matrix.custom.html",
+        "formatted_body": f"<mx-reply><blockquote>{quoted_html if quoted_html is not None else quoted}"
+                          f"</blockquote></mx-reply>{text}",
+        "m.relates_to": {"m.in_reply_to": {"event_id": RELAYED_EVENT_ID}},
+    }
+
+
+def _nested_quotes(depth: int) -> str:
+    html = "question"
+    for level in range(depth):
+        html = f"<mx-reply><blockquote>{html}</blockquote></mx-reply>answer {level}"
+    return html
+
+
+# Name -> message, the first ones as seen every day, the others as large as a client would send
+MESSAGES: Dict[str, Callable[[], RoomMessageText]] = {
+    "plain": lambda: _event({"body": "Hello, I have a question about my account"}, "@user:example.org"),
+    "mention": lambda: _event({"body": f"{BOT_USER_ID} can you help me with my order?"}, "@user:example.org"),
+    "intentional_mention": lambda: _event({
+        "body": "bot: can you help me with my order?", "m.mentions": {"user_ids": [BOT_USER_ID]},
+    }, "@user:example.org"),
+    "staff_reply": lambda: _event(_reply("anon-fox (`!abc`): Hello, I have a question", "!reply Thanks, looking")),
+    "staff_raise": lambda: _event({
+        "body": f"> <{BOT_USER_ID}> anon-fox (`!abc`): Hello, I have a question\n\n!raise Billing",
+        "m.relates_to": {"m.in_reply_to": {"event_id": RELAYED_EVENT_ID}},
+    }),
+    "edit": lambda: _event({
+        "body": " * !reply Thanks, looking into it",
+        "m.new_content": {"body": "!reply Thanks, looking into it", "msgtype": "m.text"},
+        "m.relates_to": {"rel_type": "m.replace", "event_id": RELAYED_EVENT_ID},
+    }),
+    "huge_formatted": lambda: _event(_reply(
+        "anon-fox (`!abc`): log dump", "!reply " + "<p>" + "x" * 100 + "</p>" * 1 + "<br>" * 10000,
+        "<pre>" + "line of a pasted log file\n" * 40000 + "</pre>",
+    )),
+    "huge_plain": lambda: _event({"body": "A paragraph of a long story.\n\n" * 30000}, "@user:example.org"),
+    "many_mentions": lambda: _event(
+        {"body": " ".join(f"@user{i}:server{i % 50}.example.org" for i in range(5000))}, "@user:example.org",
+    ),
+    "at_signs": lambda: _event({"body": "@:" * 50000 + "@a:" + "a-" * 20000}, "@user:example.org"),
+    "deep_quotes": lambda: _event(dict(_reply("anon-fox (`!abc`): question", "!reply answer"), **{
+        "formatted_body": _nested_quotes(200) + "!reply answer",
+    })),
+}
+
+
+def with_helpers(event: RoomMessageText) -> Dict[str, Any]:
+    reply_to = get_in_reply_to(event)
+    replaces = get_replaces(event)
+    match = re.search(reply_rx_pattern, event.body) if reply_to else None
+    return {
+        "in_reply_to": reply_to,
+        "replaces": replaces,
+        "reply_msg": _get_reply_msg(event) if reply_to or replaces else None,
+        "reply_section": get_reply_msg(event, reply_to, replaces),
+        "raise_section": get_raise_msg(event, reply_to, replaces),
+        "bot_mentioned": BOT_USER_ID in get_mentions(event.body) or event.body.lower().find("bot") > -1,
+        "reply_quote_word": match[3] if match else None,
+    }
+
+
+def with_message_content(event: RoomMessageText) -> Dict[str, Any]:
+    content = MessageContent(event.source)
+    return {
+        "in_reply_to": content.in_reply_to,
+        "replaces": content.replaces,
+        "reply_msg": content.reply_msg if content.in_reply_to or content.replaces else None,
+        "reply_section": content.reply_section,
+        "raise_section": content.raise_section,
+        "bot_mentioned": content.mentions_user(BOT_USER_ID),
+        "reply_quote_word": content.reply_quote_word(),
+    }
+
+
+def _best_us(func: Callable[[RoomMessageText], Any], event: RoomMessageText, args: argparse.Namespace) -> float:
+    timer = timeit.Timer(lambda: func(event))
+    number, _ = timer.autorange()
+    number = max(number // 5, 1)
+    return min(timer.repeat(args.repeat, number)) / number * 1e6
+
+
+def run(args: argparse.Namespace) -> int:
+    mismatches = 0
+    if not args.json:
+        print(f"{'message':<20} {'size':>9} {'helpers us':>12} {'parser us':>12} {'speedup':>8}")
+    for name, build in MESSAGES.items():
+        if args.filter and args.filter not in name:
+            continue
+        event = build()
+        expected = with_helpers(event)
+        parsed = with_message_content(event)
+        differing = sorted(field for field in expected if expected[field] != parsed[field])
+        # Not asked for by the handlers, only checked. Clients sending m.mentions list them on purpose.
+        if "m.mentions" not in event.source["content"] and \
+                sorted(get_mentions(event.body)) != sorted(MessageContent(event.source).mentions):
+            differing.append("mentions")
+        helpers_us = _best_us(with_helpers, event, args)
+        parser_us = _best_us(with_message_content, event, args)
+        result = {
+            "message": name,
+            "size": len(json.dumps(event.source["content"])),
+            "helpers_us": round(helpers_us, 2),
+            "parser_us": round(parser_us, 2),
+            "speedup": round(helpers_us / parser_us, 2),
+        }
+        if differing:
+            result["mismatches"] = differing
+            mismatches += 1
+        if args.json:
+            print(json.dumps(result), flush=True)
+        else:
+            line = (
+                f"{name:<20} {result['size']:>9} {result['helpers_us']:>12.2f} {result['parser_us']:>12.2f} "
+                f"{result['speedup']:>7.2f}x"
+            )
+            if differing:
+                line += f"  MISMATCH: {', '.join(differing)}"
+            print(line, flush=True)
+    return 1 if mismatches else 0
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5, help="Timed runs per message, the fastest is reported")
+    parser.add_argument("--filter", default=None, help="Only messages containing this string")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per message")
+    return parser.parse_args(argv)
+
+
+def main(argv: Optional[List[str]] = None):
+    sys.exit(run(parse_args(argv)))
+
+
+if __name__ == "__main__":
+    main()
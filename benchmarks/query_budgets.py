@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""Database queries per event of each code path, checked against a budget per path.
+
+Queries are attributed to the code path that handled their event, e.g. TextMessage.user_relay_to_ticket_room
+or Command.raise. The events come from the relay_load profiles, or from a journal replayed into the bot.
+
+Usage: python -m benchmarks.query_budgets [profile ...] [relay_load options] [--report FILE] [--budget PATH=N ...]
+       python -m benchmarks.query_budgets --replay config.yaml events.jsonl [--database URL]
+"""
+import argparse
+import asyncio
+import json
+import sys
+from typing import Any, Dict, Iterable, List, Optional
+
+from benchmarks import relay_load
+from feedback_bot import replay
+
+# Most queries a single event of the path may run. The first message of a user creates them,
+# so the relay paths are budgeted for that rather than for the following messages.
+BUDGETS: Dict[str, int] = {
+    "TextMessage.user_relay_to_management_room": 9,
+    "TextMessage.user_relay_to_ticket_room": 4,
+    "TextMessage.management_room": 2,
+    "TextMessage.ticket_room": 4,
+    "Command.raise": 12,
+}
+
+
+def merge_reports(reports: Iterable[Dict[str, Dict[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Per path reports of several runs, as one."""
+    merged: Dict[str, Dict[str, Any]] = {}
+    for report in reports:
+        for name, path in report.items():
+            total = merged.get(name)
+            if total is None:
+                merged[name] = {**path, "worst": dict(path["worst"]), "methods": dict(path["methods"])}
+                continue
+            events = total["events"] + path["events"]
+            total["mean"] = round((total["mean"] * total["events"] + path["mean"] * path["events"]) / events, 2)
+            total["events"] = events
+            if path["max"] > total["max"]:
+                total["max"] = path["max"]
+                total["worst"] = dict(path["worst"])
+            for method, count in path["methods"].items():
+                total["methods"][method] = total["methods"].get(method, 0) + count
+    return dict(sorted(merged.items()))
+
+
+def check_budgets(report: Dict[str, Dict[str, Any]], budgets: Dict[str, int]) -> List[str]:
+    """Paths whose worst event ran more queries than their budget, described."""
+    over = []
+    for name, budget in sorted(budgets.items()):
+        path = report.get(name)
+        if path and path["max"] > budget:
+            worst = ", ".join(f"{method} {count}" for method, count in path["worst"].items())
+            over.append(f"{name}: {path['max']} queries in one event, budget {budget} ({worst})")
+    return over
+
+
+def format_report(report: Dict[str, Dict[str, Any]], budgets: Dict[str, int]) -> str:
+    lines = [f"{'path':<48} {'events':>7} {'mean':>6} {'max':>4} {'budget':>6}"]
+    for name, path in report.items():
+        budget = budgets.get(name)
+        lines.append(
+            f"{name:<48} {path['events']:>7} {path['mean']:>6.1f} {path['max']:>4} {'-' if budget is None else budget:>6}"
+        )
+    missing = sorted(set(budgets) - set(report))
+    if missing:
+        lines.append(f"Not exercised: {', '.join(missing)}")
+    return "\n".join(lines)
+
+
+def _budget(value: str) -> Dict[str, int]:
+    name, _, budget = value.rpartition("=")
+    if not name or not budget.isdigit():
+        raise argparse.ArgumentTypeError(f"expected PATH=N, got '{value}'")
+    return {name: int(budget)}
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        description=__doc__.split("\n\n")[0], epilog="Other options are passed on to benchmarks.relay_load.",
+    )
+    parser.add_argument("--report", default=None, help="File to write the queries per path to, as JSON")
+    parser.add_argument(
+        "--budget", type=_budget, action="append", default=[],
+        help="Budget of a path, overriding the default one, e.g. Command.raise=10",
+    )
+    parser.add_argument(
+        "--replay", nargs=2, metavar=("CONFIG", "JOURNAL"), default=None,
+        help="Replay a journal instead of running the relay_load profiles",
+    )
+    parser.add_argument("--database", default=None, help="Database to replay the journal into, see feedback_bot.replay")
+    args, relay_load_argv = parser.parse_known_args(argv)
+    # Fewer events than the throughput runs, each path only needs a few of its events
+    defaults = ["--users", "20", "--messages", "2", "--rate", "0"]
+    args.relay_load = relay_load.parse_args(defaults + relay_load_argv)
+    args.budgets = dict(BUDGETS)
+    for budget in args.budget:
+        args.budgets.update(budget)
+    return args
+
+
+async def collect(args: argparse.Namespace) -> Dict[str, Dict[str, Any]]:
+    if args.replay:
+        replay_args = replay.parse_args(
+            list(args.replay) + (["--database", args.database] if args.database else []),
+        )
+        results = [await replay._main(replay_args)]
+    else:
+        results = await relay_load.run(args.relay_load)
+    return merge_reports(result["queries_per_path"] for result in results)
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    report = asyncio.run(collect(args))
+    print(format_report(report, args.budgets))
+    if args.report:
+        with open(args.report, "w") as f:
+            json.dump({"budgets": args.budgets, "paths": report}, f, indent=2)
+
+    over = check_budgets(report, args.budgets)
+    for line in over:
+        print(f"Over budget: {line}")
+    sys.exit(1 if over else 0)
+
+
+if __name__ == "__main__":
+    main()
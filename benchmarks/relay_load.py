@@ -0,0 +1,485 @@
+#!/usr/bin/env python3
+"""Relay throughput, latency and database queries of the bot under synthetic load.
+
+The real Callbacks handle the events, synced over HTTP from an in-process fake homeserver, with a
+fresh SQLite database per profile. Nothing leaves the machine.
+
+Usage: python -m benchmarks.relay_load [profile ...] [options], see --help.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import time
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import yaml
+# noinspection PyPackageRequirements
+from nio import AsyncClientConfig
+
+from benchmarks.fake_homeserver import FakeHomeserver
+from feedback_bot import metrics
+from feedback_bot.callbacks import Callbacks
+from feedback_bot.client import PooledAsyncClient
+from feedback_bot.config import Config
+from feedback_bot.journal import EventJournal
+from feedback_bot.main import register_callbacks
+from feedback_bot.models.Chat import Chat
+from feedback_bot.models.Repositories.Repositories import Repositories
+from feedback_bot.models.RoomClassifier import RoomClassifier
+from feedback_bot.models.Staff import Staff
+from feedback_bot.models.Ticket import Ticket
+from feedback_bot.models.User import User
+from feedback_bot.sender_pool import SenderPool
+from feedback_bot.storage import Storage
+from feedback_bot.utils import alias_cache
+
+logger = logging.getLogger(__name__)
+
+SERVER_NAME = "bench.local"
+BOT_USER_ID = f"@bot:{SERVER_NAME}"
+STAFF_USER_ID = f"@staff:{SERVER_NAME}"
+MANAGEMENT_ROOM_ALIAS = f"#management:{SERVER_NAME}"
+# Every measured event carries a token, found again in what the bot sends for it
+TOKEN_PATTERN = re.compile(r"bench-\d+")
+
+
+def _percentile(values: List[float], q: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+def _total_queries() -> int:
+    return sum(totals[1] for _, totals in metrics.DB_QUERY_LATENCY.values.values())
+
+
+def _total_processed() -> float:
+    return sum(metrics.EVENTS_PROCESSED.values.values())
+
+
+class RelayBenchmark(object):
+    def __init__(self, args: argparse.Namespace):
+        """One profile run: a fake homeserver, a bot with a fresh database and the measurements.
+
+        Profiles add users before starting the bot, so their rooms arrive in the initial sync,
+        then inject events with a token and wait for the bot to send something containing it.
+        """
+        self.args = args
+        self.directory = tempfile.mkdtemp(prefix="feedback-bot-bench-")
+        self.hs = FakeHomeserver(
+            SERVER_NAME,
+            latency_ms=args.latency_ms,
+            jitter_ms=args.jitter_ms,
+            ratelimit_rate=args.ratelimit_rate,
+            retry_after_ms=args.retry_after_ms,
+            failure_rate=args.failure_rate,
+            seed=args.seed,
+        )
+        self.hs.send_listeners.append(self.on_send)
+
+        self.config: Optional[Config] = None
+        self.store: Optional[Storage] = None
+        self.journal: Optional[EventJournal] = None
+        # Directory to journal the events to, with the config to replay them
+        self.journal_directory: Optional[str] = None
+        self.client: Optional[PooledAsyncClient] = None
+        self.sync_task: Optional[asyncio.Future] = None
+        self.management_room_id = ""
+        # user ID -> their room with the bot
+        self.user_rooms: Dict[str, str] = {}
+
+        self.tokens = 0
+        # token -> time injected, until the bot sends it on
+        self.pending: Dict[str, float] = {}
+        # token -> (room ID, event ID) of the event the bot sent with it
+        self.relayed: Dict[str, Tuple[str, str]] = {}
+        self.latencies: List[float] = []
+        self.drained: Optional[asyncio.Event] = None
+
+        self.measuring_since = 0.0
+        self.last_relay_at = 0.0
+        self.injected = 0
+        self.queries_before = 0
+        self.processed_before = 0.0
+        self.ratelimited_before = 0
+        self.failed_before = 0
+
+    # Setup
+
+    def _write_config(self, homeserver_url: str, token: str) -> str:
+        path = os.path.join(self.directory, "config.yaml")
+        config = {
+            "command_prefix": "!c",
+            "matrix": {
+                "user_id": BOT_USER_ID,
+                "user_token": token,
+                "device_id": "BENCHMARK",
+                "homeserver_url": homeserver_url,
+            },
+            "storage": {
+                "database": f"sqlite://{os.path.join(self.directory, 'bot.db')}",
+                "store_path": os.path.join(self.directory, "store"),
+            },
+            "feedback_bot": {"management_room": MANAGEMENT_ROOM_ALIAS},
+            "logging": {
+                "level": self.args.log_level,
+                "file_logging": {"enabled": False},
+                "console_logging": {"enabled": False},
+                "matrix_logging": {"enabled": False},
+            },
+            "ignore_old_messages": False,
+        }
+        if self.journal_directory:
+            os.makedirs(self.journal_directory, exist_ok=True)
+            # The replay writes to a database of its own next to the journal
+            replay_config = dict(config, storage={
+                "database": f"sqlite://{os.path.join(self.journal_directory, 'replay.db')}",
+                "store_path": os.path.join(self.journal_directory, "store"),
+            })
+            with open(os.path.join(self.journal_directory, "config.yaml"), "w") as f:
+                yaml.safe_dump(replay_config, f)
+            config["journal"] = {"enabled": True, "path": os.path.join(self.journal_directory, "events.jsonl")}
+        with open(path, "w") as f:
+            yaml.safe_dump(config, f)
+        return path
+
+    async def start_homeserver(self):
+        await self.hs.start()
+        self.management_room_id = self.hs.create_room(
+            STAFF_USER_ID, name="Management", alias=MANAGEMENT_ROOM_ALIAS, join=[BOT_USER_ID],
+        )
+
+    def add_users(self, count: int) -> List[Tuple[str, str]]:
+        """Users with a direct message room with the bot, as (user ID, room ID)."""
+        users = []
+        for i in range(len(self.user_rooms), len(self.user_rooms) + count):
+            user_id = f"@user{i}:{SERVER_NAME}"
+            room_id = self.hs.create_room(user_id, join=[BOT_USER_ID], is_direct=True)
+            self.user_rooms[user_id] = room_id
+            users.append((user_id, room_id))
+        return users
+
+    async def start_bot(self):
+        """Set up the bot as main does, with encryption disabled, and wait for the initial sync."""
+        self.config = Config(self._write_config(self.hs.url, self.hs.register_user(BOT_USER_ID)))
+
+        # Caches are class attributes, shared by the profiles run in this process
+        Ticket.ticket_cache.clear()
+        Chat.chat_cache.clear()
+        alias_cache.clear()
+
+        self.store = Storage(self.config.database)
+        self.store.set_repositories(Repositories(self.store))
+        RoomClassifier.load(self.store)
+        Staff.create_new(self.store, STAFF_USER_ID)
+
+        client_config = AsyncClientConfig(max_limit_exceeded=0, max_timeouts=0, encryption_enabled=False)
+        self.client = PooledAsyncClient(
+            self.config.homeserver_url,
+            self.config.user_id,
+            device_id=self.config.device_id,
+            store_path=self.config.store_path,
+            config=client_config,
+            sync_pool=self.config.sync_pool,
+            outbound_pool=self.config.outbound_pool,
+        )
+        self.client.access_token = self.config.user_token
+        self.client.user_id = self.config.user_id
+
+        callbacks = Callbacks(self.client, self.store, self.config)
+        if self.config.journal_enabled:
+            self.journal = EventJournal(self.config)
+        register_callbacks(self.client, callbacks, self.journal)
+        self.client.callbacks = callbacks
+        self.client.watchdog = None
+        self.client.sender_pool = SenderPool(self.client, self.store, self.config, client_config)
+
+        await self.client.join(self.config.management_room)
+        response = await self.client.room_resolve_alias(self.config.management_room)
+        self.config.management_room_id = response.room_id
+
+        self.sync_task = asyncio.ensure_future(self.client.sync_forever(timeout=30000, full_state=True))
+        await self.client.synced.wait()
+
+    async def close(self):
+        if self.sync_task:
+            self.sync_task.cancel()
+        if self.client:
+            await self.client.close()
+        if self.journal:
+            self.journal.close()
+        await self.hs.close()
+        if self.store:
+            self.store.conn.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    # Load
+
+    def on_send(self, room_id: str, event: Dict[str, Any]):
+        now = time.monotonic()
+        for token in TOKEN_PATTERN.findall(event["content"].get("body", "")):
+            injected_at = self.pending.pop(token, None)
+            if injected_at is None:
+                continue
+            self.latencies.append(now - injected_at)
+            self.relayed[token] = (room_id, event["event_id"])
+            self.last_relay_at = now
+        if not self.pending and self.drained:
+            self.drained.set()
+
+    def new_token(self) -> str:
+        """Token for the next injected event, timed from now until the bot sends something containing it."""
+        self.tokens += 1
+        token = f"bench-{self.tokens}"
+        self.pending[token] = time.monotonic()
+        self.injected += 1
+        return token
+
+    async def pace(self):
+        """Wait for the next injection at the configured rate, or just yield to the bot if unlimited."""
+        delay_s = 0.0
+        if self.args.rate:
+            delay_s = self.measuring_since + self.injected / self.args.rate - time.monotonic()
+        await asyncio.sleep(max(delay_s, 0))
+
+    async def drain(self) -> int:
+        """Wait for the bot to send on every injected token, returning how many never arrived."""
+        self.drained = asyncio.Event()
+        if self.pending:
+            drained = asyncio.ensure_future(self.drained.wait())
+            await asyncio.wait(
+                (drained, self.sync_task), timeout=self.args.timeout, return_when=asyncio.FIRST_COMPLETED,
+            )
+            drained.cancel()
+            if self.sync_task.done():
+                # An exception in a callback ends the sync loop, as it would end main
+                self.sync_task.result()
+        lost = len(self.pending)
+        self.pending.clear()
+        return lost
+
+    def start_measuring(self):
+        self.measuring_since = time.monotonic()
+        self.last_relay_at = self.measuring_since
+        self.injected = 0
+        self.latencies = []
+        self.queries_before = _total_queries()
+        metrics.QUERY_PATHS.reset()
+        self.processed_before = _total_processed()
+        self.ratelimited_before = self.hs.ratelimited
+        self.failed_before = self.hs.failed
+
+    def results(self, profile: str, lost: int) -> Dict[str, Any]:
+        duration_s = max(self.last_relay_at - self.measuring_since, 1e-9)
+        return {
+            "profile": profile,
+            "injected": self.injected,
+            "relayed": len(self.latencies),
+            "lost": lost,
+            "duration_s": round(duration_s, 3),
+            "throughput": round(len(self.latencies) / duration_s, 1),
+            "latency_ms": {
+                name: round(value * 1000, 1) if value is not None else None
+                for name, value in (
+                    ("p50", _percentile(self.latencies, 0.5)),
+                    ("p95", _percentile(self.latencies, 0.95)),
+                    ("p99", _percentile(self.latencies, 0.99)),
+                    ("max", max(self.latencies) if self.latencies else None),
+                )
+            },
+            "queries_per_event": round((_total_queries() - self.queries_before) / self.injected, 1) if self.injected else None,
+            "events_processed": int(_total_processed() - self.processed_before),
+            "queries_per_path": metrics.QUERY_PATHS.report(),
+            "ratelimited": self.hs.ratelimited - self.ratelimited_before,
+            "failed": self.hs.failed - self.failed_before,
+        }
+
+
+# Profiles, each returns the number of tokens that were never relayed
+
+async def many_users(bench: RelayBenchmark) -> int:
+    """Many users writing in their own rooms, interleaved, relayed to the management room."""
+    users = bench.add_users(bench.args.users)
+    await bench.start_bot()
+    bench.start_measuring()
+    for _ in range(bench.args.messages):
+        for user_id, room_id in users:
+            bench.hs.send_message(room_id, user_id, f"Hello, I have a question {bench.new_token()}")
+            await bench.pace()
+    return await bench.drain()
+
+
+async def bursty_single_user(bench: RelayBenchmark) -> int:
+    """One user pasting bursts of messages at once."""
+    [(user_id, room_id)] = bench.add_users(1)
+    await bench.start_bot()
+    bench.start_measuring()
+    for burst in range(bench.args.bursts):
+        if burst:
+            await asyncio.sleep(bench.args.burst_interval)
+        for _ in range(bench.args.burst_size):
+            bench.hs.send_message(room_id, user_id, f"Another line of a long story {bench.new_token()}")
+    return await bench.drain()
+
+
+def _staff_reply(relayed_event_id: str, text: str) -> Dict[str, Any]:
+    quoted = f"> <{BOT_USER_ID}> relayed message"
+    return {
+        "body": f"{quoted}\n\n!reply {text}",
+        "format": "org.matrix.custom.html",
+        "formatted_body": f"<mx-reply><blockquote>{quoted}</blockquote></mx-reply>!reply {text}",
+        "m.relates_to": {"m.in_reply_to": {"event_id": relayed_event_id}},
+    }
+
+
+async def staff_replies(bench: RelayBenchmark) -> int:
+    """Staff replying to relayed messages in the management room, relayed back to the users."""
+    users = bench.add_users(bench.args.users)
+    await bench.start_bot()
+    # Messages to reply to, not measured
+    for user_id, room_id in users:
+        bench.hs.send_message(room_id, user_id, f"Hello, I have a question {bench.new_token()}")
+    await bench.drain()
+    relayed_event_ids = [event_id for _, event_id in bench.relayed.values()]
+
+    bench.start_measuring()
+    for _ in range(bench.args.messages):
+        for relayed_event_id in relayed_event_ids:
+            content = _staff_reply(relayed_event_id, f"Thanks for reaching out {bench.new_token()}")
+            bench.hs.send_event(bench.management_room_id, STAFF_USER_ID, "m.room.message", dict(content, msgtype="m.text"))
+            await bench.pace()
+    return await bench.drain()
+
+
+async def raise_storm(bench: RelayBenchmark) -> int:
+    """Staff raising a ticket for every user at once, each creating a room and copying the user's messages."""
+    users = bench.add_users(bench.args.users)
+    await bench.start_bot()
+    # Users to raise tickets for, not measured
+    for user_id, room_id in users:
+        bench.hs.send_message(room_id, user_id, f"Hello, I have a question {bench.new_token()}")
+    await bench.drain()
+    anon_ids = {User.get_existing(bench.store, user_id).anon_id for user_id, _ in users}
+
+    bench.start_measuring()
+    for anon_id in sorted(anon_ids):
+        # Answered with "Raised Ticket #<id> <name> for <anon_id>", the token is the ticket name
+        bench.hs.send_message(bench.management_room_id, STAFF_USER_ID, f"!c raise {anon_id} {bench.new_token()}")
+        await bench.pace()
+    return await bench.drain()
+
+
+async def ticket_conversation(bench: RelayBenchmark) -> int:
+    """Users and staff writing back and forth in open tickets, relayed between the user and ticket rooms."""
+    users = bench.add_users(bench.args.users)
+    await bench.start_bot()
+    # Tickets to write in, not measured
+    for user_id, room_id in users:
+        bench.hs.send_message(room_id, user_id, f"Hello, I have a question {bench.new_token()}")
+    await bench.drain()
+    for user_id, _ in users:
+        anon_id = User.get_existing(bench.store, user_id).anon_id
+        bench.hs.send_message(bench.management_room_id, STAFF_USER_ID, f"!c raise {anon_id} {bench.new_token()}")
+    await bench.drain()
+    # The raise is answered before the ticket room is created
+    tickets = [Ticket.get_existing(bench.store, User.get_existing(bench.store, user_id).current_ticket_id) for user_id, _ in users]
+    deadline = time.monotonic() + bench.args.timeout
+    while not all(ticket.ticket_room_id for ticket in tickets) and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    ticket_rooms = []
+    for (user_id, room_id), ticket in zip(users, tickets):
+        bench.hs.set_membership(ticket.ticket_room_id, STAFF_USER_ID, "join")
+        ticket_rooms.append((user_id, room_id, ticket.ticket_room_id))
+
+    bench.start_measuring()
+    for _ in range(bench.args.messages):
+        for user_id, room_id, ticket_room_id in ticket_rooms:
+            bench.hs.send_message(room_id, user_id, f"Any news on this? {bench.new_token()}")
+            await bench.pace()
+            bench.hs.send_message(ticket_room_id, STAFF_USER_ID, f"Looking into it {bench.new_token()}")
+            await bench.pace()
+    return await bench.drain()
+
+
+PROFILES: Dict[str, Callable[[RelayBenchmark], Any]] = {
+    "many_users": many_users,
+    "bursty_single_user": bursty_single_user,
+    "staff_replies": staff_replies,
+    "raise_storm": raise_storm,
+    "ticket_conversation": ticket_conversation,
+}
+
+
+def format_results(results: Dict[str, Any]) -> str:
+    latency = " / ".join("-" if value is None else f"{value:.1f}" for value in results["latency_ms"].values())
+    return "\n".join([
+        f"{results['profile']}:",
+        f"  relayed {results['relayed']} of {results['injected']} events in {results['duration_s']:.2f}s, "
+        f"{results['lost']} lost",
+        f"  throughput {results['throughput']:.1f} events/s",
+        f"  latency p50 / p95 / p99 / max {latency} ms",
+        f"  {results['queries_per_event'] or 0:.1f} DB queries per event, {results['events_processed']} events processed",
+        f"  injected {results['ratelimited']} rate limits and {results['failed']} failures",
+    ])
+
+
+async def run(args: argparse.Namespace) -> List[Dict[str, Any]]:
+    all_results = []
+    for profile in args.profiles:
+        bench = RelayBenchmark(args)
+        if args.journal:
+            bench.journal_directory = os.path.join(args.journal, profile)
+        try:
+            await bench.start_homeserver()
+            lost = await PROFILES[profile](bench)
+            all_results.append(bench.results(profile, lost))
+        finally:
+            await bench.close()
+        print(json.dumps(all_results[-1]) if args.json else format_results(all_results[-1]), flush=True)
+    return all_results
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("profiles", nargs="*", help=f"Load profiles to run, all by default: {', '.join(PROFILES)}")
+    parser.add_argument("--users", type=int, default=100, help="Users writing to the bot")
+    parser.add_argument("--messages", type=int, default=5, help="Messages per user, or staff replies per relayed message")
+    parser.add_argument("--rate", type=float, default=200, help="Injected events per second, 0 for as fast as possible")
+    parser.add_argument("--burst-size", type=int, default=100, help="Messages per burst of bursty_single_user")
+    parser.add_argument("--bursts", type=int, default=5, help="Bursts of bursty_single_user")
+    parser.add_argument("--burst-interval", type=float, default=1, help="Seconds between bursts")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Homeserver latency of every request")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Random homeserver latency on top")
+    parser.add_argument("--ratelimit-rate", type=float, default=0, help="Share of requests rate limited")
+    parser.add_argument("--retry-after-ms", type=int, default=100, help="retry_after_ms of the rate limits")
+    parser.add_argument("--failure-rate", type=float, default=0, help="Share of requests failed with a 500")
+    parser.add_argument("--seed", type=int, default=None, help="Seed of the injected latency, rate limits and failures")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for the bot to catch up")
+    parser.add_argument("--json", action="store_true", help="Print one JSON object per profile")
+    parser.add_argument("--log-level", default="ERROR", help="Log level of the bot")
+    parser.add_argument(
+        "--journal", default=None,
+        help="Directory to journal the events of each profile to, replayable with feedback_bot.replay",
+    )
+    args = parser.parse_args(argv)
+    for profile in args.profiles:
+        if profile not in PROFILES:
+            parser.error(f"unknown profile '{profile}'")
+    args.profiles = args.profiles or list(PROFILES)
+    return args
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    logging.basicConfig(format="%(asctime)s | %(name)s [%(levelname)s] %(message)s")
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
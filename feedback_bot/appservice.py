@@ -0,0 +1,266 @@
+import asyncio
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+# noinspection PyPackageRequirements
+from aiohttp import web
+# noinspection PyPackageRequirements
+from nio import AsyncClient, RoomGetStateResponse, SyncResponse
+
+from feedback_bot.config import Config
+from feedback_bot.crypto_store import flush_crypto_store
+from feedback_bot.storage import is_database_unavailable
+
+logger = logging.getLogger(__name__)
+
+TRANSACTIONS_CACHE_SIZE = 1000
+MAINTENANCE_INTERVAL_S = 30
+# Key of to-device events pushed to application services, unprefixed once MSC2409 is stable
+MSC2409_TO_DEVICE = "de.sorunome.msc2409.to_device"
+
+
+class AppService(object):
+    def __init__(self, client: AsyncClient, config: Config):
+        """Matrix application service endpoint, an alternative to polling /sync.
+
+        The homeserver pushes events in transactions, which are converted to sync responses and fed
+        through the client so room state, decryption and the registered Callbacks work as when syncing.
+
+        Args:
+            client (nio.AsyncClient): nio client used to interact with matrix
+
+            config (Config): Bot configuration parameters
+        """
+        self.client = client
+        self.config = config
+        self.processed_transactions = []
+        # Transaction ID and number of parts handled before the database became unavailable
+        self.interrupted_transaction: Optional[Tuple[str, int]] = None
+        # Transactions are handled one at a time, in the order they arrive
+        self.transaction_lock = asyncio.Lock()
+
+    def _is_authorized(self, request: web.Request) -> bool:
+        token = request.query.get("access_token")
+        authorization = request.headers.get("Authorization", "")
+        if authorization.startswith("Bearer "):
+            token = authorization[len("Bearer "):]
+        return token == self.config.appservice_hs_token
+
+    @staticmethod
+    def _error(status: int, errcode: str, error: str) -> web.Response:
+        return web.json_response({"errcode": errcode, "error": error}, status=status)
+
+    async def on_transaction(self, request: web.Request) -> web.Response:
+        if not self._is_authorized(request):
+            return self._error(403, "M_FORBIDDEN", "Invalid homeserver token")
+
+        txn_id = request.match_info["txn_id"]
+        if txn_id in self.processed_transactions:
+            logger.debug("Skipping transaction %s as it's already processed", txn_id)
+            return web.json_response({})
+
+        try:
+            body = await request.json()
+        except ValueError:
+            return self._error(400, "M_NOT_JSON", "Transaction body is not valid JSON")
+
+        async with self.transaction_lock:
+            # The homeserver may have retried while we were processing the first attempt
+            if txn_id in self.processed_transactions:
+                return web.json_response({})
+
+            try:
+                await self.handle_transaction(txn_id, body)
+            except Exception as e:
+                if is_database_unavailable(e):
+                    # Not marked as processed, the homeserver retries it later
+                    logger.error(f"Database unavailable while handling transaction {txn_id}: {e}")
+                    return self._error(503, "M_UNKNOWN", "Database unavailable")
+                # Acknowledge anyway, a retry would fail the same way and block later transactions
+                logger.exception(f"Error handling transaction {txn_id}: {e}")
+
+            self.processed_transactions.insert(0, txn_id)
+            if len(self.processed_transactions) > TRANSACTIONS_CACHE_SIZE:
+                self.processed_transactions = self.processed_transactions[:TRANSACTIONS_CACHE_SIZE]
+
+        # The whole batch of events is acknowledged at once
+        return web.json_response({})
+
+    async def on_query(self, request: web.Request) -> web.Response:
+        if not self._is_authorized(request):
+            return self._error(403, "M_FORBIDDEN", "Invalid homeserver token")
+        # The bot does not provision users or room aliases
+        return self._error(404, "M_NOT_FOUND", "Not provisioned by this application service")
+
+    async def on_ping(self, request: web.Request) -> web.Response:
+        if not self._is_authorized(request):
+            return self._error(403, "M_FORBIDDEN", "Invalid homeserver token")
+        return web.json_response({})
+
+    async def _get_room_state(self, room_id: str) -> List[Dict[str, Any]]:
+        # Rooms the client has not seen yet need their state before events can be handled
+        response = await self.client.room_get_state(room_id)
+        if isinstance(response, RoomGetStateResponse):
+            return response.events
+        logger.warning(f"Failed to fetch state of room {room_id}: {response}")
+        return []
+
+    async def build_sync_response(self, txn_id: str, body: Dict[str, Any]) -> SyncResponse:
+        joined = {}
+        invited = {}
+        for event in body.get("events", []):
+            room_id = event.get("room_id")
+            if not room_id:
+                continue
+
+            is_own_invite = event.get("type") == "m.room.member" and \
+                event.get("state_key") == self.client.user_id and \
+                event.get("content", {}).get("membership") == "invite"
+            if is_own_invite and room_id not in self.client.rooms:
+                invite_state = event.get("unsigned", {}).get("invite_room_state", [])
+                invited[room_id] = {"invite_state": {"events": invite_state + [event]}}
+                continue
+
+            if room_id not in joined:
+                state = []
+                if room_id not in self.client.rooms:
+                    state = await self._get_room_state(room_id)
+                joined[room_id] = {
+                    "state": {"events": state},
+                    "timeline": {"events": [], "limited": False, "prev_batch": txn_id},
+                    "ephemeral": {"events": []},
+                    "account_data": {"events": []},
+                    "summary": {},
+                    "unread_notifications": {},
+                }
+            joined[room_id]["timeline"]["events"].append(event)
+
+        # To-device events and device list changes are only pushed with MSC2409 / MSC3202
+        to_device = body.get(MSC2409_TO_DEVICE, body.get("to_device", []))
+        device_lists = body.get("org.matrix.msc3202.device_lists", body.get("device_lists", {}))
+        one_time_keys = body.get("org.matrix.msc3202.device_one_time_keys_count", {})
+        own_key_counts = one_time_keys.get(self.client.user_id, {}).get(self.client.device_id, {})
+
+        return SyncResponse.from_dict({
+            "next_batch": self.client.next_batch or txn_id,
+            "rooms": {"join": joined, "invite": invited, "leave": {}},
+            "to_device": {"events": to_device},
+            "device_lists": {"changed": device_lists.get("changed", []), "left": device_lists.get("left", [])},
+            "device_one_time_keys_count": own_key_counts,
+            "presence": {"events": []},
+            "account_data": {"events": []},
+        })
+
+    @staticmethod
+    def split_transaction(body: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Split a transaction into parts of one event each, handled in order.
+
+        Device list changes and key counts come first, then the to-device events, which may carry
+        the keys of the room events after them.
+        """
+        to_device = body.get(MSC2409_TO_DEVICE, body.get("to_device", []))
+        parts = [{key: value for key, value in body.items() if key not in ("events", "to_device", MSC2409_TO_DEVICE)}]
+        parts += [{"to_device": [event]} for event in to_device]
+        parts += [{"events": [event]} for event in body.get("events", [])]
+        return parts
+
+    async def handle_transaction(self, txn_id: str, body: Dict[str, Any]):
+        parts = self.split_transaction(body)
+        logger.debug(f"Handling transaction {txn_id} with {len(body.get('events', []))} events")
+
+        # A retried transaction continues after the parts handled before the database became unavailable
+        first_part = 0
+        if self.interrupted_transaction and self.interrupted_transaction[0] == txn_id:
+            first_part = self.interrupted_transaction[1]
+        self.interrupted_transaction = None
+
+        for index in range(first_part, len(parts)):
+            try:
+                await self.handle_part(txn_id, parts[index])
+            except Exception as e:
+                if is_database_unavailable(e):
+                    self.interrupted_transaction = (txn_id, index)
+                    raise
+                # One failing event does not keep the rest of the transaction from being handled
+                logger.exception(f"Error handling part {index} of transaction {txn_id}: {e}")
+
+        try:
+            await self.run_maintenance()
+            flush_crypto_store(self.client)
+        except Exception as e:
+            if is_database_unavailable(e):
+                self.interrupted_transaction = (txn_id, len(parts))
+            raise
+        # Response callbacks only run for syncs, flush the journal as after one
+        journal = getattr(self.client, "journal", None)
+        if journal:
+            await journal.flush()
+
+    async def handle_part(self, txn_id: str, body: Dict[str, Any]):
+        response = await self.build_sync_response(txn_id, body)
+        if not isinstance(response, SyncResponse):
+            logger.error(f"Failed to parse part of transaction {txn_id}: {response}")
+            return
+
+        # Same handling as a sync response, without touching the sync token. This relies on private
+        # matrix-nio methods: AsyncClient._handle_to_device, _handle_invited_rooms, _handle_joined_rooms,
+        # _handle_expired_verifications, _collect_key_requests and Client._handle_olm_events.
+        # Check them when upgrading matrix-nio.
+        await self.client._handle_to_device(response)
+        await self.client._handle_invited_rooms(response)
+        await self.client._handle_joined_rooms(response)
+        if self.client.olm:
+            await self.client._handle_expired_verifications()
+            self.client._handle_olm_events(response)
+            await self.client._collect_key_requests()
+
+    async def run_maintenance(self):
+        """Send queued to-device messages and keep encryption keys up to date, as sync_forever does."""
+        tasks = [asyncio.ensure_future(self.client.send_to_device_messages())]
+        if self.client.should_upload_keys:
+            tasks.append(asyncio.ensure_future(self.client.keys_upload()))
+        if self.client.should_query_keys:
+            tasks.append(asyncio.ensure_future(self.client.keys_query()))
+        if self.client.should_claim_keys:
+            tasks.append(asyncio.ensure_future(self.client.keys_claim(self.client.get_users_for_key_claiming())))
+
+        for response in asyncio.as_completed(tasks):
+            await self.client.run_response_callbacks([await response])
+
+    async def _maintenance_loop(self):
+        while True:
+            await asyncio.sleep(MAINTENANCE_INTERVAL_S)
+            async with self.transaction_lock:
+                try:
+                    await self.run_maintenance()
+                except Exception as e:
+                    logger.warning(f"Application service maintenance failed: {e}")
+
+    def make_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_put("/_matrix/app/v1/transactions/{txn_id}", self.on_transaction)
+        app.router.add_get("/_matrix/app/v1/users/{user_id}", self.on_query)
+        app.router.add_get("/_matrix/app/v1/rooms/{room_alias}", self.on_query)
+        app.router.add_post("/_matrix/app/v1/ping", self.on_ping)
+        # Legacy paths used by older homeservers
+        app.router.add_put("/transactions/{txn_id}", self.on_transaction)
+        app.router.add_get("/users/{user_id}", self.on_query)
+        app.router.add_get("/rooms/{room_alias}", self.on_query)
+        return app
+
+    async def run(self):
+        """Listen for transactions from the homeserver until cancelled."""
+        runner = web.AppRunner(self.make_app())
+        await runner.setup()
+        site = web.TCPSite(runner, self.config.appservice_listen_host, self.config.appservice_listen_port)
+        await site.start()
+        logger.info(
+            f"Application service listening on {self.config.appservice_listen_host}:{self.config.appservice_listen_port}"
+        )
+
+        maintenance = asyncio.ensure_future(self._maintenance_loop())
+        try:
+            await asyncio.Event().wait()
+        finally:
+            maintenance.cancel()
+            await runner.cleanup()
@@ -20,8 +20,10 @@ from feedback_bot import commands_help
 from feedback_bot.chat_functions import create_private_room, invite_to_room, send_text_to_room, kick_from_room, \
     find_private_msg, is_user_in_room, send_shared_history_keys
 from feedback_bot.config import Config
+from feedback_bot.crypto_maintenance import CryptoStoreMaintenance
 from feedback_bot.handlers.EventStateHandler import EventStateHandler, LogLevel, RoomType
 from feedback_bot.handlers.MessagingHandler import MessagingHandler
+from feedback_bot.metrics import query_path
 from feedback_bot.models.Chat import Chat
 from feedback_bot.models.EventPairs import EventPair
 from feedback_bot.models.IncomingEvent import IncomingEvent
@@ -30,8 +32,9 @@ from feedback_bot.models.Staff import Staff
 from feedback_bot.models.Support import Support
 from feedback_bot.models.Ticket import Ticket
 from feedback_bot.models.User import User
+from feedback_bot.stats import build_stats_report
 from feedback_bot.storage import Storage
-from feedback_bot.utils import get_replaces, get_username
+from feedback_bot.utils import get_username, message_content
 
 logger = logging.getLogger(__name__)
 
@@ -76,6 +79,7 @@ class Command(object):
             return
 
         """Process the command"""
+        query_path(f"Command.{self.command.split()[0] if self.command.split() else ''}")
         if self.command.startswith("echo"):
             await self._echo()
         elif self.command.startswith("help"):
@@ -100,11 +104,20 @@ class Command(object):
             await self._show_active_user_ticket()
         elif self.command.startswith("addstaff"):
             await self._add_staff()
+        elif self.command.startswith("prunestore"):
+            await self._prune_store()
+        elif self.command.startswith("profile"):
+            await self._profile()
+        elif self.command.startswith("stats"):
+            await self._stats()
+        elif self.command.startswith("memory"):
+            await self._memory()
         #elif self.command.startswith("setupcommunicationsroom"):
         #    await self._setup_communications_room()
         #elif self.command.startswith("chat"):
         #    await self._chat()
         else:
+            query_path("Command.unknown")
             await self._unknown_command()
 
     # ## Decorators
@@ -150,6 +163,10 @@ class Command(object):
             "opentickets":commands_help.COMMAND_OPEN_TICKETS,
             "activeticket":commands_help.COMMAND_ACTIVE_TICKET,
             "addstaff":commands_help.COMMAND_ADD_STAFF,
+            "prunestore":commands_help.COMMAND_PRUNE_STORE,
+            "profile":commands_help.COMMAND_PROFILE,
+            "stats":commands_help.COMMAND_STATS,
+            "memory":commands_help.COMMAND_MEMORY,
             #"setupcommunicationsroom":commands_help.COMMAND_SETUP_COMMUNICATIONS_ROOM,
             #"chat":commands_help.COMMAND_CHAT,
 
@@ -178,7 +195,7 @@ class Command(object):
             await send_text_to_room(self.client, self.room.room_id, commands_help.COMMAND_WRITE)
             return
 
-        replaces = get_replaces(self.event)
+        replaces = message_content(self.event).replaces
         replaces_event_id = None
         if replaces:
             message = self.store.get_message_by_management_event_id(replaces)
@@ -281,6 +298,43 @@ class Command(object):
             self.client, self.room.room_id, f"{user_id} is now staff.",
         )
 
+    async def _prune_store(self):
+        """
+        Prune and compact the encryption key store
+        Arg "dryrun" - only report what would be pruned
+        """
+        dry_run = len(self.args) > 0 and self.args[0] == "dryrun"
+        report = await CryptoStoreMaintenance(self.client, self.store, self.config).run(dry_run)
+        await send_text_to_room(self.client, self.room.room_id, report)
+
+    async def _profile(self):
+        """
+        Control the profiler of the running bot
+        Arg "start (sampling|cprofile)", "stop" or "dump"
+        """
+        action = self.args[0] if self.args else None
+        if action == "start":
+            report = self.client.profiler.start(self.args[1] if len(self.args) > 1 else "sampling")
+        elif action == "stop":
+            report = self.client.profiler.stop()
+        elif action == "dump":
+            report = self.client.profiler.dump()
+        else:
+            report = commands_help.COMMAND_PROFILE
+        await send_text_to_room(self.client, self.room.room_id, report)
+
+    async def _stats(self):
+        """
+        Show uptime, throughput, latency, queue, cache, database and rate limit statistics
+        """
+        await send_text_to_room(self.client, self.room.room_id, build_stats_report(self.client))
+
+    async def _memory(self):
+        """
+        Take a memory snapshot and report memory per subsystem and its growth
+        """
+        await send_text_to_room(self.client, self.room.room_id, self.client.memory_monitor.report())
+
     async def _setup_communications_room(self):
         """
         Updates the communications room of a user. Creates one if needed.
@@ -410,7 +464,9 @@ class Command(object):
             return
 
         # Create a room for this ticket and invite staff to it
-        response = await ticket.create_ticket_room(self.client, [self.handler.staff.user_id])
+        response = await ticket.create_ticket_room(
+            self.client, [self.handler.staff.user_id], encrypted=self.config.ticket_room_pool_encrypted,
+        )
         if isinstance(response, RoomCreateResponse):
             logger.info(f"Created a Ticket room {response.room_id} successfully for ticket id {ticket.id}")
         else:
@@ -677,7 +733,10 @@ class Command(object):
                     resp = await invite_to_room(self.client, self.handler.staff.user_id, room.room_id)
 
                     if isinstance(resp, RoomInviteResponse):
-                        await send_shared_history_keys(self.client, room.room_id, [self.handler.staff.user_id])
+                        await send_shared_history_keys(
+                            self.client, self.store, room.room_id, [self.handler.staff.user_id],
+                            self.config.shared_history_max_age_days,
+                        )
 
         else:
             msg = f"Ticket {ticket.id} is already open"
@@ -713,7 +772,10 @@ class Command(object):
         response = await ticket.invite_to_ticket_room(self.client, self.handler.staff.user_id)
 
         if isinstance(response, RoomInviteResponse):
-            await send_shared_history_keys(self.client, ticket.ticket_room_id, [self.handler.staff.user_id])
+            await send_shared_history_keys(
+                self.client, self.store, ticket.ticket_room_id, [self.handler.staff.user_id],
+                self.config.shared_history_max_age_days,
+            )
             logger.debug(f"Invited staff to Ticket room successfully")
         else:
             msg = f"Failed to invite {self.handler.staff.user_id} to Ticket room {ticket.ticket_room_id}: {response.message}"
@@ -759,7 +821,10 @@ class Command(object):
         response = await ticket.invite_to_ticket_room(self.client, support.user_id)
 
         if isinstance(response, RoomInviteResponse):
-            await send_shared_history_keys(self.client, ticket.ticket_room_id, [support.user_id])
+            await send_shared_history_keys(
+                self.client, self.store, ticket.ticket_room_id, [support.user_id],
+                self.config.shared_history_max_age_days,
+            )
             logger.debug(f"Invited support to Ticket room successfully")
         else:
             msg = f"Failed to invite {support.user_id} to Ticket room {ticket.ticket_room_id}: {response.message}"
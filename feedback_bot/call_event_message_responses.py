@@ -6,8 +6,9 @@ from nio.rooms import MatrixRoom
 from nio.events.room_events import CallEvent
 
 from feedback_bot.event_responses import Message
-from feedback_bot.chat_functions import send_text_to_room
+from feedback_bot.chat_functions import get_sender, send_text_to_room
 from feedback_bot.config import Config
+from feedback_bot.metrics import observe_relay
 from feedback_bot.storage import Storage
 from feedback_bot.utils import with_ratelimit
 
@@ -83,12 +84,13 @@ class CallEventMessage(Message):
                 self.client.callbacks.rooms_pending[task[1]].append(task)
                 return
 
-            resp = await with_ratelimit(self.client.room_send)(
+            resp = await with_ratelimit(get_sender(self.client, room_id).room_send)(
                     room_id,
                     self.event.source.get("type", None),
                     self.event.source.get("content")
             )
         
+            observe_relay(resp)
             if type(resp) == ErrorResponse:
                 logger.error("Failed to relay call %s to room %s", self.event.event_id, self.room.room_id)
             else:
@@ -1,26 +1,33 @@
-import json
 import logging
+import time
 from datetime import datetime
 
 # noinspection PyPackageRequirements
 from nio import (
-    JoinError, MatrixRoom, Event, RoomKeyEvent, RoomMessageText, MegolmEvent, LocalProtocolError,
-    RoomKeyRequestError, RoomMemberEvent, Response, RoomKeyRequest, RedactionEvent, CallInviteEvent,
-    AsyncClient, CallEvent, 
+    JoinError, MatrixRoom, Event, RoomKeyEvent, RoomMessageText, MegolmEvent,
+    RoomMemberEvent, Response, RoomKeyRequest, RedactionEvent, CallInviteEvent,
+    AsyncClient, CallEvent, RoomNameEvent, SyncResponse,
 )
 
 from feedback_bot.bot_commands import Command
 from feedback_bot.call_event_message_responses import CallEventMessage
-from feedback_bot.chat_functions import send_text_to_room
+from feedback_bot.chat_functions import send_text_to_room, preshare_group_session
 from feedback_bot.config import Config
+from feedback_bot.crypto_store import flush_crypto_store
+from feedback_bot.encrypted_backlog import EncryptedEventBacklog
 from feedback_bot.media_responses import Media
 from feedback_bot.message_responses import TextMessage
+from feedback_bot.metrics import (
+    LAST_SYNC, SYNC_LAG, count_processed, count_received, event_processed,
+)
 from feedback_bot.models.Repositories.TicketRepository import TicketStatus
+from feedback_bot.models.RoomClassifier import RoomClassifier
 from feedback_bot.redact_responses import RedactMessage
 from feedback_bot.storage import Storage
+from feedback_bot.tracing import trace_event
 from feedback_bot.utils import with_ratelimit
 
-from feedback_bot.models.Ticket import Ticket, ticket_name_pattern
+from feedback_bot.models.Ticket import Ticket
 from feedback_bot.models.User import User
 
 logger = logging.getLogger(__name__)
@@ -45,13 +52,12 @@ class Callbacks(object):
         self.received_events = []
         self.welcome_message_sent_to_room = []
         self.rooms_pending = {}
+        # Megolm session ID -> None, in the order first seen
+        self.seen_megolm_sessions = {}
+        self.encrypted_backlog = EncryptedEventBacklog(client, store)
+        self.synced = False
 
-    async def decrypted_callback(self, room_id: str, event: RoomMessageText):
-        if isinstance(event, RoomMessageText):
-            await self.message(self.client.rooms[room_id], event)
-        else:
-            logger.warning(f"Unknown event %s passed to decrypted_callback" % event)
-
+    @count_received
     async def decryption_failure(self, room: MatrixRoom, event: MegolmEvent):
         """Callback for when an event fails to decrypt."""
         # If ignoring old messages, ignore messages older than 5 minutes
@@ -60,29 +66,14 @@ class Callbacks(object):
                     datetime.now() - datetime.fromtimestamp(event.server_timestamp / 1000.0)
             ).total_seconds() > 300:
                 return
+        event_processed(event)
         message = f"Failed to decrypt event {event.event_id} ({room.canonical_alias} / " \
                   f"{room.room_id}) (session {event.session_id} - decrypting " \
                   f"if keys arrive."
         logger.warning(message)
 
-        # Store for later
-        self.store.store_encrypted_event(event)
-
-        waiting_for_keys = self.store.get_encrypted_events_for_user(event.sender)
-        logger.info(
-            "Waiting to decrypt %s events",
-            len(waiting_for_keys),
-        )
-
-        # Send a request for the key
-        response = None
-        try:
-            response = await self.client.request_room_key(event)
-        except LocalProtocolError as ex:
-            if str(ex) != "A key sharing request is already sent out for this session id.":
-                logger.warning(f"Failed to request room key for event {event.event_id}: {ex}")
-        if isinstance(response, RoomKeyRequestError):
-            logger.warning("RoomKeyRequestError: %s (%s)", response.message, response.status_code)
+        # Store for later and request the key
+        await self.encrypted_backlog.add(event)
 
         # Send a message to the management room if
         # * matrix logging is not enabled
@@ -101,6 +92,7 @@ class Callbacks(object):
         if len(self.welcome_message_sent_to_room) > DUPLICATES_CACHE_SIZE:
             self.welcome_message_sent_to_room = self.welcome_message_sent_to_room[:DUPLICATES_CACHE_SIZE]
 
+    @count_received
     async def member(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
         """Callback for when a room member event is received.
 
@@ -117,6 +109,11 @@ class Callbacks(object):
         self.trim_duplicates_caches()
         if self.should_process(event.event_id) is False:
             return
+        event_processed(event)
+
+        # Members changed, so the next message needs a new group session
+        if event.membership in ("join", "invite"):
+            preshare_group_session(self.client, room.room_id)
 
         # Ignore if it was not us joining the room
         if event.sender != self.client.user:
@@ -174,6 +171,46 @@ class Callbacks(object):
             True,
         )
     
+    @count_received
+    async def room_name(self, room: MatrixRoom, event: RoomNameEvent) -> None:
+        """Callback for when a m.room.name event is received.
+
+        Args:
+            room (nio.rooms.MatrixRoom): The room the event came from
+
+            event (nio.events.room_events.RoomNameEvent): The event
+        """
+        if self.config.matrix_logging_room and room.room_id == self.config.matrix_logging_room:
+            # Don't react to anything in the logging room
+            return
+
+        self.trim_duplicates_caches()
+        if self.should_process(event.event_id) is False:
+            return
+        event_processed(event)
+
+        logger.debug(f"Room {room.room_id} renamed to {event.name}")
+        RoomClassifier.update_room_name(self.store, room.room_id, event.name)
+
+    async def megolm_session(self, room: MatrixRoom, event: Event) -> None:
+        """Callback for every room event, recording when each Megolm session was first seen in a room.
+
+        Args:
+            room (nio.rooms.MatrixRoom): The room the event came from
+
+            event (nio.events.room_events.Event): The event
+        """
+        session_id = getattr(event, "session_id", None)
+        if not session_id or session_id in self.seen_megolm_sessions:
+            return
+
+        self.seen_megolm_sessions[session_id] = None
+        # Sessions seen again after being dropped are recorded again, the upsert keeps the first time
+        if len(self.seen_megolm_sessions) > DUPLICATES_CACHE_SIZE:
+            del self.seen_megolm_sessions[next(iter(self.seen_megolm_sessions))]
+        self.store.repositories.roomKeyRep.put_session(session_id, room.room_id, event.server_timestamp)
+
+    @count_received
     async def call_event(self, room: MatrixRoom, event: CallEvent):
         """Callback for when a m.call.invite event is received
 
@@ -200,6 +237,8 @@ class Callbacks(object):
         
         await self._call_event(room, event)
 
+    @trace_event
+    @count_received
     async def redact(self, room, event):
         """Callback for when a redact event is received
 
@@ -225,9 +264,10 @@ class Callbacks(object):
         
         await self._redact(room, event)
         
+    @count_processed
     async def _call_event(self, room: MatrixRoom, event: CallEvent):
         # Ignore messages from ourselves
-        if event.sender == self.client.user:
+        if self.is_own_user(event.sender):
             return
 
         event_type = event.source["type"]
@@ -235,19 +275,22 @@ class Callbacks(object):
         call_invite = CallEventMessage(self.client, self.store, self.config, room, event, event_type)
         await call_invite.process()
     
+    @count_processed
     async def _redact(self, room, event: RedactionEvent):
         # Extract the redact information
         redacts_event_id = event.redacts
         reason = event.reason
 
         # Ignore messages from ourselves
-        if event.sender == self.client.user:
+        if self.is_own_user(event.sender):
             return
 
         redact = RedactMessage(self.client, self.store, self.config, room, event, redacts_event_id, reason)
         await redact.process()
         
 
+    @trace_event
+    @count_received
     async def message(self, room, event):
         """Callback for when a message event is received
 
@@ -273,12 +316,13 @@ class Callbacks(object):
         
         await self._message(room, event)
 
+    @count_processed
     async def _message(self, room, event):
         # Extract the message text
         msg = event.body
 
         # Ignore messages from ourselves
-        if event.sender == self.client.user:
+        if self.is_own_user(event.sender):
             return
 
         # If this looks like an edit, strip the edit prefix
@@ -303,6 +347,8 @@ class Callbacks(object):
             message = TextMessage(self.client, self.store, self.config, room, event, msg)
             await message.process()
 
+    @trace_event
+    @count_received
     async def media(self, room, event):
         """Callback for when a media event is received
 
@@ -327,11 +373,12 @@ class Callbacks(object):
             return
 
         # Ignore medias from ourselves
-        if event.sender == self.client.user:
+        if self.is_own_user(event.sender):
             return
         
         await self._media(room, event)
 
+    @count_processed
     async def _media(self, room, event):
         # Extract media type
         msgtype = event.source.get("content").get("msgtype")
@@ -354,10 +401,12 @@ class Callbacks(object):
         )
         await media.process()
 
+    @count_received
     async def invite(self, room, event):
         """Callback for when an invitation is received. Join the room specified in the invite"""
         if self.should_process(event.source.get("event_id")) is False:
             return
+        event_processed(event)
         logger.debug(f"Got invite to {room.room_id}.")
 
         result = await with_ratelimit(self.client.join)(room.room_id)
@@ -369,49 +418,7 @@ class Callbacks(object):
 
     async def room_key(self, event: RoomKeyEvent):
         """Callback for ToDevice events like room key events."""
-        events = self.store.get_encrypted_events(event.session_id)
-        waiting_for_keys = self.store.get_encrypted_events_for_user(event.sender)
-        if len(events):
-            log_func = logger.info
-        else:
-            log_func = logger.debug
-        log_func(
-            "Got room key event for session %s, matched sessions: %s",
-            event.session_id, len(events),
-        )
-        log_func(
-            "Waiting to decrypt %s events",
-            len(waiting_for_keys),
-        )
-
-        if not events:
-            return
-
-        for encrypted_event in events:
-            try:
-                event_dict = json.loads(encrypted_event["event"])
-                params = event_dict["source"]
-                params["room_id"] = event_dict["room_id"]
-                params["transaction_id"] = event_dict["transaction_id"]
-                megolm_event = MegolmEvent.from_dict(params)
-            except Exception as ex:
-                logger.warning("Failed to restore MegolmEvent for %s: %s", encrypted_event["event_id"], ex)
-                continue
-            try:
-                # noinspection PyTypeChecker
-                decrypted = self.client.decrypt_event(megolm_event)
-            except Exception as ex:
-                logger.warning("Error decrypting event %s: %s", megolm_event.event_id, ex)
-                continue
-            if isinstance(decrypted, Event):
-                logger.info("Successfully decrypted stored event %s", decrypted.event_id)
-                parsed_event = Event.parse_event(decrypted.source)
-                logger.info("Parsed event: %s", parsed_event)
-                self.store.remove_encrypted_event(decrypted.event_id)
-                # noinspection PyTypeChecker
-                await self.decrypted_callback(encrypted_event["room_id"], parsed_event)
-            else:
-                logger.warning("Failed to decrypt event %s", decrypted.event_id)
+        await self.encrypted_backlog.on_room_key(event)
 
     async def room_key_request(self, event: RoomKeyRequest):
         """Callback for ToDevice RoomKeyRequest events from unverified device."""
@@ -425,6 +432,28 @@ class Callbacks(object):
                 user_id, device_id):
             res = self.client.continue_key_share(request)
 
+    async def sync(self, response: SyncResponse):
+        """Callback for when a sync response has been handled."""
+        # Session updates of the whole response are written at once
+        flush_crypto_store(self.client)
+
+        now = time.time()
+        LAST_SYNC.set(now)
+        # The first sync returns the latest history of every room, not new events
+        if self.synced:
+            timestamps = [
+                event.server_timestamp
+                for room in response.rooms.join.values()
+                for event in room.timeline.events
+            ]
+            if timestamps:
+                SYNC_LAG.observe(max(now - max(timestamps) / 1000, 0))
+        self.synced = True
+
+    def is_own_user(self, user_id: str) -> bool:
+        """Whether the user is the bot or one of its sender pool accounts."""
+        return user_id == self.client.user or user_id in self.config.sender_pool_user_ids
+
     def should_process(self, event_id: str) -> bool:
         logger.debug("Callback received event: %s", event_id)
         if event_id in self.received_events:
@@ -1,6 +1,9 @@
+import asyncio
 import logging
+import time
 from collections import defaultdict
-from typing import List, Union, Dict, Iterator
+from typing import List, Union, Dict, Iterator, Optional, Tuple
+from uuid import uuid4
 
 from commonmark import commonmark
 # noinspection PyPackageRequirements
@@ -16,16 +19,73 @@ from nio import (
     RoomVisibility,
     RoomInviteError,
     RoomInviteResponse, RoomKickResponse, RoomKickError, MatrixRoom, RoomAvatarEvent,
-    ToDeviceMessage
+    ToDeviceMessage, ToDeviceResponse, ToDeviceError, Api, KeysQueryError, KeysClaimError,
+    ShareGroupSessionError,
 )
 from nio.crypto import OlmDevice, InboundGroupSession, Session
+from feedback_bot.storage import Storage
+from feedback_bot.tracing import span, traced
 from feedback_bot.utils import get_room_id, with_ratelimit
 
 logger = logging.getLogger(__name__)
 
+def get_sender(client: AsyncClient, room_id: str) -> AsyncClient:
+    """Get the account sending to a room - the client itself unless a sender pool is configured."""
+    sender_pool = getattr(client, "sender_pool", None)
+    if sender_pool:
+        return sender_pool.get_sender(room_id)
+    return client
+
+def get_event_sender(client: AsyncClient, sender_id: Optional[str]) -> AsyncClient:
+    """Get the account that sent an event of the bot, which alone may edit it. The client itself if unknown."""
+    sender_pool = getattr(client, "sender_pool", None)
+    if sender_id and sender_pool:
+        return sender_pool.get_account(sender_id) or client
+    return client
+
+# room_id -> background task sharing the room's outbound group session
+preshare_tasks: Dict[str, asyncio.Future] = {}
+
+def preshare_group_session(client: AsyncClient, room_id: str):
+    """Share the outbound Megolm session of a room in the background, ahead of the next message.
+
+    Otherwise room_send shares a new session lazily, delaying the first message after a membership change.
+    """
+    task = preshare_tasks.get(room_id)
+    if task and not task.done():
+        return
+    preshare_tasks[room_id] = asyncio.ensure_future(_preshare_group_session(client, room_id))
+
+async def _preshare_group_session(client: AsyncClient, room_id: str):
+    # Let the sync response that triggered this finish updating the room and invalidating its session first
+    await asyncio.sleep(0)
+
+    sender = get_sender(client, room_id)
+    room = sender.rooms.get(room_id)
+    if not sender.olm or not room or not room.encrypted:
+        return
+
+    try:
+        # Membership may change again while sharing
+        while sender.olm.should_share_group_session(room_id) and room_id not in sender.sharing_session:
+            if not room.members_synced:
+                await with_ratelimit(sender.joined_members)(room_id)
+            if sender.should_query_keys:
+                await with_ratelimit(sender.keys_query)()
+            resp = await with_ratelimit(sender.share_group_session)(room_id, ignore_unverified_devices=True)
+            if isinstance(resp, ShareGroupSessionError):
+                logger.warning(f"Failed to pre-share group session of room {room_id}: {resp.message}")
+                return
+            logger.debug(f"Pre-shared group session of room {room_id}")
+    except LocalProtocolError as ex:
+        logger.debug(f"Not pre-sharing group session of room {room_id}: {ex}")
+    finally:
+        preshare_tasks.pop(room_id, None)
+
+@traced("send_text_to_room")
 async def send_text_to_room(
     client: AsyncClient, room: str, message: str, notice: bool = True, markdown_convert: bool = True,
-    reply_to_event_id: str = None, replaces_event_id: str = None,
+    reply_to_event_id: str = None, replaces_event_id: str = None, sender: AsyncClient = None,
 ) -> Union[RoomSendResponse, RoomSendError, str]:
     """Send text to a matrix room
 
@@ -45,6 +105,9 @@ async def send_text_to_room(
         reply_to_event_id (str): Optional event ID that this message is a reply to.
 
         replaces_event_id (str): Optional event ID that this message replaces.
+
+        sender (nio.AsyncClient): Optional account to send with, the room's sender by default.
+            An edit must be sent by the account that sent the edited event.
     """
     try:
         room_id = await get_room_id(client, room, logger)
@@ -61,7 +124,8 @@ async def send_text_to_room(
     }
 
     if markdown_convert:
-        content["formatted_body"] = commonmark(message)
+        with span("commonmark"):
+            content["formatted_body"] = commonmark(message)
 
     if replaces_event_id:
         content["m.relates_to"] = {
@@ -74,7 +138,7 @@ async def send_text_to_room(
             "body": message,
         }
         if markdown_convert:
-            content["m.new_content"]["formatted_body"] = commonmark(message)
+            content["m.new_content"]["formatted_body"] = content["formatted_body"]
     # We don't store the original message content so cannot provide the fallback, unfortunately
     elif reply_to_event_id:
         content["m.relates_to"] = {
@@ -84,7 +148,7 @@ async def send_text_to_room(
         }
 
     try:
-        return await client.room_send(
+        response = await with_ratelimit((sender or get_sender(client, room_id)).room_send)(
             room_id,
             "m.room.message",
             content,
@@ -93,10 +157,13 @@ async def send_text_to_room(
     except (LocalProtocolError, SendRetryError) as ex:
         logger.exception(f"Unable to send message response to {room_id}")
         return f"Failed to send message: {ex}"
+    return response
 
 
-async def send_room_redact(client: AsyncClient, room_id: str, redacts_event_id: str, reason:str):
-    return await client.room_redact(
+async def send_room_redact(
+        client: AsyncClient, room_id: str, redacts_event_id: str, reason:str, sender: AsyncClient = None,
+):
+    return await with_ratelimit((sender or get_sender(client, room_id)).room_redact)(
             room_id,
             redacts_event_id,
             reason,
@@ -130,7 +197,7 @@ async def send_reaction(
     }
 
     try:
-        return await client.room_send(
+        return await with_ratelimit(get_sender(client, room_id).room_send)(
             room_id,
             "m.reaction",
             content,
@@ -141,9 +208,10 @@ async def send_reaction(
         return f"Failed to send reaction: {ex}"
 
 
+@traced("send_media_to_room")
 async def send_media_to_room(
     client: AsyncClient, room: str, media_type: str, body: str, media_url: str = None,
-    media_file: dict = None, media_info: dict = None, reply_to_event_id: str = None,
+    media_file: dict = None, media_info: dict = None, reply_to_event_id: str = None, sender: AsyncClient = None,
 ) -> Union[RoomSendResponse, RoomSendError, str]:
     """Send media to a matrix room
 
@@ -163,6 +231,8 @@ async def send_media_to_room(
         media_info (dict): The media url and metadata
 
         reply_to_event_id (str): Optional event ID that this message is a reply to.
+
+        sender (nio.AsyncClient): Optional account to send with, the room's sender by default.
     """
     try:
         room_id = await get_room_id(client, room, logger)
@@ -196,7 +266,7 @@ async def send_media_to_room(
         }
 
     try:
-        return await client.room_send(
+        response = await with_ratelimit((sender or get_sender(client, room_id)).room_send)(
             room_id,
             "m.room.message",
             content,
@@ -205,6 +275,7 @@ async def send_media_to_room(
     except (LocalProtocolError, SendRetryError) as ex:
         logger.exception(f"Unable to send media response to {room_id}")
         return f"Failed to send media: {ex}"
+    return response
 
 
 async def create_private_room(
@@ -255,18 +326,36 @@ def find_private_msg(client:AsyncClient, mxid: str) -> MatrixRoom:
     return msg_room
 
 async def create_room(
-        client: AsyncClient, roomname: str, invite:List[str] = []
+        client: AsyncClient, roomname: str, invite:List[str] = [], encrypted: bool = False
 ) -> Union[RoomCreateResponse, RoomCreateError]:
     """
     :param roomname: The room name
+    :param encrypted: Whether to enable encryption when creating the room
     :return: the Room Response from room_create()
     """
+    initial_state = []
+    if encrypted:
+        initial_state.append({
+            "type": "m.room.encryption",
+            "state_key": "",
+            "content": {"algorithm": "m.megolm.v1.aes-sha2"},
+        })
+
+    # Invite a sender pool account to share the outbound traffic of the room
+    sender_pool = getattr(client, "sender_pool", None)
+    sender = sender_pool.pick_new_room_sender() if sender_pool else None
+    if sender:
+        invite = invite + [sender.user_id]
+
     resp = await with_ratelimit(client.room_create)(
         name=roomname,
         invite=invite,
+        initial_state=initial_state,
     )
     if isinstance(resp, RoomCreateResponse):
         logger.debug(f"Created a new room with roomID: {resp.room_id}")
+        if sender:
+            sender_pool.set_room_sender(resp.room_id, sender)
     elif isinstance(resp, RoomCreateError):
         logger.exception(f"Failed to create a new room with error: {resp.status_code}")
     return resp
@@ -285,13 +374,20 @@ async def invite_to_room(
             )
         if isinstance(resp, RoomInviteResponse):
             logger.debug(f"Invited user {mxid} to room: {room_id}")
+            preshare_group_session(client, room_id)
         elif isinstance(resp, RoomInviteError):
             logger.exception(f"Failed to invite user {mxid} to room {room_id} with error: {resp.status_code}")
         return resp
 
 ## MSC3061: Sharing room keys for past messages - matrix-nio does not yet support sharing room keys, so this has been
 ## Implemented from scratch until proper library support comes out.
-async def send_shared_history_keys(client:AsyncClient, room_id: str, user_ids:List[str]):
+async def send_shared_history_keys(
+        client:AsyncClient, store:Storage, room_id: str, user_ids:List[str], max_age_days: Optional[int] = None,
+) -> int:
+    """
+    :param max_age_days: Only share sessions first seen in the room within this many days, all sessions if None
+    :return: the number of room keys sent
+    """
 
     if not client.olm:
         raise LocalProtocolError("End-to-end encryption disabled")
@@ -300,45 +396,120 @@ async def send_shared_history_keys(client:AsyncClient, room_id: str, user_ids:Li
     room = client.rooms.get(room_id)
     if not room:
         logger.error("Unknown room. Not sharing decryption keys")
-        return
+        return 0
     if not room.encrypted:
         logger.error("Room is unencrypted. Not sharing decryption keys")
-        return
+        return 0
+
+    since = None
+    if max_age_days is not None:
+        since = int((time.time() - max_age_days * 24 * 60 * 60) * 1000)
+
+    # Make sure every device can receive the keys
+    await establish_olm_sessions(client, user_ids)
 
-    # TODO: find way to fetch user devices from server.
     # Get user devices
     devices_by_user = {}
     for user_id in user_ids:
         devices_by_user[user_id] = client.device_store.active_user_devices(user_id)
-    await send_shared_history_inbound_sessions(client, room, devices_by_user)
-
-async def send_shared_history_inbound_sessions(client:AsyncClient, room:MatrixRoom, devices_by_user_iter: Dict[str, Iterator[OlmDevice]]):
+    return await send_shared_history_inbound_sessions(client, store, room, devices_by_user, since)
 
-    # Get stored InboundGroupSessions - currently storage does not differentiate between shareable and private, so we send all!!!.
-    shared_history_sessions:defaultdict[str, defaultdict[str, InboundGroupSession]] = client.olm.inbound_group_store._entries[room.room_id]
+async def establish_olm_sessions(client:AsyncClient, user_ids:List[str]):
+    """Fetch missing device lists and claim one-time keys for devices without an Olm session, in one request each.
+    """
+    # Users the bot shares no encrypted room with yet, or whose devices changed
+    untracked_users = {user_id for user_id in user_ids if user_id not in client.olm.tracked_users}
+    client.olm.users_for_key_query.update(untracked_users)
+    if client.should_query_keys:
+        resp = await with_ratelimit(client.keys_query)()
+        if isinstance(resp, KeysQueryError):
+            logger.error(f"Failed to query device keys of users {user_ids}: {resp.message}")
+
+    missing_sessions = client.olm.get_missing_sessions(user_ids)
+    if not missing_sessions:
+        return
+    logger.debug(f"Claiming one-time keys for devices {dict(missing_sessions)}")
+    resp = await with_ratelimit(client.keys_claim)(missing_sessions)
+    if isinstance(resp, KeysClaimError):
+        logger.error(f"Failed to claim one-time keys of users {list(missing_sessions.keys())}: {resp.message}")
+
+async def send_shared_history_inbound_sessions(
+        client:AsyncClient, store:Storage, room:MatrixRoom, devices_by_user_iter: Dict[str, Iterator[OlmDevice]],
+        since: Optional[int] = None,
+) -> int:
+    """
+    :param since: Only share sessions first seen in the room at or after this timestamp (ms), all sessions if None
+    :return: the number of room keys sent
+    """
 
-    # Convert Iterator to list
-    devices_by_user = {}
-    for user, device_iter in devices_by_user_iter.items():
-        devices_by_user[user] = list(device_iter)
+    # Get stored InboundGroupSessions - currently storage does not differentiate between shareable and private.
+    group_sessions: List[InboundGroupSession] = [
+        group_session
+        for sessions in client.olm.inbound_group_store._entries[room.room_id].values()
+        for group_session in sessions.values()
+    ]
+
+    # Sessions that predate tracking have no first seen time, so they are only shared without a time window
+    if since is not None:
+        recent_session_ids = store.repositories.roomKeyRep.get_sessions_since(room.room_id, since)
+        group_sessions = [group_session for group_session in group_sessions if group_session.id in recent_session_ids]
+
+    # Queue of forwarded keys per device, skipping keys the device already got
+    pending: Dict[Tuple[str, str], Tuple[OlmDevice, List[InboundGroupSession]]] = {}
+    session_ids = [group_session.id for group_session in group_sessions]
+    for user_id, device_iter in devices_by_user_iter.items():
+        forwarded = store.repositories.roomKeyRep.get_forwarded_keys(session_ids, user_id)
+        for device in device_iter:
+            if client.olm.session_store.get(device.curve25519) is None:
+                logger.error(f"Session for user {user_id} device {device} is not available yet.")
+                continue
+            device_sessions = [
+                group_session for group_session in group_sessions
+                if (group_session.id, device.id) not in forwarded
+            ]
+            if device_sessions:
+                pending[(user_id, device.id)] = (device, device_sessions)
 
     logger.debug(
-        f"Sharing history of room {room.room_id} with users {devices_by_user.keys()}, {shared_history_sessions}")
-
-    for sender_key, group_sessions in shared_history_sessions.items():
-        for group_session in group_sessions.values():
-
-            for user_id, devices in devices_by_user.items():
-                for device in devices:
-                    session = client.olm.session_store.get(device.curve25519)
-                    if session is None:
-                        logger.error(f"Session for user {user_id} device {device} is not available yet.")
-                        continue
-                    client.outgoing_to_device_messages.append(
-                        _encrypt_forwarding_key(client, room.room_id, group_session, session, device)
-                    )
-
-                resp = await client.send_to_device_messages()
+        f"Sharing history of room {room.room_id} with users {list(devices_by_user_iter.keys())}, "
+        f"{len(group_sessions)} sessions, {len(pending)} devices")
+
+    # A to-device request carries one message per device, so every request forwards
+    # the next pending key of each device
+    sent = 0
+    while pending:
+        messages = []
+        batch = []
+        for device_key, (device, device_sessions) in list(pending.items()):
+            group_session = device_sessions.pop(0)
+            session = client.olm.session_store.get(device.curve25519)
+            messages.append(_encrypt_forwarding_key(client, room.room_id, group_session, session, device))
+            batch.append((group_session.id, device.user_id, device.id))
+            if not device_sessions:
+                pending.pop(device_key)
+
+        resp = await _send_to_device_batch(client, messages)
+        if isinstance(resp, ToDeviceError):
+            logger.error(f"Failed to share history of room {room.room_id}: {resp.message}")
+            break
+        store.repositories.roomKeyRep.put_forwarded_keys(batch)
+        sent += len(messages)
+
+    logger.info(f"Shared {sent} room keys of room {room.room_id} with users {list(devices_by_user_iter.keys())}")
+    return sent
+
+async def _send_to_device_batch(
+        client: AsyncClient, messages: List[ToDeviceMessage]
+) -> Union[ToDeviceResponse, ToDeviceError]:
+    """Send to-device messages of the same type in a single request, at most one per device."""
+    content = defaultdict(dict)
+    for message in messages:
+        content[message.recipient][message.recipient_device] = message.content
+
+    method, path, data = Api.to_device(client.access_token, messages[0].type, {"messages": content}, uuid4())
+    # The response is tied to a single message, which is never in the client's outgoing queue
+    return await with_ratelimit(client._send)(ToDeviceResponse, method, path, data, response_data=(messages[0],))
+
 def _encrypt_forwarding_key(
         client: AsyncClient,
         room_id,  # type: str
@@ -0,0 +1,116 @@
+import logging
+from functools import partial
+from typing import Any, Dict, Optional, Union
+
+# noinspection PyPackageRequirements
+from aiohttp import ClientResponse, ClientSession, ClientTimeout, TCPConnector, TraceConfig
+# noinspection PyPackageRequirements
+from nio import AsyncClient
+# noinspection PyPackageRequirements
+from nio.client.async_client import AsyncDataT, connect_wrapper, on_request_chunk_sent
+
+from feedback_bot.tracing import span
+
+logger = logging.getLogger(__name__)
+
+
+class PooledAsyncClient(AsyncClient):
+    """AsyncClient keeping separate HTTP connection pools for the /sync long-poll and outbound requests.
+
+    The long-poll holds a connection open for up to the sync timeout, so sends, room creation,
+    invites and kicks get their own connector and are never queued behind it.
+    """
+
+    def __init__(self, *args, sync_pool: Dict[str, Any] = None, outbound_pool: Dict[str, Any] = None, **kwargs):
+        """
+        Args:
+            sync_pool (dict): Connector settings for the /sync pool, see Config.sync_pool
+
+            outbound_pool (dict): Connector settings for all other requests, see Config.outbound_pool
+        """
+        super().__init__(*args, **kwargs)
+        self.sync_pool = sync_pool or {}
+        self.outbound_pool = outbound_pool or {}
+        self.sync_session: Optional[ClientSession] = None
+        self.outbound_session: Optional[ClientSession] = None
+
+    @staticmethod
+    def _is_sync_request(path: str) -> bool:
+        return path.split("?", 1)[0].endswith("/sync")
+
+    def _create_session(self, pool: Dict[str, Any]) -> ClientSession:
+        trace = TraceConfig()
+        trace.on_request_chunk_sent.append(on_request_chunk_sent)
+
+        connector = TCPConnector(
+            limit=pool.get("limit", 100),
+            limit_per_host=pool.get("limit_per_host", 0),
+            keepalive_timeout=pool.get("keepalive_timeout", 60),
+        )
+        session = ClientSession(
+            timeout=ClientTimeout(
+                total=pool.get("request_timeout", self.config.request_timeout),
+                connect=pool.get("connect_timeout"),
+            ),
+            trace_configs=[trace],
+            connector=connector,
+        )
+        session.connector.connect = partial(connect_wrapper, session.connector)
+        return session
+
+    def _get_session(self, path: str) -> ClientSession:
+        # Sessions are created lazily so they are bound to the running event loop
+        if self._is_sync_request(path):
+            if not self.sync_session:
+                self.sync_session = self._create_session(self.sync_pool)
+            return self.sync_session
+
+        if not self.outbound_session:
+            self.outbound_session = self._create_session(self.outbound_pool)
+        return self.outbound_session
+
+    async def send(
+        self,
+        method: str,
+        path: str,
+        data: Union[None, str, AsyncDataT] = None,
+        headers: Optional[Dict[str, str]] = None,
+        trace_context: Optional[Any] = None,
+        timeout: Optional[float] = None,
+    ) -> ClientResponse:
+        """Send a request to the homeserver through the pool matching the request path."""
+        is_sync = self._is_sync_request(path)
+        session = self._get_session(path)
+        pool = self.sync_pool if is_sync else self.outbound_pool
+
+        if timeout is None:
+            timeout = pool.get("request_timeout", self.config.request_timeout)
+
+        return await session.request(
+            method,
+            self.homeserver + path,
+            data=data,
+            ssl=self.ssl,
+            headers=headers,
+            trace_request_ctx=trace_context,
+            # A timeout of 0 disables the total timeout, e.g. for full state syncs
+            timeout=ClientTimeout(total=timeout or None, connect=pool.get("connect_timeout")),
+        )
+
+    def encrypt(self, room_id: str, message_type: str, content: Dict[Any, Any]):
+        with span("encrypt"):
+            return super().encrypt(room_id, message_type, content)
+
+    async def share_group_session(self, room_id: str, *args, **kwargs):
+        with span("share_group_session"):
+            return await super().share_group_session(room_id, *args, **kwargs)
+
+    async def close(self):
+        """Close both connection pools."""
+        await super().close()
+        if self.sync_session:
+            await self.sync_session.close()
+            self.sync_session = None
+        if self.outbound_session:
+            await self.outbound_session.close()
+            self.outbound_session = None
@@ -1,5 +1,5 @@
 AVAILABLE_COMMANDS = """claim, raise, close, reopen, opentickets, \
-activeticket, addstaff"""
+activeticket, addstaff, prunestore, profile, stats, memory"""
 
 COMMAND_WRITE = """Sends a message to a room using the bot. Usage:
 
@@ -76,3 +76,30 @@ Standalone:
 `!chat <user id>`
 """
 
+
+COMMAND_PRUNE_STORE = """Prunes encryption keys of rooms the bot has left and of Ticket rooms past retention, and compacts a file key store.
+With `dryrun` only reports what would be pruned. Usage:
+
+`!prunestore (dryrun)`
+"""
+
+COMMAND_PROFILE = """Profiles the running bot. `start` starts a low overhead sampling profiler, or cProfile with `start cprofile`.
+`dump` writes the profile so far and `stop` writes it and stops profiling, both post the hottest functions.
+Profiles are written under the store path, sampling profiles as collapsed stacks for flamegraphs and cProfile ones as pstats. Usage:
+
+`!profile start (sampling|cprofile)`
+`!profile dump`
+`!profile stop`
+"""
+
+COMMAND_STATS = """Shows runtime statistics: uptime, events per second, relay latency percentiles, queue depths,
+cache hit rates, database queries per event and rate limit backoff. Usage:
+
+`!stats`
+"""
+
+COMMAND_MEMORY = """Takes a memory snapshot and reports the size of long-lived structures, memory per subsystem
+and its growth since the previous and the first snapshot. Starts allocation tracing if it is not running yet. Usage:
+
+`!memory`
+"""
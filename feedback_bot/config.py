@@ -84,6 +84,19 @@ class Config(object):
             self.database = {"type": "postgres", "connection_string": database_path}
         else:
             raise ConfigError("Invalid connection string for storage.database")
+        # Statements taking longer are logged, with their parameters redacted
+        self.database["slow_query_ms"] = self._get_cfg(["storage", "slow_query_ms"], required=False, default=100)
+
+        # Where encryption keys and sessions are kept
+        self.crypto_store = self._get_cfg(["storage", "crypto_store"], required=False, default="file")
+        if self.crypto_store not in ("file", "database"):
+            raise ConfigError("storage.crypto_store must be one of 'file' or 'database'")
+        self.crypto_maintenance_interval_hours = self._get_cfg(
+            ["storage", "crypto_maintenance", "interval_hours"], required=False, default=0,
+        )
+        self.crypto_maintenance_ticket_retention_days = self._get_cfg(
+            ["storage", "crypto_maintenance", "ticket_retention_days"], required=False, default=None,
+        )
 
         # Matrix bot account setup
         self.user_id = self._get_cfg(["matrix", "user_id"], required=True)
@@ -93,15 +106,83 @@ class Config(object):
 
         self.user_password = self._get_cfg(["matrix", "user_password"], required=False)
         self.user_token = self._get_cfg(["matrix", "user_token"], required=False)
+
+        # Application service mode, events are pushed by the homeserver instead of polling /sync
+        self.appservice_enabled = self._get_cfg(["appservice", "enabled"], required=False, default=False)
+        if self.appservice_enabled:
+            self.appservice_as_token = self._get_cfg(["appservice", "as_token"], required=True)
+            self.appservice_hs_token = self._get_cfg(["appservice", "hs_token"], required=True)
+            self.appservice_listen_host = self._get_cfg(["appservice", "listen_host"], required=False, default="127.0.0.1")
+            self.appservice_listen_port = self._get_cfg(["appservice", "listen_port"], required=False, default=8090)
+            # The application service token is the access token of the bot user
+            self.user_token = self.appservice_as_token
+
         if not self.user_token and not self.user_password:
             raise ConfigError("Must supply either user token or password")
 
+        # Prometheus scrape endpoint
+        self.metrics_enabled = self._get_cfg(["metrics", "enabled"], required=False, default=False)
+        self.metrics_listen_host = self._get_cfg(["metrics", "listen_host"], required=False, default="127.0.0.1")
+        self.metrics_listen_port = self._get_cfg(["metrics", "listen_port"], required=False, default=9090)
+
+        # Event loop lag and blocking call detection
+        self.watchdog_enabled = self._get_cfg(["watchdog", "enabled"], required=False, default=False)
+        self.watchdog_interval_ms = self._get_cfg(["watchdog", "interval_ms"], required=False, default=50)
+        self.watchdog_threshold_ms = self._get_cfg(["watchdog", "threshold_ms"], required=False, default=200)
+
+        # Memory accounting
+        self.memory_tracemalloc = self._get_cfg(["memory", "tracemalloc"], required=False, default=False)
+        self.memory_tracemalloc_frames = self._get_cfg(["memory", "tracemalloc_frames"], required=False, default=1)
+        self.memory_report_interval_hours = self._get_cfg(["memory", "report_interval_hours"], required=False, default=0)
+
+        # Sampled tracing of events through the relay pipeline
+        self.tracing_enabled = self._get_cfg(["tracing", "enabled"], required=False, default=False)
+        self.tracing_sample_rate = float(self._get_cfg(["tracing", "sample_rate"], required=False, default=0.01))
+        if not 0 <= self.tracing_sample_rate <= 1:
+            raise ConfigError("tracing.sample_rate must be between 0 and 1")
+        self.tracing_exporter = self._get_cfg(["tracing", "exporter"], required=False, default="jsonl")
+        if self.tracing_exporter not in ("jsonl", "otlp"):
+            raise ConfigError("tracing.exporter must be one of 'jsonl' or 'otlp'")
+        self.tracing_jsonl_path = self._get_cfg(["tracing", "jsonl", "path"], required=False, default="traces.jsonl")
+        self.tracing_jsonl_max_bytes = self._get_cfg(
+            ["tracing", "jsonl", "max_bytes"], required=False, default=10 * 1024 * 1024,
+        )
+        self.tracing_jsonl_backup_count = self._get_cfg(["tracing", "jsonl", "backup_count"], required=False, default=5)
+        self.tracing_otlp_endpoint = self._get_cfg(
+            ["tracing", "otlp", "endpoint"], required=False, default="http://127.0.0.1:4318/v1/traces",
+        )
+
+        # Journal of the events delivered to the callbacks, for replays
+        self.journal_enabled = self._get_cfg(["journal", "enabled"], required=False, default=False)
+        self.journal_path = self._get_cfg(
+            ["journal", "path"], required=False, default=os.path.join(self.store_path, "journal", "events.jsonl"),
+        )
+        self.journal_max_bytes = self._get_cfg(["journal", "max_bytes"], required=False, default=100 * 1024 * 1024)
+        self.journal_backup_count = self._get_cfg(["journal", "backup_count"], required=False, default=10)
+
         self.device_id = self._get_cfg(["matrix", "device_id"], required=True)
         self.device_name = self._get_cfg(
             ["matrix", "device_name"], default="nio-template"
         )
+
+        # Secondary bot accounts sharing the outbound traffic
+        self.sender_pool = []
+        for account in self._get_cfg(["matrix", "sender_pool"], required=False, default=[]):
+            if not re.match("@.*:.*", account.get("user_id") or ""):
+                raise ConfigError("matrix.sender_pool user_id must be in the form @name:domain")
+            if not account.get("user_token") and not account.get("user_password"):
+                raise ConfigError(f"Must supply either user token or password for {account['user_id']}")
+            if not account.get("device_id"):
+                raise ConfigError(f"Config option device_id is required for {account['user_id']}")
+            account.setdefault("device_name", self.device_name)
+            self.sender_pool.append(account)
+        self.sender_pool_user_ids = [account["user_id"] for account in self.sender_pool]
         self.homeserver_url = self._get_cfg(["matrix", "homeserver_url"], required=True)
 
+        # HTTP connection pools, the /sync long-poll and outbound requests use separate connectors
+        self.sync_pool = self._get_connection_pool_cfg("sync", limit=2, limit_per_host=2)
+        self.outbound_pool = self._get_connection_pool_cfg("outbound", limit=20, limit_per_host=20)
+
         self.command_prefix = self._get_cfg(["command_prefix"], default="!c") + " "
 
         # Matrix logging
@@ -127,6 +208,27 @@ class Config(object):
         self.confirm_reaction_fail = self._get_cfg(["feedback_bot", "confirm_reaction", "fail"], required=False, default="❗")
         self.relay_management_media = self._get_cfg(["feedback_bot", "relay_management_media"], required=False, default=False)
         self.ignore_old_messages = self._get_cfg(["ignore_old_messages"], default=False)
+        self.shared_history_max_age_days = self._get_cfg(
+            ["feedback_bot", "shared_history", "max_age_days"], required=False, default=None,
+        )
+        self.ticket_room_pool_size = self._get_cfg(["feedback_bot", "ticket_room_pool", "size"], required=False, default=0)
+        self.ticket_room_pool_encrypted = self._get_cfg(
+            ["feedback_bot", "ticket_room_pool", "encrypted"], required=False, default=False,
+        )
+
+    def _get_connection_pool_cfg(self, name: str, limit: int, limit_per_host: int) -> dict:
+        path = ["matrix", "connection_pools", name]
+        pool = {
+            "limit": self._get_cfg(path + ["limit"], required=False, default=limit),
+            "limit_per_host": self._get_cfg(path + ["limit_per_host"], required=False, default=limit_per_host),
+            "keepalive_timeout": self._get_cfg(path + ["keepalive_timeout"], required=False, default=60),
+            "connect_timeout": self._get_cfg(path + ["connect_timeout"], required=False, default=10),
+            "request_timeout": self._get_cfg(path + ["request_timeout"], required=False, default=60),
+        }
+        for option, value in pool.items():
+            if not isinstance(value, (int, float)) or value < 0:
+                raise ConfigError(f"matrix.connection_pools.{name}.{option} must be a non-negative number")
+        return pool
 
     def _get_cfg(
         self, path: List[str], default: Any = None, required: bool = True,
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from typing import List, Optional
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient
+# noinspection PyPackageRequirements
+from nio.store.models import MegolmInboundSessions
+from peewee import OperationalError
+
+from feedback_bot.chat_functions import send_text_to_room
+from feedback_bot.config import Config
+from feedback_bot.crypto_store import DatabaseCryptoStore, flush_crypto_store
+from feedback_bot.storage import IN_LIST_BATCH_SIZE, Storage
+
+logger = logging.getLogger(__name__)
+
+
+def vacuum_sqlite(path: str):
+    """Compact a SQLite database file, on its own connection so it can run in a thread."""
+    connection = sqlite3.connect(path, timeout=10)
+    try:
+        connection.execute("VACUUM")
+    finally:
+        connection.close()
+
+
+def format_size(size: Optional[int]) -> str:
+    if size is None:
+        return "unknown"
+    for unit in ("B", "KiB", "MiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}"
+        size /= 1024
+    return f"{size:.1f} GiB"
+
+
+class CryptoStoreMaintenance(object):
+    def __init__(self, client: AsyncClient, store: Storage, config: Config):
+        """Pruning and compaction of the Olm/Megolm store.
+
+        Megolm sessions of rooms the bot has left and of Ticket rooms closed for longer than the
+        retention period are removed. Olm sessions are kept, nio decides which one decrypts a message.
+        Only the file store is compacted, the database store shares the bot database.
+
+        Args:
+            client (nio.AsyncClient): nio client used to interact with matrix
+
+            store (Storage): Bot storage
+
+            config (Config): Bot configuration parameters
+        """
+        self.client = client
+        self.store = store
+        self.config = config
+        self.task: Optional[asyncio.Future] = None
+        self.started = False
+
+    def start(self):
+        """Run the maintenance periodically, reporting to the management room."""
+        self.started = True
+        self.task = asyncio.ensure_future(self._run_forever())
+
+    async def _run_forever(self):
+        while True:
+            await asyncio.sleep(self.config.crypto_maintenance_interval_hours * 60 * 60)
+            try:
+                report = await self.run()
+            except Exception as e:
+                logger.error(f"Crypto store maintenance failed: {e}")
+                continue
+            await send_text_to_room(self.client, self.config.management_room_id, report)
+
+    def _store_size(self) -> Optional[int]:
+        crypto_store = self.client.store
+        if not isinstance(crypto_store, DatabaseCryptoStore):
+            try:
+                return os.path.getsize(crypto_store.database_path)
+            except OSError:
+                return None
+
+        # The crypto tables share the bot database, only their own size is reported
+        tables = [model._meta.table_name for model in crypto_store.models]
+        if crypto_store.database_config["type"] == "postgres":
+            cursor = crypto_store.database.execute_sql(
+                "SELECT sum(pg_total_relation_size(quote_ident(t))) FROM unnest(%s) t", (tables,),
+            )
+        else:
+            # Pages of the tables and their indexes, dbstat is missing from some SQLite builds
+            try:
+                cursor = crypto_store.database.execute_sql(
+                    "SELECT sum(pgsize) FROM dbstat WHERE name IN "
+                    f"(SELECT name FROM sqlite_master WHERE tbl_name IN ({', '.join('?' * len(tables))}))",
+                    tables,
+                )
+            except OperationalError:
+                return None
+        return int(cursor.fetchone()[0] or 0)
+
+    def _rooms_to_prune(self) -> List[str]:
+        megolm_rooms = self.client.olm.inbound_group_store._entries.keys()
+        left_rooms = {room_id for room_id in megolm_rooms if room_id not in self.client.rooms}
+
+        retention_rooms = set()
+        if self.config.crypto_maintenance_ticket_retention_days is not None:
+            closed_before = int(
+                (time.time() - self.config.crypto_maintenance_ticket_retention_days * 24 * 60 * 60) * 1000
+            )
+            retention_rooms = set(
+                self.store.repositories.ticketRep.get_ticket_rooms_closed_before(closed_before)
+            ) & set(megolm_rooms)
+
+        return sorted(left_rooms | retention_rooms)
+
+    async def run(self, dry_run: bool = False) -> str:
+        """Prune stale sessions and compact the store, returning a report."""
+        if not self.client.olm:
+            return "End-to-end encryption is disabled, nothing to prune."
+
+        # Buffered session updates must be in the database before deleting. Nothing awaits until the
+        # delete, so no update of a pruned session can be buffered again and written back after it.
+        flush_crypto_store(self.client)
+        crypto_store = self.client.store
+        size_before = self._store_size()
+
+        megolm_entries = self.client.olm.inbound_group_store._entries
+        megolm_count = sum(len(sessions) for room in megolm_entries.values() for sessions in room.values())
+        prune_rooms = self._rooms_to_prune()
+        megolm_session_ids = [
+            session_id
+            for room_id in prune_rooms
+            for sessions in megolm_entries[room_id].values()
+            for session_id in sessions.keys()
+        ]
+
+        if not dry_run:
+            with crypto_store.database.bind_ctx(crypto_store.models):
+                with crypto_store.database.atomic():
+                    for i in range(0, len(megolm_session_ids), IN_LIST_BATCH_SIZE):
+                        batch = megolm_session_ids[i:i + IN_LIST_BATCH_SIZE]
+                        MegolmInboundSessions.delete().where(MegolmInboundSessions.session_id.in_(batch)).execute()
+
+            for room_id in prune_rooms:
+                megolm_entries.pop(room_id, None)
+            self.store.repositories.roomKeyRep.delete_room_sessions(prune_rooms, megolm_session_ids)
+
+            # Compacting a large file takes seconds, so it runs off the event loop. The database crypto
+            # store is not compacted: it shares the bot database, and Postgres reclaims space through autovacuum
+            if not isinstance(crypto_store, DatabaseCryptoStore):
+                await asyncio.get_running_loop().run_in_executor(None, vacuum_sqlite, crypto_store.database_path)
+
+        size_after = self._store_size()
+        action = "Would prune" if dry_run else "Pruned"
+        report = (
+            f"{action} {len(megolm_session_ids)} of {megolm_count} Megolm sessions in {len(prune_rooms)} rooms. "
+            f"Store size: {format_size(size_before)} before, {format_size(size_after)} after."
+        )
+        logger.info(report)
+        return report
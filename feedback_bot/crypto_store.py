@@ -0,0 +1,120 @@
+import logging
+from typing import Any, Dict, Tuple
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient
+# noinspection PyPackageRequirements
+from nio.crypto import InboundGroupSession, Session
+# noinspection PyPackageRequirements
+from nio.store import SqliteStore
+from peewee import OnConflict, PostgresqlDatabase, SqliteDatabase
+from playhouse.db_url import parse
+
+logger = logging.getLogger(__name__)
+
+# Buffered session updates are written early once this many are pending
+MAX_PENDING_WRITES = 100
+
+# Conflict targets used instead of SQLite's INSERT OR REPLACE, keyed by nio's table names
+REPLACE_CONFLICT_TARGETS = {
+    "olmsessions": ("session_id",),
+    "megolminboundsessions": ("session_id",),
+    "forwardedchains": ("sender_key", "session_id"),
+    "devicekeys": ("account_id", "user_id", "device_id"),
+    "devicetruststate": ("device_id",),
+    "keys": ("device_id", "key_type"),
+    "encryptedrooms": ("room_id", "account_id"),
+    "outgoingkeyrequests": ("request_id", "account_id"),
+    "synctokens": ("account_id",),
+}
+
+
+class UpsertPostgresqlDatabase(PostgresqlDatabase):
+    """Postgres database turning the REPLACE queries of nio's store into upserts."""
+
+    def conflict_update(self, oc: OnConflict, query):
+        action = oc._action.lower() if oc._action else ""
+        if action != "replace":
+            return super().conflict_update(oc, query)
+
+        table_name = query.model._meta.table_name
+        conflict_target = REPLACE_CONFLICT_TARGETS[table_name]
+        preserve = [
+            field.column_name for field in query.model._meta.sorted_fields
+            if field.column_name not in conflict_target and field is not query.model._meta.primary_key
+        ] or list(conflict_target)
+        upsert = OnConflict(action="update", conflict_target=conflict_target, preserve=preserve)
+        return super().conflict_update(upsert, query)
+
+
+class DatabaseCryptoStore(SqliteStore):
+    """nio crypto store kept in the bot database instead of a file under storage.store_path.
+
+    Olm and Megolm session updates are buffered in memory and written together in one transaction
+    after each sync, so bursts of to-device traffic don't cause a write per message. Any node
+    connected to the same database can take over with the keys and sessions of the bot.
+    """
+
+    # Set from Config.database before the client loads its store
+    database_config: Dict[str, Any] = {}
+
+    def __post_init__(self):
+        # curve key, session id -> Olm session
+        self.pending_sessions: Dict[Tuple[str, str], Session] = {}
+        # session id -> Megolm session
+        self.pending_group_sessions: Dict[str, InboundGroupSession] = {}
+        super().__post_init__()
+
+    def _create_database(self):
+        if self.database_config["type"] == "postgres":
+            return UpsertPostgresqlDatabase(**parse(self.database_config["connection_string"]))
+
+        return SqliteDatabase(
+            self.database_config["connection_string"],
+            pragmas={
+                "foreign_keys": 1,
+                "secure_delete": 1,
+            },
+            timeout=10,
+        )
+
+    def save_session(self, curve_key, session):
+        self.pending_sessions[(curve_key, session.id)] = session
+        self._flush_if_full()
+
+    def save_inbound_group_session(self, session):
+        self.pending_group_sessions[session.id] = session
+        self._flush_if_full()
+
+    def load_sessions(self):
+        self.flush()
+        return super().load_sessions()
+
+    def load_inbound_group_sessions(self):
+        self.flush()
+        return super().load_inbound_group_sessions()
+
+    def _flush_if_full(self):
+        if len(self.pending_sessions) + len(self.pending_group_sessions) >= MAX_PENDING_WRITES:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered session updates in a single transaction."""
+        if not self.pending_sessions and not self.pending_group_sessions:
+            return
+
+        sessions, self.pending_sessions = self.pending_sessions, {}
+        group_sessions, self.pending_group_sessions = self.pending_group_sessions, {}
+        with self.database.atomic():
+            for (curve_key, _), session in sessions.items():
+                super().save_session(curve_key, session)
+            for group_session in group_sessions.values():
+                super().save_inbound_group_session(group_session)
+
+        logger.debug(f"Saved {len(sessions)} Olm and {len(group_sessions)} Megolm sessions")
+
+
+def flush_crypto_store(client: AsyncClient):
+    """Write buffered crypto store updates, if the client uses the database crypto store."""
+    if isinstance(client.store, DatabaseCryptoStore):
+        client.store.flush()
@@ -0,0 +1,163 @@
+import logging
+import time
+from collections import Counter
+from typing import Dict, Iterator, Tuple
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient, Event, LocalProtocolError, MegolmEvent, RoomKeyEvent, RoomKeyRequestError
+
+from feedback_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Undecryptable events are dropped if their keys don't arrive within this time
+BACKLOG_MAX_AGE_S = 24 * 60 * 60
+EXPIRY_INTERVAL_S = 60
+
+
+class EncryptedEventBacklog(object):
+    def __init__(self, client: AsyncClient, store: Storage):
+        """Events waiting for their room keys, stored in the encrypted_events table.
+
+        Counters per user and per session are kept in memory, so only room keys of sessions
+        with waiting events touch the database. Key requests are sent once per session.
+
+        Args:
+            client (nio.AsyncClient): nio client used to interact with matrix
+
+            store (Storage): Bot storage
+        """
+        self.client = client
+        self.store = store
+        # session_id -> waiting events per user
+        self.session_users: Dict[str, Counter] = {}
+        # session_id -> time the first event of the session was stored
+        self.session_first_seen: Dict[str, float] = {}
+        self.user_counts: Counter = Counter()
+        self.requested_sessions = set()
+        self.last_expiry = time.monotonic()
+
+    def load(self):
+        """Rebuild the counters from the database."""
+        self.session_users = {}
+        self.session_first_seen = {}
+        self.user_counts = Counter()
+        now = time.monotonic()
+        for user_id, session_id, count in self.store.get_encrypted_event_counts():
+            self.session_users.setdefault(session_id, Counter())[user_id] += count
+            self.session_first_seen.setdefault(session_id, now)
+            self.user_counts[user_id] += count
+
+        logger.info(f"Loaded {sum(self.user_counts.values())} events waiting for room keys")
+
+    def waiting_for_user(self, user_id: str) -> int:
+        return self.user_counts.get(user_id, 0)
+
+    def waiting_for_session(self, session_id: str) -> int:
+        return sum(self.session_users.get(session_id, Counter()).values())
+
+    async def add(self, event: MegolmEvent):
+        """Store an undecryptable event and request its room key, once per session."""
+        self.expire()
+
+        if not self.store.store_encrypted_event(event):
+            return
+        self.session_users.setdefault(event.session_id, Counter())[event.sender] += 1
+        self.session_first_seen.setdefault(event.session_id, time.monotonic())
+        self.user_counts[event.sender] += 1
+
+        logger.info("Waiting to decrypt %s events", self.user_counts[event.sender])
+
+        if event.session_id in self.requested_sessions:
+            return
+        self.requested_sessions.add(event.session_id)
+
+        response = None
+        try:
+            response = await self.client.request_room_key(event)
+        except LocalProtocolError as ex:
+            if str(ex) != "A key sharing request is already sent out for this session id.":
+                logger.warning(f"Failed to request room key for event {event.event_id}: {ex}")
+        if isinstance(response, RoomKeyRequestError):
+            logger.warning("RoomKeyRequestError: %s (%s)", response.message, response.status_code)
+            # Allow a new request with the next event of the session
+            self.requested_sessions.discard(event.session_id)
+
+    def _forget_session(self, session_id: str):
+        for user_id, count in self.session_users.pop(session_id, Counter()).items():
+            self.user_counts[user_id] -= count
+            if self.user_counts[user_id] <= 0:
+                del self.user_counts[user_id]
+        self.session_first_seen.pop(session_id, None)
+        self.requested_sessions.discard(session_id)
+
+    def expire(self):
+        """Drop sessions whose keys didn't arrive in time."""
+        now = time.monotonic()
+        if now - self.last_expiry < EXPIRY_INTERVAL_S:
+            return
+        self.last_expiry = now
+
+        expired = [
+            session_id for session_id, first_seen in self.session_first_seen.items()
+            if now - first_seen > BACKLOG_MAX_AGE_S
+        ]
+        for session_id in expired:
+            self.store.remove_encrypted_events_of_session(session_id)
+            self._forget_session(session_id)
+        if expired:
+            logger.info(f"Expired waiting events of {len(expired)} sessions")
+
+    def _decrypt_stored_events(self, session_id: str) -> Iterator[Tuple[MegolmEvent, Event]]:
+        for megolm_event in self.store.iter_encrypted_events(session_id):
+            try:
+                # noinspection PyTypeChecker
+                decrypted = self.client.decrypt_event(megolm_event)
+            except Exception as ex:
+                logger.warning("Error decrypting event %s: %s", megolm_event.event_id, ex)
+                continue
+            if isinstance(decrypted, Event):
+                yield megolm_event, decrypted
+            else:
+                logger.warning("Failed to decrypt event %s", megolm_event.event_id)
+
+    async def on_room_key(self, event: RoomKeyEvent):
+        """Decrypt the events waiting for a room key and replay them in the order they were sent."""
+        self.expire()
+
+        waiting = self.waiting_for_session(event.session_id)
+        log_func = logger.info if waiting else logger.debug
+        log_func("Got room key event for session %s, matched events: %s", event.session_id, waiting)
+        if not waiting:
+            return
+
+        # Events are streamed in server timestamp order
+        replayed_event_ids = []
+        for megolm_event, decrypted in self._decrypt_stored_events(event.session_id):
+            logger.info("Successfully decrypted stored event %s", decrypted.event_id)
+            replayed_event_ids.append(decrypted.event_id)
+            self._count_removed(megolm_event)
+
+            room = self.client.rooms.get(megolm_event.room_id)
+            if not room:
+                logger.warning(f"Not replaying event {decrypted.event_id} of unknown room {megolm_event.room_id}")
+                continue
+            # Same handling as events decrypted during sync
+            for callback in self.client.event_callbacks:
+                try:
+                    await callback.execute(decrypted, room)
+                except Exception as ex:
+                    logger.error(f"Error replaying decrypted event {decrypted.event_id}: {ex}")
+
+        self.store.remove_encrypted_events(replayed_event_ids)
+        if not self.waiting_for_session(event.session_id):
+            self._forget_session(event.session_id)
+
+    def _count_removed(self, megolm_event: MegolmEvent):
+        users = self.session_users.get(megolm_event.session_id)
+        if not users or not users[megolm_event.sender]:
+            return
+        users[megolm_event.sender] -= 1
+        self.user_counts[megolm_event.sender] -= 1
+        if self.user_counts[megolm_event.sender] <= 0:
+            del self.user_counts[megolm_event.sender]
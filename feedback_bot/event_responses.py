@@ -1,6 +1,6 @@
 import logging
 import re
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
 
 # noinspection PyPackageRequirements
 from nio import RoomSendResponse, RoomSendError, AsyncClient, RoomMessage, RoomGetEventResponse
@@ -12,10 +12,13 @@ from feedback_bot.chat_functions import send_reaction, send_text_to_room
 from feedback_bot.config import Config
 from feedback_bot.handlers.EventStateHandler import EventStateHandler, LogLevel, RoomType
 from feedback_bot.handlers.MessagingHandler import MessagingHandler
+from feedback_bot.metrics import query_path
 from feedback_bot.models.EventPairs import EventPair, SingleEvent
 from feedback_bot.models.IncomingEvent import IncomingEvent
+from feedback_bot.models.User import User
 from feedback_bot.storage import Storage
-from feedback_bot.utils import _get_reply_msg, get_in_reply_to, get_mentions, get_replaces, get_reply_msg, get_raise_msg
+from feedback_bot.tracing import traced
+from feedback_bot.utils import MessageContent, message_content
 
 logger = logging.getLogger(__name__)
 
@@ -40,7 +43,9 @@ class Message(object):
         self.config: Config = config
         self.room:MatrixRoom  = room
         self.event: RoomMessage = event
-        
+        # Parsed once, shared with the handlers and commands of the event
+        self.content: MessageContent = message_content(event)
+
         self.handler = EventStateHandler(client, store, config, room, event)
         self.messageHandler = MessagingHandler(self.handler)
         
@@ -50,6 +55,7 @@ class Message(object):
     async def handle_management_room_message(self):
         raise NotImplementedError
 
+    @traced("Message.process")
     async def process(self):
         """
         Process messages.
@@ -69,10 +75,13 @@ class Message(object):
 
         # Handle different scenarios
         if self.handler.room_type == RoomType.ManagementRoom:
+            query_path(f"{type(self).__name__}.management_room")
             await self.handle_management_room_message()
         elif self.handler.room_type == RoomType.TicketRoom:
+            query_path(f"{type(self).__name__}.ticket_room")
             await self.handle_ticket_room_message()
         elif self.handler.room_type == RoomType.ChatRoom:
+            query_path(f"{type(self).__name__}.chat_room")
             await self.handle_chat_room_message()
         else:
             # Default - message from user
@@ -85,43 +94,63 @@ class Message(object):
     def anonymise_text(self, anonymise: bool) -> str:
         raise NotImplementedError
 
+    def sender_user(self) -> User:
+        """The sender as a User, reusing the one already found while relaying, created if new."""
+        user = self.handler.user
+        if user is not None and user.user_id == self.event.sender:
+            return user
+        user = User.get_existing(self.store, self.event.sender)
+        if user is None:
+            user = User.create_new(self.store, self.event.sender)
+        return user
+
     async def get_related(self, related_event_id: str) -> Union[str, None]:
+        related_event = await self.get_related_event(related_event_id)
+        if related_event:
+            return related_event.event_id
+
+    @traced("Message.get_related")
+    async def get_related_event(self, related_event_id: str) -> Optional[SingleEvent]:
+        """The event paired with a related event of this room, with the account that sent it if it is the bot's."""
         resp = await self.client.room_get_event(self.room.room_id, related_event_id)
         if isinstance(resp, RoomGetEventResponse):
-            related_event_is_clone = resp.event.sender == self.client.user_id
+            related_event_is_clone = resp.event.sender == self.client.user_id or \
+                                     resp.event.sender in self.config.sender_pool_user_ids
         else:
             return None
         
         if related_event_is_clone:
             event_pair =  EventPair.get_clone_event_pair(self.store, self.room.room_id, related_event_id)
             if event_pair:
-                return event_pair.event_id
+                return event_pair.get_single_event()
         else:
             event_pair =  EventPair.get_event_pair(self.store, self.room.room_id, related_event_id)
             if event_pair:
-                return event_pair.clone_event_id
+                return event_pair.get_single_clone_event()
 
-    async def put_related_clone_event(self, clone_room_id: str, clone_event_id: str):
-        event_pair = EventPair(self.store, self.room.room_id, self.event.event_id, clone_room_id, clone_event_id)
+    async def put_related_clone_event(self, clone_room_id: str, clone_event_id: str, clone_sender_id: str = None):
+        event_pair = EventPair(
+            self.store, self.room.room_id, self.event.event_id, clone_room_id, clone_event_id, clone_sender_id,
+        )
         event_pair.store_event_pair()
         
     async def transform_reply(self, text:str, room_id:str) -> Tuple[str, str]:
-        reply_to_event_id = get_in_reply_to(self.event)
+        reply_to_event_id = self.content.in_reply_to
         if reply_to_event_id:
             reply_to_event_id = await self.get_related(reply_to_event_id)
             if reply_to_event_id:
-                text = _get_reply_msg(self.event)
+                text = self.content.reply_msg
                 
         return [reply_to_event_id, text]
     
-    async def transform_replaces(self, text:str, room_id:str) -> Tuple[str, str]:
-        replaces_event_id = get_replaces(self.event)
-        if replaces_event_id:
-            replaces_event_id = await self.get_related(replaces_event_id)
-            if replaces_event_id:
-                text = _get_reply_msg(self.event)
+    async def transform_replaces(self, text:str, room_id:str) -> Tuple[Optional[SingleEvent], str]:
+        replaces_event = None
+        if self.content.replaces:
+            replaces_event = await self.get_related_event(self.content.replaces)
+            if replaces_event:
+                text = self.content.reply_msg
                 
-        return (replaces_event_id, text)
+        return (replaces_event, text)
         
     async def send_message_to_room(self, text, room):
         raise NotImplementedError
@@ -157,10 +186,13 @@ class Message(object):
 
         # Handle different relaying scenarios
         if self.handler.ticket:
+            query_path(f"{type(self).__name__}.user_relay_to_ticket_room")
             text = self.anonymise_text(True)
         elif self.handler.user.current_chat_room_id:
+            query_path(f"{type(self).__name__}.user_relay_to_chat_room")
             text = self.anonymise_text(True)
         else:
+            query_path(f"{type(self).__name__}.user_relay_to_management_room")
             # Save the message event id into storage, to be sent to a ticket room later
             self.save_incoming_event()
             text = self.anonymise_text(self.config.anonymise_senders)
@@ -6,18 +6,13 @@ from nio import AsyncClient, MatrixRoom, RoomMessage
 
 from feedback_bot.chat_functions import send_text_to_room
 from feedback_bot.config import Config
-from feedback_bot.models.Chat import chat_room_name_pattern, Chat
+from feedback_bot.models.Chat import Chat
+from feedback_bot.models.RoomClassifier import RoomClassifier, RoomType
 from feedback_bot.models.Staff import Staff
-from feedback_bot.models.Ticket import ticket_name_pattern, Ticket
+from feedback_bot.models.Ticket import Ticket
 from feedback_bot.models.User import User
 from feedback_bot.storage import Storage
-
-class RoomType(Enum):
-    ManagementRoom  = 0
-    LoggingRoom     = 1
-    UserRoom        = 2
-    TicketRoom      = 3
-    ChatRoom        = 4
+from feedback_bot.tracing import traced
 
 class LogLevel(Enum):
     INFO            = 0
@@ -107,6 +102,7 @@ class EventStateHandler(object):
     def update_state_chat(self, chat_room_id:str):
         self.chat = Chat.get_existing(self.store, chat_room_id)
 
+    @traced("EventStateHandler.find_room_state")
     async def find_room_state(self) -> bool:
 
         if self.room_type == RoomType.TicketRoom:
@@ -144,21 +140,16 @@ class EventStateHandler(object):
         return False
 
 
-    # Room type determined by the room name in most cases
+    # Room type determined by the cached Ticket and Chat room classification
+    @traced("EventStateHandler.determine_room_type")
     def determine_room_type(self, room: MatrixRoom) -> RoomType:
 
         if room.room_id == self.config.management_room_id:
             self.room_type = RoomType.ManagementRoom
         elif room.room_id == self.config.matrix_logging_room:
             self.room_type = RoomType.LoggingRoom
-        elif room.name is None:
-            self.room_type = RoomType.UserRoom
-        elif chat_room_name_pattern.match(room.name):
-            self.room_type = RoomType.ChatRoom
-        elif ticket_name_pattern.match(room.name):
-            self.room_type = RoomType.TicketRoom
         else:
-            self.room_type = RoomType.UserRoom
+            self.room_type = RoomClassifier.get_room_type(self.store, room)
 
         return self.room_type
 
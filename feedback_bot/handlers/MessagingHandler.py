@@ -3,6 +3,7 @@ import logging
 from nio import RoomCreateResponse, RoomCreateError
 
 from feedback_bot.models.Repositories.TicketRepository import TicketStatus
+from feedback_bot.tracing import traced
 from feedback_bot.utils import get_username
 
 logger = logging.getLogger(__name__)
@@ -108,6 +109,7 @@ class MessagingHandler(object):
             return await self.setup_communications_room()
         return True
 
+    @traced("MessagingHandler.setup_relay")
     async def setup_relay(self) -> str:
         # Find user from event
         if not self.handler.find_state_user():
@@ -126,7 +128,7 @@ class MessagingHandler(object):
             self.handler.update_state_chat(self.handler.user.current_chat_room_id)
             return self.handler.chat.chat_room_id
         else:
-            return self.config.management_room
+            return self.config.management_room_id
 
     async def find_communications_room(self, user_id) -> bool :
         if not self.handler.user.room_id:
@@ -0,0 +1,156 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+from typing import Any, Dict, Iterator, List, Optional, Union
+
+# noinspection PyPackageRequirements
+from nio import Event, InviteEvent, MatrixInvitedRoom, MatrixRoom
+
+from feedback_bot.config import Config
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_VERSION = 1
+# Journal files hold decrypted messages, only the bot's user may read them
+FILE_MODE = 0o600
+
+
+def room_context(room: MatrixRoom) -> Dict[str, Any]:
+    """The state of a room the handlers read, besides what is in the database."""
+    return {
+        "type": "room",
+        "room_id": room.room_id,
+        "invited_room": isinstance(room, MatrixInvitedRoom),
+        "name": room.name,
+        "canonical_alias": room.canonical_alias,
+        "creator": room.creator,
+        "encrypted": room.encrypted,
+        "members": list(room.users),
+        "invited": list(room.invited_users),
+    }
+
+
+def _open_private(path: str, flags: int):
+    """File descriptor of a journal file, created readable by the bot's user only."""
+    return os.open(path, flags | os.O_CREAT, FILE_MODE)
+
+
+def journal_files(path: str) -> List[str]:
+    """Files of a journal, oldest first: the compressed backups, then the current file."""
+    if path.endswith(".gz") or not os.path.exists(f"{path}.1.gz"):
+        return [path]
+    backups = []
+    index = 1
+    while os.path.exists(f"{path}.{index}.gz"):
+        backups.insert(0, f"{path}.{index}.gz")
+        index += 1
+    return backups + ([path] if os.path.exists(path) else [])
+
+
+def read_journal(path: str) -> Iterator[Dict[str, Any]]:
+    """Records of a journal in the order they were written."""
+    for filename in journal_files(path):
+        opener = gzip.open if filename.endswith(".gz") else open
+        with opener(filename, "rt", encoding="utf-8") as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    # The last line is cut short if the bot stopped while writing it
+                    logger.warning(f"Skipping unreadable line {line_number} of {filename}")
+
+
+class EventJournal(object):
+    def __init__(self, config: Config):
+        """Append-only journal of every event delivered to the Callbacks, with its room context.
+
+        One compact JSON object per line. The context of a room is written before its event
+        whenever it changed, and again at the start of every file, so each file replays on its own.
+        The file is rotated at max_bytes, rotated files are gzip compressed in a thread.
+
+        Args:
+            config (Config): Bot configuration parameters
+        """
+        self.path = config.journal_path
+        self.max_bytes = config.journal_max_bytes
+        self.backup_count = config.journal_backup_count
+        self.user_id = config.user_id
+        self.room_contexts: Dict[str, Dict[str, Any]] = {}
+        self.rotation_lock = threading.Lock()
+        self.file = None
+        self.size = 0
+        self._open()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.file = open(_open_private(self.path, os.O_WRONLY | os.O_APPEND), "a", encoding="utf-8")
+        self.size = self.file.tell()
+        self.room_contexts = {}
+        self._write({"type": "journal", "version": JOURNAL_VERSION, "user_id": self.user_id})
+
+    def _write(self, record: Dict[str, Any]):
+        line = json.dumps(record, separators=(",", ":"), default=str) + "\n"
+        self.file.write(line)
+        self.size += len(line)
+
+    def _rotate(self):
+        self.file.close()
+        rotated = f"{self.path}.{time.time_ns()}"
+        os.rename(self.path, rotated)
+        self._open()
+        try:
+            asyncio.get_running_loop().run_in_executor(None, self._compress, rotated)
+        except RuntimeError:
+            self._compress(rotated)
+
+    def _compress(self, rotated: str):
+        with self.rotation_lock:
+            for index in range(self.backup_count, 0, -1):
+                backup = f"{self.path}.{index}.gz"
+                if not os.path.exists(backup):
+                    continue
+                if index == self.backup_count:
+                    os.remove(backup)
+                else:
+                    os.rename(backup, f"{self.path}.{index + 1}.gz")
+            backup_fd = _open_private(f"{self.path}.1.gz", os.O_WRONLY | os.O_TRUNC)
+            with open(rotated, "rb") as source, open(backup_fd, "wb") as backup_file, \
+                    gzip.GzipFile(fileobj=backup_file, mode="wb") as target:
+                shutil.copyfileobj(source, target)
+            os.remove(rotated)
+
+    async def record(self, room: MatrixRoom, event: Union[Event, InviteEvent]):
+        """Callback for every room and invite event, registered before the handlers."""
+        source = getattr(event, "source", None)
+        if not source:
+            return
+        # A room's context and its event go to the same file
+        if self.max_bytes and self.size >= self.max_bytes and self.backup_count:
+            self._rotate()
+
+        context = room_context(room)
+        if self.room_contexts.get(room.room_id) != context:
+            self.room_contexts[room.room_id] = context
+            self._write(context)
+        self._write({
+            "type": "invite" if isinstance(event, InviteEvent) else "event",
+            "room_id": room.room_id,
+            "received": int(time.time() * 1000),
+            "event": source,
+        })
+
+    async def flush(self, response: Optional[Any] = None):
+        """Callback for when a sync response has been handled, writing out its events at once."""
+        self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+            self.file = None
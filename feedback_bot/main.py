@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 import logging
+import tracemalloc
 from time import sleep
+from typing import Optional
 
 # noinspection PyPackageRequirements
 from aiohttp import ClientConnectionError, ServerDisconnectedError
@@ -8,7 +10,9 @@ from aiohttp import ClientConnectionError, ServerDisconnectedError
 from nio import (
     AsyncClient,
     AsyncClientConfig,
+    Event,
     ForwardedRoomKeyEvent,
+    InviteEvent,
     InviteMemberEvent,
     JoinError,
     LocalProtocolError,
@@ -23,29 +27,85 @@ from nio import (
     RoomMessageMedia,
     RoomResolveAliasResponse, RoomKeyRequest,
     RedactionEvent,
+    RoomNameEvent,
+    SyncResponse,
     CallInviteEvent,
     CallCandidatesEvent,
     CallHangupEvent,
     CallAnswerEvent
 )
 
+from feedback_bot.appservice import AppService
 from feedback_bot.callbacks import Callbacks
+from feedback_bot.client import PooledAsyncClient
 from feedback_bot.config import Config
+from feedback_bot.crypto_maintenance import CryptoStoreMaintenance
+from feedback_bot.crypto_store import DatabaseCryptoStore, flush_crypto_store
+from feedback_bot.journal import EventJournal
+from feedback_bot.memory import MemoryMonitor
+from feedback_bot.metrics import MetricsServer, ROOMS_PENDING
 from feedback_bot.models.Repositories.Repositories import Repositories
+from feedback_bot.models.RoomClassifier import RoomClassifier
+from feedback_bot.profiler import Profiler
+from feedback_bot.sender_pool import SenderPool
 from feedback_bot.storage import Storage
+from feedback_bot.ticket_room_pool import TicketRoomPool
+from feedback_bot.tracing import configure_tracing
+from feedback_bot.watchdog import LoopWatchdog
 from feedback_bot.utils import sleep_ms
 
 logger = logging.getLogger(__name__)
 
 
+def register_callbacks(client: AsyncClient, callbacks: Callbacks, journal: Optional[EventJournal] = None):
+    """Route the events of a sync to the Callbacks handling them."""
+    if journal:
+        # Registered first, so events are journaled before handling them
+        # noinspection PyTypeChecker
+        client.add_event_callback(journal.record, (Event, InviteEvent))
+        # noinspection PyTypeChecker
+        client.add_response_callback(journal.flush, (SyncResponse,))
+    # noinspection PyTypeChecker
+    client.add_event_callback(callbacks.member, (RoomMemberEvent,))
+    # noinspection PyTypeChecker
+    client.add_event_callback(callbacks.message, (RoomMessageText, RoomMessageNotice, RoomMessageFormatted))
+    # noinspection PyTypeChecker
+    client.add_event_callback(callbacks.media, (RoomMessageMedia, RoomEncryptedMedia))
+    # noinspection PyTypeChecker
+    #client.add_event_callback(callbacks.call_event, (CallInviteEvent, CallCandidatesEvent, CallHangupEvent, CallAnswerEvent,))
+    # noinspection PyTypeChecker
+    client.add_event_callback(callbacks.redact, (RedactionEvent,))
+    # noinspection PyTypeChecker
+    client.add_event_callback(callbacks.room_name, (RoomNameEvent,))
+    # noinspection PyTypeChecker
+    client.add_event_callback(callbacks.invite, (InviteMemberEvent,))
+    # noinspection PyTypeChecker
+    client.add_event_callback(callbacks.decryption_failure, (MegolmEvent,))
+    # noinspection PyTypeChecker
+    client.add_event_callback(callbacks.megolm_session, (Event,))
+    # noinspection PyTypeChecker
+    client.add_to_device_callback(callbacks.room_key, (ForwardedRoomKeyEvent, RoomKeyEvent))
+    # noinspection PyTypeChecker
+    client.add_to_device_callback(callbacks.room_key_request, (RoomKeyRequest,))
+    # noinspection PyTypeChecker
+    client.add_response_callback(callbacks.sync, (SyncResponse,))
+
+
 async def main(config: Config):
+    if config.memory_tracemalloc:
+        tracemalloc.start(config.memory_tracemalloc_frames)
+    configure_tracing(config)
+
     # Configure the database
     store = Storage(config.database)
 
     # Initialise global model repositories:
     repositories = Repositories(store)
     store.set_repositories(repositories)
-    
+
+    # Classify known Ticket and Chat rooms
+    RoomClassifier.load(store)
+
     # Configuration options for the AsyncClient
     client_config = AsyncClientConfig(
         max_limit_exceeded=0,
@@ -53,14 +113,19 @@ async def main(config: Config):
         store_sync_tokens=True,
         encryption_enabled=True,
     )
+    if config.crypto_store == "database":
+        DatabaseCryptoStore.database_config = config.database
+        client_config.store = DatabaseCryptoStore
 
     # Initialize the matrix client
-    client = AsyncClient(
+    client = PooledAsyncClient(
         config.homeserver_url,
         config.user_id,
         device_id=config.device_id,
         store_path=config.store_path,
         config=client_config,
+        sync_pool=config.sync_pool,
+        outbound_pool=config.outbound_pool,
     )
 
     if config.user_token:
@@ -69,26 +134,36 @@ async def main(config: Config):
 
     # Set up event callbacks
     callbacks = Callbacks(client, store, config)
-    # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.member, (RoomMemberEvent,))
-    # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.message, (RoomMessageText, RoomMessageNotice, RoomMessageFormatted))
-    # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.media, (RoomMessageMedia, RoomEncryptedMedia))
-    # noinspection PyTypeChecker
-    #client.add_event_callback(callbacks.call_event, (CallInviteEvent, CallCandidatesEvent, CallHangupEvent, CallAnswerEvent,))
-    # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.redact, (RedactionEvent,))
-    # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.invite, (InviteMemberEvent,))
-    # noinspection PyTypeChecker
-    client.add_event_callback(callbacks.decryption_failure, (MegolmEvent,))
-    # noinspection PyTypeChecker
-    client.add_to_device_callback(callbacks.room_key, (ForwardedRoomKeyEvent, RoomKeyEvent))
-    # noinspection PyTypeChecker
-    client.add_to_device_callback(callbacks.room_key_request, (RoomKeyRequest,))
+    callbacks.encrypted_backlog.load()
+    journal = EventJournal(config) if config.journal_enabled else None
+    register_callbacks(client, callbacks, journal)
 
     client.callbacks = callbacks
+    client.journal = journal
+    ROOMS_PENDING.set_function(lambda: sum(len(tasks) for tasks in callbacks.rooms_pending.values()))
+
+    client.watchdog = None
+    if config.watchdog_enabled:
+        client.watchdog = LoopWatchdog(config)
+        client.watchdog.start()
+
+    if config.metrics_enabled:
+        await MetricsServer(config.metrics_listen_host, config.metrics_listen_port).start()
+
+    # Profiler controlled with the profile command
+    client.profiler = Profiler(config)
+    client.memory_monitor = MemoryMonitor(client, config)
+
+    # Secondary accounts for outbound traffic
+    client.sender_pool = SenderPool(client, store, config, client_config)
+
+    # Scheduled crypto store pruning
+    if config.crypto_maintenance_interval_hours:
+        client.crypto_maintenance = CryptoStoreMaintenance(client, store, config)
+
+    # Spare Ticket rooms
+    if config.ticket_room_pool_size:
+        client.ticket_room_pool = TicketRoomPool(client, store, config)
     
     # Keep trying to reconnect on failure (with some time in-between)
     while True:
@@ -159,7 +234,22 @@ async def main(config: Config):
                     logger.info(f"Logging room membership is good")
 
             logger.info(f"Logged in as {config.user_id}")
-            await client.sync_forever(timeout=30000, full_state=True)
+
+            if not client.sender_pool.started:
+                await client.sender_pool.start()
+            if config.ticket_room_pool_size and not client.ticket_room_pool.started:
+                client.ticket_room_pool.start()
+            if config.crypto_maintenance_interval_hours and not client.crypto_maintenance.started:
+                client.crypto_maintenance.start()
+            if config.memory_report_interval_hours and not client.memory_monitor.started:
+                client.memory_monitor.start()
+
+            if config.appservice_enabled:
+                # Fetch the current state of joined rooms once, then receive pushed transactions
+                await client.sync(timeout=0, full_state=True)
+                await AppService(client, config).run()
+            else:
+                await client.sync_forever(timeout=30000, full_state=True)
 
         except (ClientConnectionError, ServerDisconnectedError):
             logger.warning("Unable to connect to homeserver, retrying in 15s...")
@@ -168,4 +258,7 @@ async def main(config: Config):
             sleep(15)
         finally:
             # Make sure to close the client connection on disconnect
+            flush_crypto_store(client)
+            if journal:
+                await journal.flush()
             await client.close()
@@ -4,16 +4,17 @@ from typing import List
 # noinspection PyPackageRequirements
 from nio import RoomSendResponse, RoomSendError
 
-from feedback_bot.chat_functions import send_media_to_room, send_reaction, send_text_to_room, find_private_msg
+from feedback_bot.chat_functions import (
+    find_private_msg, get_sender, send_media_to_room, send_reaction, send_text_to_room,
+)
 from feedback_bot.event_responses import Message
 from feedback_bot.handlers.EventStateHandler import EventStateHandler, RoomType, LogLevel
 from feedback_bot.handlers.MessagingHandler import MessagingHandler
+from feedback_bot.metrics import observe_relay
 from feedback_bot.models.Chat import Chat
 from feedback_bot.models.IncomingEvent import IncomingEvent
 from feedback_bot.models.Repositories.TicketRepository import TicketStatus
 from feedback_bot.models.Ticket import Ticket
-from feedback_bot.models.User import User
-from feedback_bot.utils import get_in_reply_to
 
 logger = logging.getLogger(__name__)
 
@@ -59,7 +60,7 @@ class Media(Message):
         self.media_info = media_info
 
     async def handle_management_room_media(self):
-        reply_to = get_in_reply_to(self.event)
+        reply_to = self.content.in_reply_to
 
         if reply_to and self.config.relay_management_media:
             # Send back to original sender
@@ -75,6 +76,7 @@ class Media(Message):
                     self.media_file,
                     self.media_info
                 )
+                observe_relay(response)
                 if isinstance(response, RoomSendResponse):
                     # Store our outbound reply so we can reference it later
                     self.store.store_message(
@@ -128,15 +130,10 @@ class Media(Message):
             f"alias: {self.room.canonical_alias}): {self.body}"
             
     def anonymise_text(self, anonymise: bool) -> str:
-        user = User.get_existing(self.store, self.event.sender)
-        
-        if user is None:
-            user = User.create(self.store, self.event.sender)
-            
         if anonymise:
             text = None
         else:
-            text = f"{user.anon_id} (`{self.room.room_id}`) " \
+            text = f"{self.sender_user().anon_id} (`{self.room.room_id}`) " \
                    f"sent {media_name[self.media_type]} {self.body}:"
         return text
 
@@ -151,9 +148,10 @@ class Media(Message):
             return
         
         
+        sender = get_sender(self.client, room_id)
         sender_notify_event_id = None
         if text:
-            response = await send_text_to_room(self.client, room_id, text, notice=True)
+            response = await send_text_to_room(self.client, room_id, text, notice=True, sender=sender)
             sender_notify_event_id = response.event_id
             if type(response) != RoomSendResponse or not response.event_id:
                 logger.error(f"Failed to relay {media_name[self.media_type]} {self.event.event_id} to"
@@ -167,12 +165,14 @@ class Media(Message):
             self.body,
             self.media_url,
             self.media_file,
-            self.media_info
+            self.media_info,
+            sender=sender,
         )
+        observe_relay(response)
 
         if type(response) == RoomSendResponse and response.event_id:
             try:
-                await self.put_related_clone_event(room_id, response.event_id)
+                await self.put_related_clone_event(room_id, response.event_id, sender.user_id)
                 self.store.store_message(
                     self.event.event_id,
                     response.event_id,
@@ -0,0 +1,189 @@
+import asyncio
+import logging
+import os
+import resource
+import time
+import tracemalloc
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient
+
+from feedback_bot.chat_functions import send_text_to_room
+from feedback_bot.config import Config
+from feedback_bot.crypto_maintenance import format_size
+from feedback_bot.models.Chat import Chat
+from feedback_bot.models.RoomClassifier import RoomClassifier
+from feedback_bot.models.Ticket import Ticket
+from feedback_bot.utils import alias_cache
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+TOP_GROWTH_LINES = 5
+
+# Third party packages, by the directory name in site-packages
+PACKAGE_SUBSYSTEMS = {
+    "nio": "nio (room state, crypto)",
+    "olm": "nio (room state, crypto)",
+    "peewee": "crypto store",
+    "playhouse": "crypto store",
+    "aiohttp": "http",
+    "multidict": "http",
+    "yarl": "http",
+    "faker": "faker",
+    "commonmark": "commonmark",
+}
+
+
+def subsystem_of(filename: str) -> str:
+    """Subsystem an allocation is attributed to, from the file it was made in."""
+    filename = os.path.abspath(filename)
+    if filename.startswith(PACKAGE_DIR):
+        module = os.path.relpath(filename, PACKAGE_DIR)
+        return f"bot: {os.path.splitext(module)[0].replace(os.sep, '.')}"
+    parts = filename.split(os.sep)
+    for directory in ("site-packages", "dist-packages"):
+        if directory in parts:
+            package = parts[parts.index(directory) + 1]
+            return PACKAGE_SUBSYSTEMS.get(package, package.split(".")[0].split("-")[0])
+    if "sqlite3" in parts:
+        return "database"
+    return "python"
+
+
+def _signed_size(size: int) -> str:
+    return ("+" if size >= 0 else "-") + format_size(abs(size))
+
+
+def rss_bytes() -> Optional[int]:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Peak instead of current, where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryMonitor(object):
+    def __init__(self, client: AsyncClient, config: Config):
+        """Memory accounting of the long-lived structures and tracemalloc snapshots diffed over time.
+
+        Allocations are grouped per subsystem by the module they were made in. Each report compares
+        the latest snapshot to the previous one and to the first one.
+
+        Args:
+            client (nio.AsyncClient): nio client used to interact with matrix
+
+            config (Config): Bot configuration parameters
+        """
+        self.client = client
+        self.config = config
+        self.baseline: Optional[tracemalloc.Snapshot] = None
+        self.baseline_at = 0.0
+        self.previous: Optional[tracemalloc.Snapshot] = None
+        self.previous_at = 0.0
+        self.task: Optional[asyncio.Future] = None
+        self.started = False
+
+    def start(self):
+        """Report memory growth periodically to the management room."""
+        self.started = True
+        self.task = asyncio.ensure_future(self._run_forever())
+
+    async def _run_forever(self):
+        while True:
+            await asyncio.sleep(self.config.memory_report_interval_hours * 60 * 60)
+            try:
+                report = self.report()
+            except Exception as e:
+                logger.error(f"Memory report failed: {e}")
+                continue
+            await send_text_to_room(self.client, self.config.management_room_id, report)
+
+    def structure_sizes(self) -> List[Tuple[str, int]]:
+        """Entries in the structures that grow with usage."""
+        callbacks = self.client.callbacks
+        return [
+            ("Ticket cache", len(Ticket.ticket_cache)),
+            ("Chat cache", len(Chat.chat_cache)),
+            ("Room classification cache", len(RoomClassifier.room_cache)),
+            ("Room alias cache", len(alias_cache)),
+            ("Pending room events", sum(len(tasks) for tasks in callbacks.rooms_pending.values())),
+            ("Processed event IDs", len(callbacks.received_events)),
+            ("Welcomed rooms", len(callbacks.welcome_message_sent_to_room)),
+            ("Seen Megolm sessions", len(callbacks.seen_megolm_sessions)),
+            ("Events waiting for room keys", sum(callbacks.encrypted_backlog.user_counts.values())),
+            ("Joined rooms", len(self.client.rooms)),
+            ("Room members", sum(len(room.users) for room in self.client.rooms.values())),
+        ]
+
+    def take_snapshot(self) -> tracemalloc.Snapshot:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.config.memory_tracemalloc_frames)
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ))
+
+    @staticmethod
+    def subsystem_sizes(snapshot: tracemalloc.Snapshot) -> Dict[str, int]:
+        sizes: Counter = Counter()
+        for stat in snapshot.statistics("filename"):
+            sizes[subsystem_of(stat.traceback[0].filename)] += stat.size
+        return sizes
+
+    def report(self) -> str:
+        """Take a snapshot and report memory per subsystem, and its growth."""
+        was_tracing = tracemalloc.is_tracing()
+        snapshot = self.take_snapshot()
+        now = time.monotonic()
+
+        lines = [
+            "**Memory report**",
+            "",
+            f"- Resident: {format_size(rss_bytes())}, traced: {format_size(tracemalloc.get_traced_memory()[0])}",
+            "- Structures: " + ", ".join(f"{name} {size}" for name, size in self.structure_sizes()),
+        ]
+
+        if not was_tracing:
+            lines.append("- Allocation tracing started now, growth is reported from the next snapshot on.")
+        else:
+            sizes = self.subsystem_sizes(snapshot)
+            previous_sizes = self.subsystem_sizes(self.previous) if self.previous else {}
+            baseline_sizes = self.subsystem_sizes(self.baseline) if self.baseline else {}
+            lines.append(
+                f"- Per subsystem, change since the last report ({(now - self.previous_at) / 3600:.1f}h) "
+                f"and since the first ({(now - self.baseline_at) / 3600:.1f}h):"
+                if self.previous else "- Per subsystem:"
+            )
+            for subsystem, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:10]:
+                line = f"  - {subsystem}: {format_size(size)}"
+                if self.previous:
+                    line += f", {_signed_size(size - previous_sizes.get(subsystem, 0))}"
+                    line += f", {_signed_size(size - baseline_sizes.get(subsystem, 0))}"
+                lines.append(line)
+
+            if self.previous:
+                growth = [
+                    stat for stat in snapshot.compare_to(self.previous, "lineno")[:TOP_GROWTH_LINES]
+                    if stat.size_diff > 0
+                ]
+                if growth:
+                    lines.append("- Largest growth since the last report:")
+                for stat in growth:
+                    frame = stat.traceback[0]
+                    lines.append(
+                        f"  - `{os.path.basename(frame.filename)}:{frame.lineno}` {_signed_size(stat.size_diff)} "
+                        f"in {stat.count_diff:+d} blocks"
+                    )
+
+        if not self.baseline:
+            self.baseline, self.baseline_at = snapshot, now
+        self.previous, self.previous_at = snapshot, now
+
+        report = "\n".join(lines)
+        logger.info(report)
+        return report
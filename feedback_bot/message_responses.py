@@ -1,5 +1,4 @@
 import logging
-import re
 from typing import Union
 
 # noinspection PyPackageRequirements
@@ -8,11 +7,10 @@ from nio.rooms import MatrixRoom
 
 from feedback_bot.event_responses import Message
 from feedback_bot.bot_commands import Command
-from feedback_bot.chat_functions import send_reaction, send_text_to_room
+from feedback_bot.chat_functions import get_event_sender, get_sender, send_reaction, send_text_to_room
 from feedback_bot.config import Config
-from feedback_bot.models.User import User
+from feedback_bot.metrics import observe_relay
 from feedback_bot.storage import Storage
-from feedback_bot.utils import USER_ID_REGEX, get_in_reply_to, get_mentions, get_replaces, get_reply_msg, get_raise_msg
 
 logger = logging.getLogger(__name__)
 
@@ -39,12 +37,10 @@ class TextMessage(Message):
         self.message_content: str = message_content
 
     async def handle_management_room_message(self):
-        reply_to = get_in_reply_to(self.event)
-        replaces = get_replaces(self.event)
-
-
-        reply_section = get_reply_msg(self.event, reply_to, replaces)
-        raise_section = get_raise_msg(self.event, reply_to, replaces)
+        reply_to = self.content.in_reply_to
+        replaces = self.content.replaces
+        reply_section = self.content.reply_section
+        raise_section = self.content.raise_section
 
         if not reply_section:
             if not raise_section:
@@ -58,11 +54,9 @@ class TextMessage(Message):
                 #message = self.store.get_message_by_management_event_id(reply_to)
                # if message:
                 # Match user id in message to raise the ticket for
-                reply_rx_pattern = r'> <@([^:>]+):([^>]+)> ([^\s]+)' # Chatgpt helps here
-                match = re.search(reply_rx_pattern, self.event.body)
-                if match:
-                    rx_id = match[3]  # Get the id from regex group
-                    if self.client.user_id in rx_id:
+                rx_id = self.content.reply_quote_word()
+                if rx_id:
+                    if any(user_id in rx_id for user_id in [self.client.user_id] + self.config.sender_pool_user_ids):
                         await send_text_to_room(
                             self.client,
                             self.room.room_id,
@@ -91,6 +85,7 @@ class TextMessage(Message):
                 False,
                 reply_to_event_id=message["event_id"],
             )
+            observe_relay(response)
             if isinstance(response, RoomSendResponse):
                 # Store our outbound reply so we can reference it later
                 self.store.store_message(
@@ -150,6 +145,7 @@ class TextMessage(Message):
                 False,
                 replaces_event_id=message["event_id"],
             )
+            observe_relay(response)
             if isinstance(response, RoomSendResponse):
                 # Store our outbound reply so we can reference it later
                 self.store.store_message(
@@ -183,15 +179,10 @@ class TextMessage(Message):
             f"alias: {self.room.canonical_alias}): {self.message_content}"
 
     def anonymise_text(self, anonymise: bool) -> str:
-        user = User.get_existing(self.store, self.event.sender)
-        
-        if user is None:
-            user = User.create(self.store, self.event.sender)
-        
         if anonymise:
             text = f"{self.message_content}".replace("\n", "  \n")
         else:
-            text = f"{user.anon_id} (`{self.room.room_id}`): " \
+            text = f"{self.sender_user().anon_id} (`{self.room.room_id}`): " \
                    f"{self.message_content}".replace("\n", "  \n")
         return text
         
@@ -206,18 +197,25 @@ class TextMessage(Message):
             return
             
         reply_to_event_id, text = await self.transform_reply(text, room_id)
-        replaces_event_id, text = await self.transform_replaces(text, room_id)
+        replaces_event, text = await self.transform_replaces(text, room_id)
+        # Edits are only accepted from the account that sent the edited event
+        if replaces_event:
+            sender = get_event_sender(self.client, replaces_event.sender_id)
+        else:
+            sender = get_sender(self.client, room_id)
 
         response = await send_text_to_room(self.client,
                                            room_id, text,
                                            False,
                                            reply_to_event_id=reply_to_event_id,
-                                           replaces_event_id=replaces_event_id,
+                                           replaces_event_id=replaces_event.event_id if replaces_event else None,
+                                           sender=sender,
                                         )
+        observe_relay(response)
         if type(response) == RoomSendResponse and response.event_id:
             
             try:
-                await self.put_related_clone_event(room_id, response.event_id)
+                await self.put_related_clone_event(room_id, response.event_id, sender.user_id)
                 self.store.store_message(
                     self.event.event_id,
                     response.event_id,
@@ -234,8 +232,7 @@ class TextMessage(Message):
     def relay_based_on_mention_room(self) -> bool:
         if self.handler.is_mention_only_room([self.room.canonical_alias, self.room.room_id], self.room.is_named):
             # Did we get mentioned?
-            mentioned = self.config.user_id in get_mentions(self.message_content) or \
-                        self.message_content.lower().find(self.config.user_localpart.lower()) > -1
+            mentioned = self.content.mentions_user(self.config.user_id)
             if not mentioned:
                 logger.debug("Skipping message %s in room %s as it's set to only relay on mention and we were not "
                              "mentioned.", self.event.event_id, self.room.room_id)
@@ -0,0 +1,457 @@
+import abc
+import contextvars
+import functools
+import logging
+import os
+import sys
+import time
+from collections import deque
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+# noinspection PyPackageRequirements
+from aiohttp import web
+# noinspection PyPackageRequirements
+from nio import RoomSendResponse
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+        pairs.append(f'{name}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric(abc.ABC):
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.label_names):
+            raise ValueError(f"Metric {self.name} takes labels {self.label_names}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    @abc.abstractmethod
+    def samples(self) -> List[Tuple[str, Sequence[str], Sequence[str], float]]:
+        """(name suffix, label names, label values, value) of every series."""
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        for suffix, names, values, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_format_labels(names, values)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        return [("", self.label_names, key, value) for key, value in sorted(self.values.items())]
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self.values: Dict[Tuple[str, ...], float] = {}
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float, **labels):
+        self.values[self._key(labels)] = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Compute the (unlabelled) value when scraped, instead of keeping it up to date."""
+        self.function = function
+
+    def get(self, **labels) -> float:
+        if self.function:
+            return self.function()
+        return self.values.get(self._key(labels), 0)
+
+    def samples(self):
+        if self.function:
+            try:
+                return [("", (), (), self.function())]
+            except Exception as e:
+                logger.warning(f"Failed to compute metric {self.name}: {e}")
+                return []
+        return [("", self.label_names, key, value) for key, value in sorted(self.values.items())]
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+            self, name: str, documentation: str, label_names: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # label values -> (count per bucket, not cumulative), sum, count
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        series = self.values.get(key)
+        if series is None:
+            series = self.values[key] = ([0] * len(self.buckets), [0.0, 0])
+        counts, totals = series
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        totals[0] += value
+        totals[1] += 1
+
+    def samples(self):
+        samples = []
+        bucket_names = self.label_names + ("le",)
+        for key, (counts, totals) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                samples.append(("_bucket", bucket_names, key + (_format_value(bound),), cumulative))
+            samples.append(("_sum", self.label_names, key, totals[0]))
+            samples.append(("_count", self.label_names, key, totals[1]))
+        return samples
+
+
+class RateWindow(object):
+    def __init__(self, max_window_s: int):
+        """Per second counts over a sliding window, for rates over the last minutes."""
+        self.max_window_s = max_window_s
+        self.counts = [0] * max_window_s
+        self.seconds = [0] * max_window_s
+
+    def mark(self, amount: int = 1):
+        second = int(time.monotonic())
+        i = second % self.max_window_s
+        if self.seconds[i] != second:
+            self.seconds[i] = second
+            self.counts[i] = 0
+        self.counts[i] += amount
+
+    def rate(self, window_s: int) -> float:
+        """Average per second over the last window_s seconds."""
+        second = int(time.monotonic())
+        total = sum(
+            count for count, counted_at in zip(self.counts, self.seconds)
+            if second - counted_at < window_s
+        )
+        return total / window_s
+
+
+class Reservoir(object):
+    def __init__(self, size: int):
+        """The most recent observations, for exact quantiles of recent values."""
+        self.values = deque(maxlen=size)
+
+    def observe(self, value: float):
+        self.values.append(value)
+
+    def quantiles(self, qs: Sequence[float]) -> List[Optional[float]]:
+        if not self.values:
+            return [None for _ in qs]
+        values = sorted(self.values)
+        return [values[min(int(q * len(values)), len(values) - 1)] for q in qs]
+
+
+class QueryPath(object):
+    def __init__(self, name: str):
+        """The queries run while handling one event, per repository method.
+
+        Named after the event type, then after the code path taking the event as the handlers find out,
+        e.g. TextMessage.user_relay_to_ticket_room or Command.raise.
+        """
+        self.name = name
+        self.queries: Dict[str, int] = {}
+        self.named = False
+
+    @property
+    def count(self) -> int:
+        return sum(self.queries.values())
+
+
+class QueryPathStats(object):
+    def __init__(self):
+        """Totals of the queries per event of each code path, with the worst event, for budgets and reports."""
+        self.paths: Dict[str, Dict[str, Any]] = {}
+
+    def observe(self, path: QueryPath):
+        stats = self.paths.get(path.name)
+        if stats is None:
+            stats = self.paths[path.name] = {"events": 0, "queries": 0, "max": 0, "worst": {}, "methods": {}}
+        count = path.count
+        stats["events"] += 1
+        stats["queries"] += count
+        if count > stats["max"] or not stats["worst"]:
+            stats["max"] = count
+            stats["worst"] = dict(path.queries)
+        for method, method_count in path.queries.items():
+            stats["methods"][method] = stats["methods"].get(method, 0) + method_count
+
+    def reset(self):
+        self.paths.clear()
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        """Per path: events, mean and max queries per event, the queries of the worst event and of all, per method."""
+        return {
+            name: {
+                "events": stats["events"],
+                "mean": round(stats["queries"] / stats["events"], 2),
+                "max": stats["max"],
+                "worst": dict(sorted(stats["worst"].items(), key=lambda item: -item[1])),
+                "methods": dict(sorted(stats["methods"].items(), key=lambda item: -item[1])),
+            }
+            for name, stats in sorted(self.paths.items())
+        }
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(
+            self, name: str, documentation: str, label_names: Sequence[str] = (),
+            buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format."""
+        return "\n".join(metric.render() for metric in self.metrics.values()) + "\n"
+
+
+REGISTRY = Registry()
+
+PROCESS_START_TIME = REGISTRY.gauge("process_start_time_seconds", "Start time of the bot since the epoch")
+PROCESS_START_TIME.set(time.time())
+EVENTS_RECEIVED = REGISTRY.counter(
+    "feedback_bot_events_received_total", "Events passed to the callbacks", ("type",),
+)
+EVENTS_PROCESSED = REGISTRY.counter(
+    "feedback_bot_events_processed_total", "Events handled after filtering old, duplicate and logging room events",
+    ("type",),
+)
+RELAY_LATENCY = REGISTRY.histogram(
+    "feedback_bot_relay_latency_seconds", "Time from the server timestamp of an event to its relay to another room",
+    ("type",),
+)
+DB_QUERY_LATENCY = REGISTRY.histogram(
+    "feedback_bot_db_query_seconds", "Database query latency per repository method", ("method",), DB_BUCKETS,
+)
+DB_STATEMENT_LATENCY = REGISTRY.histogram(
+    "feedback_bot_db_statement_seconds", "Database statement latency per repository method and statement",
+    ("method", "statement"), DB_BUCKETS,
+)
+DB_ROWS = REGISTRY.counter(
+    "feedback_bot_db_rows_total", "Rows fetched or written by the statements of each repository method",
+    ("method", "statement"),
+)
+DB_SLOW_QUERIES = REGISTRY.counter(
+    "feedback_bot_db_slow_queries_total", "Statements slower than storage.slow_query_ms", ("method",),
+)
+RATELIMIT_HITS = REGISTRY.counter(
+    "feedback_bot_ratelimit_hits_total", "Requests rejected with M_LIMIT_EXCEEDED", ("account",),
+)
+RATELIMIT_BACKOFF = REGISTRY.counter(
+    "feedback_bot_ratelimit_backoff_seconds_total", "Time spent waiting for rate limits to expire", ("account",),
+)
+ROOMS_PENDING = REGISTRY.gauge(
+    "feedback_bot_rooms_pending", "Events queued until the bot is able to send to their target room",
+)
+CACHE_HITS = REGISTRY.counter("feedback_bot_cache_hits_total", "Lookups answered from a cache", ("cache",))
+CACHE_MISSES = REGISTRY.counter("feedback_bot_cache_misses_total", "Lookups that missed a cache", ("cache",))
+SYNC_LAG = REGISTRY.histogram(
+    "feedback_bot_sync_lag_seconds", "Age of the newest timeline event of each sync response when it is handled",
+)
+LAST_SYNC = REGISTRY.gauge("feedback_bot_last_sync_timestamp_seconds", "Time the last sync response was handled")
+QUERIES_PER_EVENT = REGISTRY.histogram(
+    "feedback_bot_queries_per_event", "Database queries run while handling an event, per code path", ("path",),
+    QUERY_COUNT_BUCKETS,
+)
+
+# Not exported, for the stats command
+EVENT_RATE = RateWindow(15 * 60)
+DB_QUERY_RATE = RateWindow(15 * 60)
+RECENT_RELAY_LATENCY = Reservoir(1000)
+QUERY_PATHS = QueryPathStats()
+
+# The event being handled, for attributing responses to it
+current_event: contextvars.ContextVar = contextvars.ContextVar("current_event", default=None)
+# The queries of the event being handled, for attributing them to its code path
+current_query_path: contextvars.ContextVar = contextvars.ContextVar("current_query_path", default=None)
+
+
+def event_type(event) -> str:
+    source = getattr(event, "source", None) or {}
+    return source.get("type") or type(event).__name__
+
+
+def event_processed(event):
+    EVENTS_PROCESSED.inc(type=event_type(event))
+    EVENT_RATE.mark()
+
+
+def count_received(func):
+    """Decorator for Callbacks entry points, counting every event passed to them and the queries run for it."""
+    @functools.wraps(func)
+    async def wrapper(self, room, event):
+        EVENTS_RECEIVED.inc(type=event_type(event))
+        path = QueryPath(event_type(event))
+        token = current_query_path.set(path)
+        try:
+            return await func(self, room, event)
+        finally:
+            current_query_path.reset(token)
+            # Events ignored without a query, e.g. duplicates and our own, would only skew the paths
+            if path.named or path.queries:
+                QUERIES_PER_EVENT.observe(path.count, path=path.name)
+                QUERY_PATHS.observe(path)
+
+    return wrapper
+
+
+def count_processed(func):
+    """Decorator for event handlers, counting handled events and making the event current while handling it."""
+    @functools.wraps(func)
+    async def wrapper(self, room, event):
+        token = current_event.set(event)
+        try:
+            return await func(self, room, event)
+        finally:
+            current_event.reset(token)
+            event_processed(event)
+
+    return wrapper
+
+
+def observe_relay(response):
+    """Record the latency of a relay, a successful send of the event being handled to another room."""
+    event = current_event.get()
+    if event is None or not isinstance(response, RoomSendResponse):
+        return
+    server_timestamp = getattr(event, "server_timestamp", None)
+    if server_timestamp:
+        latency = max(time.time() - server_timestamp / 1000, 0)
+        RELAY_LATENCY.observe(latency, type=event_type(event))
+        RECENT_RELAY_LATENCY.observe(latency)
+
+
+def query_path(name: str):
+    """Name the code path taking the event being handled, which its queries are attributed to."""
+    path = current_query_path.get()
+    if path is not None:
+        path.name = name
+        path.named = True
+
+
+def observe_query(method: str, seconds: float, statement: Optional[str] = None):
+    DB_QUERY_LATENCY.observe(seconds, method=method)
+    if statement:
+        DB_STATEMENT_LATENCY.observe(seconds, method=method, statement=statement)
+    DB_QUERY_RATE.mark()
+    path = current_query_path.get()
+    if path is not None:
+        path.queries[method] = path.queries.get(method, 0) + 1
+
+
+def count_rows(method: str, statement: str, rows: int):
+    DB_ROWS.inc(rows, method=method, statement=statement)
+
+
+def count_cache(cache: str, hit: bool):
+    if hit:
+        CACHE_HITS.inc(cache=cache)
+    else:
+        CACHE_MISSES.inc(cache=cache)
+
+
+# code object -> "Module.function" label
+_method_names: Dict[object, str] = {}
+
+
+def caller_name(depth: int = 2) -> str:
+    """Name of the function calling the caller, e.g. TicketRepository.get_ticket.
+
+    Repositories live in modules named after their class, so module and function name identify the method.
+    """
+    code = sys._getframe(depth).f_code
+    name = _method_names.get(code)
+    if name is None:
+        module = os.path.splitext(os.path.basename(code.co_filename))[0]
+        name = _method_names[code] = f"{module}.{code.co_name}"
+    return name
+
+
+class MetricsServer(object):
+    def __init__(self, host: str, port: int):
+        """Local HTTP endpoint serving the registry in the Prometheus text format on /metrics."""
+        self.host = host
+        self.port = port
+        self.runner: Optional[web.AppRunner] = None
+        self.started = False
+
+    @staticmethod
+    async def on_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=REGISTRY.render(), headers={"Content-Type": CONTENT_TYPE})
+
+    async def start(self):
+        self.started = True
+        app = web.Application()
+        app.router.add_get("/metrics", self.on_metrics)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, self.host, self.port).start()
+        logger.info(f"Metrics listening on {self.host}:{self.port}")
+
+    async def close(self):
+        if self.runner:
+            await self.runner.cleanup()
+        self.runner = None
+        self.started = False
@@ -97,6 +97,7 @@ def migrate(store):
         store._execute("""
                   CREATE TABLE IF NOT EXISTS `Users` (
         `user_id` VARCHAR(80) NOT NULL,
+        `anon_id` VARCHAR(80) NOT NULL UNIQUE,
         `room_id` VARCHAR(80) NULL,
         PRIMARY KEY (`user_id`))
               """)
@@ -109,7 +110,7 @@ def migrate(store):
 
         store._execute("""
                   CREATE TABLE IF NOT EXISTS `Tickets` (
-        `id` INT NOT NULL,
+        `id` INTEGER NOT NULL,
         `user_id` VARCHAR(80) NOT NULL,
         `user_room_id` VARCHAR(80) NULL,
         `status` VARCHAR(100) NULL DEFAULT 'open',
@@ -117,7 +118,7 @@ def migrate(store):
         PRIMARY KEY (`id`),
         CONSTRAINT `fk_Tickets_Users_user_id`
           FOREIGN KEY (`user_id`)
-          REFERENCES `Users` (`user_id`)
+          REFERENCES `Users` (`anon_id`)
           ON DELETE CASCADE
           ON UPDATE CASCADE)
               """)
@@ -141,7 +142,7 @@ def migrate(store):
 
         store._execute("""
                   CREATE TABLE IF NOT EXISTS `TimelineEvents` (
-        `id` INT NOT NULL,
+        `id` INTEGER NOT NULL,
         `device_id` VARCHAR(80) NULL,
         `event_id` VARCHAR(80) NULL,
         `room_id` VARCHAR(80) NULL,
@@ -19,7 +19,7 @@ def migrate(store):
     else:
         store._execute("""
         CREATE TABLE IF NOT EXISTS `IncomingEvents` (
-            `id` INT NOT NULL,
+            `id` INTEGER NOT NULL,
             `user_id` VARCHAR(80) NOT NULL,
             `room_id` VARCHAR(80) NOT NULL,
             `event_id` VARCHAR(80) NOT NULL,
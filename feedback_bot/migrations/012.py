@@ -0,0 +1,16 @@
+# noinspection PyProtectedMember
+def migrate(store):
+
+    if store.db_type == "postgres":
+
+        store._execute("""
+        CREATE TABLE IF NOT EXISTS SpareRooms (
+            room_id VARCHAR(80) NOT NULL,
+            PRIMARY KEY (room_id))
+        """)
+    else:
+        store._execute("""
+        CREATE TABLE IF NOT EXISTS `SpareRooms` (
+            `room_id` VARCHAR(80) NOT NULL,
+            PRIMARY KEY (`room_id`))
+        """)
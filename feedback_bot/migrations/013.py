@@ -0,0 +1,40 @@
+# noinspection PyProtectedMember
+def migrate(store):
+
+    if store.db_type == "postgres":
+
+        store._execute("""
+        CREATE TABLE IF NOT EXISTS RoomKeySessions (
+            session_id VARCHAR(80) NOT NULL,
+            room_id VARCHAR(80) NOT NULL,
+            first_seen BIGINT NOT NULL,
+            PRIMARY KEY (session_id))
+        """)
+
+        store._execute("""
+        CREATE TABLE IF NOT EXISTS ForwardedRoomKeys (
+            session_id VARCHAR(80) NOT NULL,
+            user_id VARCHAR(80) NOT NULL,
+            device_id VARCHAR(80) NOT NULL,
+            PRIMARY KEY (session_id, user_id, device_id))
+        """)
+    else:
+        store._execute("""
+        CREATE TABLE IF NOT EXISTS `RoomKeySessions` (
+            `session_id` VARCHAR(80) NOT NULL,
+            `room_id` VARCHAR(80) NOT NULL,
+            `first_seen` BIGINT NOT NULL,
+            PRIMARY KEY (`session_id`))
+        """)
+
+        store._execute("""
+        CREATE TABLE IF NOT EXISTS `ForwardedRoomKeys` (
+            `session_id` VARCHAR(80) NOT NULL,
+            `user_id` VARCHAR(80) NOT NULL,
+            `device_id` VARCHAR(80) NOT NULL,
+            PRIMARY KEY (`session_id`, `user_id`, `device_id`))
+        """)
+
+    store._execute("""
+        CREATE INDEX room_key_sessions_room_id_idx on RoomKeySessions (room_id, first_seen);
+    """)
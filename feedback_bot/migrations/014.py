@@ -0,0 +1,48 @@
+import json
+import zlib
+
+
+# noinspection PyProtectedMember
+def migrate(store):
+    # Store the compressed raw event source instead of the serialised MegolmEvent
+    if store.db_type == "postgres":
+        store._execute("""
+            ALTER TABLE encrypted_events ADD COLUMN server_timestamp BIGINT default 0;
+        """)
+        store._execute("""
+            ALTER TABLE encrypted_events ADD COLUMN source BYTEA;
+        """)
+    else:
+        store._execute("""
+            ALTER TABLE encrypted_events ADD COLUMN server_timestamp BIGINT default 0;
+        """)
+        store._execute("""
+            ALTER TABLE encrypted_events ADD COLUMN source BLOB;
+        """)
+
+    store._execute("""
+        select id, event from encrypted_events where event is not null;
+    """)
+    rows = store.cursor.fetchall()
+    converted = []
+    for row_id, event_json in rows:
+        try:
+            event_dict = json.loads(event_json)
+            source = event_dict["source"]
+            source["room_id"] = event_dict["room_id"]
+        except (ValueError, KeyError, TypeError):
+            continue
+        converted.append((
+            source.get("origin_server_ts", 0), zlib.compress(json.dumps(source).encode()), row_id,
+        ))
+    store._executemany("""
+        update encrypted_events set server_timestamp = ?, source = ?, event = null where id = ?;
+    """, converted)
+
+    # Rows that could not be converted can never be decrypted
+    store._execute("""
+        delete from encrypted_events where source is null;
+    """)
+    store._execute("""
+        CREATE INDEX encrypted_events_session_id_ts_idx ON encrypted_events (session_id, server_timestamp);
+    """)
@@ -0,0 +1,13 @@
+import time
+
+
+# noinspection PyProtectedMember
+def migrate(store):
+    # Time a Ticket was closed (ms), used for crypto store retention
+    store._execute("""
+        ALTER TABLE Tickets ADD COLUMN closed_at BIGINT NULL;
+    """)
+    # Retention of Tickets closed before this migration starts now
+    store._execute("""
+        UPDATE Tickets SET closed_at = ? WHERE status = ?;
+    """, (int(time.time() * 1000), "closed"))
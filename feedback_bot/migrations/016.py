@@ -0,0 +1,6 @@
+# noinspection PyProtectedMember
+def migrate(store):
+    # Rooms missing from the room classification cache are looked up by their Ticket room ID
+    store._execute("""
+        CREATE INDEX tickets_user_room_id_idx ON Tickets (user_room_id);
+    """)
@@ -0,0 +1,6 @@
+# noinspection PyProtectedMember
+def migrate(store):
+    # Crypto store maintenance looks up the rooms of Tickets closed before its retention
+    store._execute("""
+        CREATE INDEX tickets_status_closed_at_idx ON Tickets (status, closed_at);
+    """)
@@ -0,0 +1,23 @@
+# noinspection PyProtectedMember
+def migrate(store):
+    # Account picked to send to a room when it was created, fixed for the room's lifetime
+    if store.db_type == "postgres":
+
+        store._execute("""
+        CREATE TABLE IF NOT EXISTS RoomSenders (
+            room_id VARCHAR(80) NOT NULL,
+            sender_id VARCHAR(80) NOT NULL,
+            PRIMARY KEY (room_id))
+        """)
+    else:
+        store._execute("""
+        CREATE TABLE IF NOT EXISTS `RoomSenders` (
+            `room_id` VARCHAR(80) NOT NULL,
+            `sender_id` VARCHAR(80) NOT NULL,
+            PRIMARY KEY (`room_id`))
+        """)
+
+    # Account that sent the clone event, the only one whose edits and redactions of it are accepted
+    store._execute("""
+        ALTER TABLE EventPairs ADD COLUMN clone_sender_id VARCHAR(80) NULL;
+    """)
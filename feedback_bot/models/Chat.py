@@ -2,17 +2,16 @@ from typing import List
 from nio import AsyncClient, RoomCreateResponse, RoomInviteResponse, MatrixRoom, Response, RoomCreateError
 
 from feedback_bot.chat_functions import invite_to_room, create_room, send_text_to_room
+from feedback_bot.metrics import count_cache
 from feedback_bot.models.Repositories.ChatRepository import ChatRepository
 from feedback_bot.models.Repositories.UserRepository import UserRepository
+from feedback_bot.models.RoomClassifier import RoomClassifier
 from feedback_bot.storage import Storage
 import logging
-import re
 # Controller (External data)-> Service (Logic) -> Repository (sql queries)
 
 logger = logging.getLogger(__name__)
 
-chat_room_name_pattern = re.compile(r"^Chat:")
-
 class Chat(object):
 
     chat_cache = {}
@@ -33,6 +32,7 @@ class Chat(object):
     def get_existing(storage: Storage, chat_room_id: str):
         # Check cache first
         chat = Chat.chat_cache.get(chat_room_id, None)
+        count_cache("chat", chat is not None)
         if chat:
             return chat
 
@@ -62,6 +62,7 @@ class Chat(object):
             storage.repositories.chatRep.create_chat(user_id, chat_room_id)
         except Exception as e:
             return e
+        RoomClassifier.set_chat_room(chat_room_id)
 
         chat = Chat(storage, chat_room_id)
         # Add chat to cache
@@ -77,9 +78,10 @@ class Chat(object):
         chat = Chat.chat_cache.get(chat_room_id, None)
         # Cache hit
         if chat:
+            count_cache("chat", True)
             return chat
 
-        # Cache miss
+        # Cache miss, counted by get_existing
         chat = Chat.get_existing(store, chat_room_id)
 
         if chat:
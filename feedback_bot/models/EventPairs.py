@@ -4,13 +4,16 @@ from feedback_bot.models.Repositories.EventPairsRepository import EventPairsRepo
 from feedback_bot.storage import Storage
 
 class SingleEvent(object):
-    def __init__(self, room_id, event_id):
+    def __init__(self, room_id, event_id, sender_id=None):
         self.room_id = room_id
         self.event_id = event_id
+        # Only known for events the bot sent
+        self.sender_id = sender_id
 
 # Controller (External data)-> Service (Logic) -> Repository (sql queries)
 class EventPair(object):
-    def __init__(self, storage:Storage, room_id:str, event_id:str, clone_room_id:str, clone_event_id:str):
+    def __init__(self, storage:Storage, room_id:str, event_id:str, clone_room_id:str, clone_event_id:str,
+                 clone_sender_id:str = None):
         # Setup Storage bindings
         self.storage = storage
         self.eventPairsRep: EventPairsRepository = self.storage.repositories.eventPairsRep
@@ -20,6 +23,8 @@ class EventPair(object):
         
         self.clone_room_id = clone_room_id
         self.clone_event_id = clone_event_id
+        # Account that sent the clone, None for pairs stored before it was recorded
+        self.clone_sender_id = clone_sender_id
 
     @staticmethod
     def get_event_pair(storage:Storage, room_id:str, event_id:str) -> EventPair:
@@ -27,7 +32,9 @@ class EventPair(object):
         result = storage.repositories.eventPairsRep.get_room_event(room_id, event_id)
         
         if result:
-            result = EventPair(storage, room_id, event_id, result['clone_room_id'], result['clone_event_id'])
+            result = EventPair(
+                storage, room_id, event_id, result['clone_room_id'], result['clone_event_id'], result['clone_sender_id'],
+            )
             
         return result
     
@@ -55,12 +62,14 @@ class EventPair(object):
         
     def store_event_pair(self):
         # Store event pair to associate ticket room messages with real rooms and vice versa.
-        self.eventPairsRep.put_clone_event(self.room_id, self.event_id, self.clone_room_id, self.clone_event_id)
+        self.eventPairsRep.put_clone_event(
+            self.room_id, self.event_id, self.clone_room_id, self.clone_event_id, self.clone_sender_id,
+        )
         
     def get_single_event(self):
         return SingleEvent(self.room_id, self.event_id)
     
     def get_single_clone_event(self):
-        return SingleEvent(self.clone_room_id, self.clone_event_id)
+        return SingleEvent(self.clone_room_id, self.clone_event_id, self.clone_sender_id)
         
     
\ No newline at end of file
@@ -16,6 +16,11 @@ class ChatRepository(object):
             return chat_room_id[0]
         return chat_room_id
 
+    def get_chat_rooms(self):
+        self.storage._execute("SELECT chat_room_id FROM Chats;")
+        chats = self.storage.cursor.fetchall()
+        return [row[0] for row in chats]
+
     def assign_staff_to_chat(self, chat_room_id: str, staff_id: str):
         self.storage._execute("""
             insert into ChatsStaffRelation (chat_room_id, staff_id) values (?, ?);
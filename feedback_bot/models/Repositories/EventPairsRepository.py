@@ -6,13 +6,14 @@ class EventPairsRepository(object):
 
     def get_room_event(self, room_id:str, event_id:str):
         self.storage._execute("""
-            SELECT clone_room_id, clone_event_id FROM EventPairs WHERE room_id = ? AND event_id = ?;
+            SELECT clone_room_id, clone_event_id, clone_sender_id FROM EventPairs WHERE room_id = ? AND event_id = ?;
         """, (room_id, event_id,))
         clone_event = self.storage.cursor.fetchone()
         if clone_event:
             return {
                     "clone_room_id": clone_event[0],
                     "clone_event_id": clone_event[1],
+                    "clone_sender_id": clone_event[2],
                 }
         return None
     
@@ -28,10 +29,10 @@ class EventPairsRepository(object):
                 }
         return None
     
-    def put_clone_event(self, room_id:str, event_id:str, clone_room_id:str, clone_event_id:str):
+    def put_clone_event(self, room_id:str, event_id:str, clone_room_id:str, clone_event_id:str, clone_sender_id:str = None):
         self.storage._execute("""
-            INSERT INTO EventPairs (room_id, event_id, clone_room_id, clone_event_id) values (?, ?, ?, ?);
-        """, (room_id, event_id, clone_room_id, clone_event_id,))
+            INSERT INTO EventPairs (room_id, event_id, clone_room_id, clone_event_id, clone_sender_id) values (?, ?, ?, ?, ?);
+        """, (room_id, event_id, clone_room_id, clone_event_id, clone_sender_id,))
     
     def delete_room_events(self, room_id:str):
         self.storage._execute("""
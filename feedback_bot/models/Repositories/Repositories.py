@@ -1,6 +1,9 @@
 from feedback_bot.models.Repositories.ChatRepository import ChatRepository
 from feedback_bot.models.Repositories.EventPairsRepository import EventPairsRepository
 from feedback_bot.models.Repositories.IncomingEventsRepository import IncomingEventsRepository
+from feedback_bot.models.Repositories.RoomKeyRepository import RoomKeyRepository
+from feedback_bot.models.Repositories.RoomSenderRepository import RoomSenderRepository
+from feedback_bot.models.Repositories.SpareRoomRepository import SpareRoomRepository
 from feedback_bot.models.Repositories.StaffRepository import StaffRepository
 from feedback_bot.models.Repositories.SupportRepository import SupportRepository
 from feedback_bot.models.Repositories.TicketRepository import TicketRepository
@@ -18,4 +21,7 @@ class Repositories(object):
         self.userRep = UserRepository(self.storage)
         self.chatRep = ChatRepository(self.storage)
         self.incomingEventsRep = IncomingEventsRepository(self.storage)
-        self.eventPairsRep = EventPairsRepository(self.storage)
\ No newline at end of file
+        self.eventPairsRep = EventPairsRepository(self.storage)
+        self.spareRoomRep = SpareRoomRepository(self.storage)
+        self.roomKeyRep = RoomKeyRepository(self.storage)
+        self.roomSenderRep = RoomSenderRepository(self.storage)
\ No newline at end of file
@@ -0,0 +1,47 @@
+from typing import List, Set, Tuple
+
+from feedback_bot.storage import IN_LIST_BATCH_SIZE, Storage
+
+class RoomKeyRepository(object):
+    def __init__(self, storage:Storage) -> None:
+        self.storage = storage
+
+    def put_session(self, session_id:str, room_id:str, first_seen:int):
+        # The first event seen for a session is kept
+        self.storage._execute("""
+            INSERT INTO RoomKeySessions (session_id, room_id, first_seen) values (?, ?, ?)
+            ON CONFLICT (session_id) DO NOTHING;
+        """, (session_id, room_id, first_seen))
+
+    def get_sessions_since(self, room_id:str, since:int) -> Set[str]:
+        self.storage._execute("""
+            SELECT session_id FROM RoomKeySessions WHERE room_id= ? AND first_seen >= ?;
+        """, (room_id, since))
+        return {row[0] for row in self.storage.cursor.fetchall()}
+
+    def get_forwarded_keys(self, session_ids:List[str], user_id:str) -> Set[Tuple[str, str]]:
+        forwarded_keys = set()
+        for i in range(0, len(session_ids), IN_LIST_BATCH_SIZE):
+            batch = session_ids[i:i + IN_LIST_BATCH_SIZE]
+            placeholders = ", ".join("?" for _ in batch)
+            self.storage._execute(f"""
+                SELECT session_id, device_id FROM ForwardedRoomKeys
+                WHERE user_id= ? AND session_id IN ({placeholders});
+            """, (user_id, *batch))
+            forwarded_keys.update((row[0], row[1]) for row in self.storage.cursor.fetchall())
+        return forwarded_keys
+
+    def put_forwarded_keys(self, forwarded_keys:List[Tuple[str, str, str]]):
+        # (session_id, user_id, device_id)
+        self.storage._executemany("""
+            INSERT INTO ForwardedRoomKeys (session_id, user_id, device_id) values (?, ?, ?)
+            ON CONFLICT (session_id, user_id, device_id) DO NOTHING;
+        """, forwarded_keys)
+
+    def delete_room_sessions(self, room_ids:List[str], session_ids:List[str]):
+        self.storage._executemany("""
+            DELETE FROM RoomKeySessions WHERE room_id= ?;
+        """, [(room_id,) for room_id in room_ids])
+        self.storage._executemany("""
+            DELETE FROM ForwardedRoomKeys WHERE session_id= ?;
+        """, [(session_id,) for session_id in session_ids])
@@ -0,0 +1,16 @@
+from typing import Dict
+
+from feedback_bot.storage import Storage
+
+class RoomSenderRepository(object):
+    def __init__(self, storage:Storage) -> None:
+        self.storage = storage
+
+    def put_room_sender(self, room_id:str, sender_id:str):
+        self.storage._execute("""
+            INSERT INTO RoomSenders (room_id, sender_id) values (?, ?);
+        """, (room_id, sender_id))
+
+    def get_room_senders(self) -> Dict[str, str]:
+        self.storage._execute("SELECT room_id, sender_id FROM RoomSenders;")
+        return {row[0]: row[1] for row in self.storage.cursor.fetchall()}
@@ -0,0 +1,20 @@
+from feedback_bot.storage import Storage
+
+class SpareRoomRepository(object):
+    def __init__(self, storage:Storage) -> None:
+        self.storage = storage
+
+    def put_spare_room(self, room_id:str):
+        self.storage._execute("""
+            INSERT INTO SpareRooms (room_id) values (?);
+        """, (room_id,))
+
+    def get_spare_rooms(self):
+        self.storage._execute("SELECT room_id FROM SpareRooms;")
+        rooms = self.storage.cursor.fetchall()
+        return [row[0] for row in rooms]
+
+    def delete_spare_room(self, room_id:str):
+        self.storage._execute("""
+            DELETE FROM SpareRooms WHERE room_id= ?;
+        """, (room_id,))
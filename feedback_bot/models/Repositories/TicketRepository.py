@@ -1,3 +1,5 @@
+import time
+
 from feedback_bot.storage import Storage
 from enum import Enum
 
@@ -72,9 +74,10 @@ class TicketRepository(object):
         """, (ticket_id, staff_id))
     
     def set_ticket_status(self, ticket_id:int, status:str):
+        closed_at = int(time.time() * 1000) if status == TicketStatus.CLOSED.value else None
         self.storage._execute("""
-            UPDATE Tickets SET status= ? WHERE id=?
-        """, (status, ticket_id))
+            UPDATE Tickets SET status= ?, closed_at= ? WHERE id=?
+        """, (status, closed_at, ticket_id))
 
     def get_ticket_status(self, ticket_id: int):
         self.storage._execute("""
@@ -105,6 +108,34 @@ class TicketRepository(object):
             return ticket_room_id[0]
         return ticket_room_id
 
+    def get_ticket_id_of_room(self, ticket_room_id: str):
+        self.storage._execute("""
+            SELECT id FROM Tickets WHERE user_room_id=?
+        """, (ticket_room_id,))
+        id = self.storage.cursor.fetchone()
+        if id:
+            return id[0]
+        return id
+
+    def get_ticket_rooms(self):
+        self.storage._execute("""
+            SELECT id, user_room_id FROM Tickets WHERE user_room_id IS NOT NULL
+        """)
+
+        tickets = self.storage.cursor.fetchall()
+        return [
+            {
+                'id': ticket[0],
+                'ticket_room_id': ticket[1],
+            } for ticket in tickets
+        ]
+
+    def get_ticket_rooms_closed_before(self, closed_before:int):
+        self.storage._execute("""
+            SELECT user_room_id FROM Tickets WHERE status=? AND closed_at < ? AND user_room_id IS NOT NULL
+        """, (TicketStatus.CLOSED.value, closed_before))
+        return [ticket[0] for ticket in self.storage.cursor.fetchall()]
+
     def get_all_fields(self, ticket_id:int):
         self.storage._execute("""
             select id, user_id, user_room_id, status, ticket_name from Tickets where id = ?
@@ -0,0 +1,97 @@
+from enum import Enum
+from typing import Dict, Optional, Tuple, Union
+
+from nio import MatrixRoom
+
+from feedback_bot.metrics import count_cache
+from feedback_bot.storage import Storage
+import logging
+import re
+# Controller (External data)-> Service (Logic) -> Repository (sql queries)
+
+logger = logging.getLogger(__name__)
+
+
+ticket_name_pattern = re.compile(r"Ticket #(\d+) \(.+\)")
+chat_room_name_pattern = re.compile(r"^Chat:")
+
+class RoomType(Enum):
+    ManagementRoom  = 0
+    LoggingRoom     = 1
+    UserRoom        = 2
+    TicketRoom      = 3
+    ChatRoom        = 4
+
+class RoomClassifier(object):
+
+    # room_id -> (RoomType, ticket_id / chat_room_id / None)
+    room_cache: Dict[str, Tuple[RoomType, Union[int, str, None]]] = {}
+
+    @staticmethod
+    def load(storage: Storage):
+        # Build the classification map from the Tickets and Chats tables
+        RoomClassifier.room_cache = {}
+        for ticket in storage.repositories.ticketRep.get_ticket_rooms():
+            RoomClassifier.room_cache[ticket['ticket_room_id']] = (RoomType.TicketRoom, ticket['id'])
+        for chat_room_id in storage.repositories.chatRep.get_chat_rooms():
+            RoomClassifier.room_cache[chat_room_id] = (RoomType.ChatRoom, chat_room_id)
+
+        logger.info(f"Loaded room classification for {len(RoomClassifier.room_cache)} rooms")
+
+    @staticmethod
+    def classify(storage: Storage, room_id: str) -> Tuple[RoomType, Union[int, str, None]]:
+        # Cache hit
+        classification = RoomClassifier.room_cache.get(room_id, None)
+        count_cache("room_classifier", classification is not None)
+        if classification:
+            return classification
+
+        # Cache miss - the database is the source of truth, never the room name
+        ticket_id = storage.repositories.ticketRep.get_ticket_id_of_room(room_id)
+        if ticket_id is not None:
+            classification = (RoomType.TicketRoom, ticket_id)
+        elif storage.repositories.chatRep.get_chat(room_id):
+            classification = (RoomType.ChatRoom, room_id)
+        else:
+            classification = (RoomType.UserRoom, None)
+
+        RoomClassifier.room_cache[room_id] = classification
+        return classification
+
+    @staticmethod
+    def get_room_type(storage: Storage, room: MatrixRoom) -> RoomType:
+        return RoomClassifier.classify(storage, room.room_id)[0]
+
+    @staticmethod
+    def get_ticket_id(room_id: str) -> Optional[int]:
+        classification = RoomClassifier.room_cache.get(room_id, None)
+        if classification and classification[0] == RoomType.TicketRoom:
+            return classification[1]
+
+    @staticmethod
+    def set_ticket_room(ticket_room_id: str, ticket_id: int, previous_room_id: Optional[str] = None):
+        # The replaced room is no longer the Ticket's, re-check it against the database on next use
+        if previous_room_id and previous_room_id != ticket_room_id:
+            RoomClassifier.room_cache.pop(previous_room_id, None)
+        RoomClassifier.room_cache[ticket_room_id] = (RoomType.TicketRoom, ticket_id)
+
+    @staticmethod
+    def set_chat_room(chat_room_id: str):
+        RoomClassifier.room_cache[chat_room_id] = (RoomType.ChatRoom, chat_room_id)
+
+    @staticmethod
+    def update_room_name(storage: Storage, room_id: str, name: Optional[str]):
+        classification = RoomClassifier.room_cache.get(room_id, None)
+
+        # Rooms without a Ticket or Chat entry are re-checked against the database on next use
+        if classification and classification[0] == RoomType.UserRoom:
+            RoomClassifier.room_cache.pop(room_id)
+        room_type = RoomClassifier.classify(storage, room_id)[0]
+
+        # Renames do not change the classification, only warn about misleading names
+        if not name:
+            return
+        if ticket_name_pattern.match(name) and room_type != RoomType.TicketRoom:
+            logger.warning(f"Room {room_id} was renamed to '{name}' but is not a Ticket room")
+        elif chat_room_name_pattern.match(name) and room_type != RoomType.ChatRoom:
+            logger.warning(f"Room {room_id} was renamed to '{name}' but is not a Chat room")
@@ -1,19 +1,18 @@
 from typing import List
 from nio import AsyncClient, RoomCreateResponse, RoomInviteResponse, MatrixRoom, Response
 
-from feedback_bot.chat_functions import invite_to_room, create_room, send_text_to_room
+from feedback_bot.chat_functions import invite_to_room, create_room, send_text_to_room, preshare_group_session
+from feedback_bot.metrics import count_cache
 from feedback_bot.models.Repositories.TicketRepository import TicketStatus, TicketRepository
 from feedback_bot.models.Repositories.UserRepository import UserRepository
+from feedback_bot.models.RoomClassifier import RoomClassifier
 from feedback_bot.storage import Storage
 import logging
-import re
 # Controller (External data)-> Service (Logic) -> Repository (sql queries)
 
 logger = logging.getLogger(__name__)
 
 
-ticket_name_pattern = re.compile(r"Ticket #(\d+) \(.+\)")
-
 class Ticket(object):
 
     ticket_cache = {}
@@ -37,6 +36,7 @@ class Ticket(object):
     def get_existing(storage: Storage, ticket_id: int):
         # Check cache first
         ticket = Ticket.ticket_cache.get(ticket_id, None)
+        count_cache("ticket", ticket is not None)
         if ticket:
             return ticket
 
@@ -65,21 +65,14 @@ class Ticket(object):
 
     @staticmethod
     def find_room_ticket_id(room:MatrixRoom):
-        match = None
-        if room.name:
-            match = ticket_name_pattern.match(room.name)
-
-        ticket_id = None
-        if match:
-            ticket_id = match[1]  # Get the id from regex group
-
-        if ticket_id and ticket_id.isnumeric():
-            return int(ticket_id)
+        return RoomClassifier.get_ticket_id(room.room_id)
 
     @staticmethod
     def find_ticket_of_room(store, room:MatrixRoom):
         is_open_ticket_room = False
 
+        # Make sure the room is classified before looking up its ticket
+        RoomClassifier.classify(store, room.room_id)
         ticket_id = Ticket.find_room_ticket_id(room)
         if not ticket_id:
             return None
@@ -88,9 +81,10 @@ class Ticket(object):
         ticket = Ticket.ticket_cache.get(ticket_id, None)
         # Cache hit
         if ticket:
+            count_cache("ticket", True)
             return ticket
 
-        # Cache miss
+        # Cache miss, counted by get_existing
         ticket = Ticket.get_existing(store, ticket_id)
 
         if ticket:
@@ -99,19 +93,32 @@ class Ticket(object):
         else:
             return None
 
-    async def create_ticket_room(self, client:AsyncClient, invite:List[str] = []):
+    async def create_ticket_room(self, client:AsyncClient, invite:List[str] = [], encrypted:bool = False):
+        room_name = f"Ticket #{self.id} ({self.ticket_name})"
+
+        # Take a pre-created room if available
+        ticket_room_pool = getattr(client, "ticket_room_pool", None)
+        if ticket_room_pool:
+            ticket_room_id = await ticket_room_pool.take(room_name, invite)
+            if ticket_room_id:
+                self.set_ticket_room_id(ticket_room_id)
+                preshare_group_session(client, ticket_room_id)
+                return RoomCreateResponse(ticket_room_id)
+
         # Request a Ticket reply room to be created.
-        response = await create_room(client, f"Ticket #{self.id} ({self.ticket_name})", invite)
+        response = await create_room(client, room_name, invite, encrypted=encrypted)
 
         if isinstance(response, RoomCreateResponse):
-            self.ticket_room_id = response.room_id
-            self.ticketRep.set_ticket_room_id(self.id, self.ticket_room_id)
+            self.set_ticket_room_id(response.room_id)
+            preshare_group_session(client, response.room_id)
 
         return response
 
     def set_ticket_room_id(self, ticket_room_id:str):
+        previous_room_id = self.ticket_room_id
         self.ticket_room_id = ticket_room_id
         self.ticketRep.set_ticket_room_id(self.id, ticket_room_id)
+        RoomClassifier.set_ticket_room(ticket_room_id, self.id, previous_room_id)
 
     async def invite_to_ticket_room(self, client:AsyncClient, user_id:str):
         # Invite staff to the Ticket room
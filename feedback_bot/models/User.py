@@ -1,8 +1,8 @@
+from feedback_bot.metrics import count_cache
 from feedback_bot.models.Repositories.UserRepository import UserRepository
 from feedback_bot.storage import Storage
 from feedback_bot.utils import get_username
 from faker import Faker
-from datetime import datetime
 import random
 
 # Controller (External data)-> Service (Logic) -> Repository (sql queries)
@@ -23,6 +23,9 @@ class User(object):
 
     @staticmethod
     def get_existing(storage:Storage, user_id:str):
+        # Users are not cached, lookups are counted for the stats command
+        count_cache("user", False)
+
         # Find existing user
         exists = storage.repositories.userRep.get_user(user_id)
         if not exists:
@@ -46,9 +49,11 @@ class User(object):
         return User(storage, user_id)
     
     @staticmethod
-    def generate_anonymous_name(seed = datetime.now().timestamp()):
-        Faker.seed(seed)
-        faker = Faker()        
+    def generate_anonymous_name(seed = None):
+        # A default seed is evaluated once, every user would get the same names and only differ in the digits
+        if seed is not None:
+            Faker.seed(seed)
+        faker = Faker()
         first_name = faker.first_name()
         last_name = faker.first_name()
         digits = random.randint(0, 100)
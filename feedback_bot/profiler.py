@@ -0,0 +1,185 @@
+import cProfile
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+from typing import List, Optional, Tuple
+
+from feedback_bot.config import Config
+
+logger = logging.getLogger(__name__)
+
+SAMPLE_INTERVAL_S = 0.005
+TOP_FUNCTIONS = 10
+PROFILE_MODES = ("sampling", "cprofile")
+
+
+def _frame_label(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _is_idle(code) -> bool:
+    # The event loop waiting for I/O
+    return code.co_filename.endswith("selectors.py") and code.co_name in ("select", "poll")
+
+
+class SamplingProfiler(object):
+    def __init__(self, thread_id: int, interval_s: float = SAMPLE_INTERVAL_S):
+        """Sample the stack of a thread from a background thread, cheap enough to leave on in production.
+
+        Stacks are aggregated in the collapsed format of flamegraph.pl and speedscope.
+        """
+        self.thread_id = thread_id
+        self.interval_s = interval_s
+        self.stacks: Counter = Counter()
+        self.own_samples: Counter = Counter()
+        self.samples = 0
+        self.idle_samples = 0
+        self.lock = threading.Lock()
+        self.running = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(target=self._run, name="feedback-bot-profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread:
+            self.thread.join()
+        self.thread = None
+
+    def _run(self):
+        while self.running.is_set():
+            time.sleep(self.interval_s)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            labels = []
+            idle = _is_idle(frame.f_code)
+            top = _frame_label(frame.f_code)
+            while frame is not None:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            with self.lock:
+                self.samples += 1
+                if idle:
+                    self.idle_samples += 1
+                    continue
+                self.stacks[";".join(reversed(labels))] += 1
+                self.own_samples[top] += 1
+
+    def write(self, path: str):
+        with self.lock:
+            stacks = list(self.stacks.items())
+        with open(path, "w") as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+
+    def summary(self) -> str:
+        with self.lock:
+            samples, idle_samples = self.samples, self.idle_samples
+            top = self.own_samples.most_common(TOP_FUNCTIONS)
+        if not samples:
+            return "No samples yet."
+        lines = [f"{samples} samples, event loop idle in {idle_samples / samples:.0%}. Top functions by own time:"]
+        for label, count in top:
+            lines.append(f"- `{label}` {count / samples:.1%}")
+        return "\n".join(lines)
+
+
+class Profiler(object):
+    def __init__(self, config: Config):
+        """Profiler of the running bot, controlled with the `profile` staff command.
+
+        The sampling mode writes collapsed stacks for flamegraphs, the cprofile mode writes pstats files.
+        Both are written to the profiles directory under storage.store_path.
+
+        Args:
+            config (Config): Bot configuration parameters
+        """
+        self.config = config
+        self.mode: Optional[str] = None
+        self.sampler: Optional[SamplingProfiler] = None
+        self.cprofile: Optional[cProfile.Profile] = None
+        self.started_at = 0.0
+
+    @property
+    def running(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: str = "sampling") -> str:
+        if self.running:
+            return f"The {self.mode} profiler is already running."
+        if mode not in PROFILE_MODES:
+            return f"Unknown profiler mode '{mode}', use one of {', '.join(PROFILE_MODES)}."
+
+        if mode == "cprofile":
+            # Profiles the thread it is enabled in, the event loop
+            self.cprofile = cProfile.Profile()
+            self.cprofile.enable()
+        else:
+            self.sampler = SamplingProfiler(threading.get_ident())
+            self.sampler.start()
+        self.mode = mode
+        self.started_at = time.monotonic()
+        logger.info(f"Started the {mode} profiler")
+        return f"Started the {mode} profiler."
+
+    def _path(self, extension: str) -> str:
+        directory = os.path.join(self.config.store_path, "profiles")
+        os.makedirs(directory, exist_ok=True)
+        now = time.time()
+        name = f"profile-{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now * 1000) % 1000:03d}"
+        return os.path.join(directory, f"{name}.{extension}")
+
+    def _cprofile_summary(self, stats: pstats.Stats) -> str:
+        # (file, line, function) -> (primitive calls, calls, own time, cumulative time, callers)
+        rows: List[Tuple[tuple, tuple]] = sorted(stats.stats.items(), key=lambda item: item[1][2], reverse=True)
+        lines = [f"{stats.total_calls} calls in {stats.total_tt:.3f}s. Top functions by own time:"]
+        for (filename, line, function), (_, calls, own_time, cumulative_time, _) in rows[:TOP_FUNCTIONS]:
+            lines.append(
+                f"- `{function} ({os.path.basename(filename)}:{line})` {own_time:.3f}s own, "
+                f"{cumulative_time:.3f}s cumulative, {calls} calls"
+            )
+        return "\n".join(lines)
+
+    def dump(self) -> str:
+        """Write the profile so far and summarise the hottest functions, the profiler keeps running."""
+        if not self.running:
+            return "The profiler is not running."
+
+        duration = time.monotonic() - self.started_at
+        if self.mode == "cprofile":
+            path = self._path("pstats")
+            # Creating the stats disables the profiler
+            stats = pstats.Stats(self.cprofile)
+            stats.dump_stats(path)
+            self.cprofile.enable()
+            summary = self._cprofile_summary(stats)
+        else:
+            path = self._path("folded")
+            self.sampler.write(path)
+            summary = self.sampler.summary()
+
+        logger.info(f"Wrote {self.mode} profile to {path}")
+        return f"Profiled for {duration:.0f}s, written to `{path}`.\n\n{summary}"
+
+    def stop(self) -> str:
+        """Stop the profiler, writing and summarising the profile."""
+        if not self.running:
+            return "The profiler is not running."
+
+        report = self.dump()
+        if self.mode == "cprofile":
+            self.cprofile.disable()
+        else:
+            self.sampler.stop()
+        self.cprofile = None
+        self.sampler = None
+        self.mode = None
+        return report
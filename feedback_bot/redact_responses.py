@@ -8,9 +8,8 @@ from nio.rooms import MatrixRoom
 from nio.events.room_events import RoomMessageText
 
 from feedback_bot.event_responses import Message
-from feedback_bot.chat_functions import send_room_redact
+from feedback_bot.chat_functions import get_event_sender, send_room_redact
 from feedback_bot.config import Config
-from feedback_bot.models.User import User
 from feedback_bot.storage import Storage
 
 logger = logging.getLogger(__name__)
@@ -50,31 +49,28 @@ class RedactMessage(Message):
             f"alias: {self.room.canonical_alias}): {self.redacts_event_id}"
 
     def anonymise_text(self, anonymise: bool) -> str:
-        user = User.get_existing(self.store, self.event.sender)
-        
-        if user is None:
-            user = User.create(self.store, self.event.sender)
-            
         if anonymise:
             text = f"{self.redacts_event_id}".replace("\n", "  \n")
         else:
-            text = f"{user.anon_id} (`{self.room.room_id}`): " \
+            text = f"{self.sender_user().anon_id} (`{self.room.room_id}`): " \
                    f"{self.redacts_event_id}".replace("\n", "  \n")
         return text
         
         
     async def send_message_to_room(self, text:str, room_id:str):
                 
-        redacts_event_id = await self.get_related(self.redacts_event_id)
+        redacts_event = await self.get_related_event(self.redacts_event_id)
         
-        if not redacts_event_id:
+        if not redacts_event:
             logger.error("Failed to find related redacts event by %s in room %s", self.event.event_id, self.room.room_id)
             return
         
+        # Secondary accounts have no power, they can only redact the events they sent
         response = await send_room_redact(self.client,
                                            room_id,
-                                           redacts_event_id,
-                                           self.reason
+                                           redacts_event.event_id,
+                                           self.reason,
+                                           sender=get_event_sender(self.client, redacts_event.sender_id),
                                         )
         if type(response) == RoomRedactResponse and response.event_id:
             logger.info("Redact message %s relayed to room %s", self.event.event_id, self.room.room_id)
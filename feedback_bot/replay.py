@@ -0,0 +1,382 @@
+#!/usr/bin/env python3
+"""Replay an event journal into the bot, as fast as it handles the events.
+
+The journal's events are fed to the Callbacks of a bot with the configured database, and a client
+answering its requests locally instead of a homeserver. Event and room IDs the homeserver gave to
+what the bot sent and created are looked up ahead in the journal, so the rows written match the
+ones written when the events were received. Anonymous names are random, users new to the database
+get different ones than they got then.
+
+To rebuild a database, replay the journal written since its last backup into the restored backup.
+For load tests, replay into a copy with --database.
+
+Usage: python -m feedback_bot.replay config.yaml store/journal/events.jsonl [options], see --help.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import re
+import sys
+import time
+import urllib.parse
+from collections import Counter, OrderedDict, defaultdict, deque
+from typing import Any, Deque, Dict, Iterable, List, Optional, Tuple
+
+# noinspection PyPackageRequirements
+from nio import AsyncClientConfig, Event, InviteEvent, MatrixInvitedRoom, MatrixRoom, MegolmEvent
+
+from feedback_bot import metrics
+from feedback_bot.callbacks import Callbacks
+from feedback_bot.client import PooledAsyncClient
+from feedback_bot.config import Config
+from feedback_bot.journal import read_journal
+from feedback_bot.main import register_callbacks
+from feedback_bot.memory import MemoryMonitor
+from feedback_bot.models.Repositories.Repositories import Repositories
+from feedback_bot.models.RoomClassifier import RoomClassifier
+from feedback_bot.profiler import Profiler
+from feedback_bot.sender_pool import SenderPool
+from feedback_bot.storage import Storage
+
+logger = logging.getLogger(__name__)
+
+# Events kept for the bot fetching related events, e.g. the event replied to
+EVENT_CACHE_SIZE = 100000
+
+API_PREFIX = re.compile(r"^/_matrix/client/(r0|v3)")
+ROUTES = [
+    ("send", "PUT", re.compile(r"^/rooms/(?P<room_id>[^/]+)/send/(?P<event_type>[^/]+)/[^/]+$")),
+    ("put_state", "PUT", re.compile(r"^/rooms/(?P<room_id>[^/]+)/state/(?P<event_type>[^/]+)(/[^/]*)?$")),
+    ("redact", "PUT", re.compile(r"^/rooms/(?P<room_id>[^/]+)/redact/[^/]+/[^/]+$")),
+    ("create_room", "POST", re.compile(r"^/createRoom$")),
+    ("join", "POST", re.compile(r"^/join/(?P<room_id>[^/]+)$")),
+    ("resolve_alias", "GET", re.compile(r"^/directory/room/(?P<alias>[^/]+)$")),
+    ("get_event", "GET", re.compile(r"^/rooms/(?P<room_id>[^/]+)/event/(?P<event_id>[^/]+)$")),
+    ("joined_members", "GET", re.compile(r"^/rooms/(?P<room_id>[^/]+)/joined_members$")),
+    ("get_state", "GET", re.compile(r"^/rooms/(?P<room_id>[^/]+)/state$")),
+    ("keys_query", "POST", re.compile(r"^/keys/query$")),
+    ("keys_claim", "POST", re.compile(r"^/keys/claim$")),
+    ("keys_upload", "POST", re.compile(r"^/keys/upload$")),
+]
+
+
+def _not_found(error: str) -> Tuple[int, Any]:
+    return 404, {"errcode": "M_NOT_FOUND", "error": error}
+
+
+class JournalIndex(object):
+    def __init__(self, own_user_ids: Iterable[str]):
+        """IDs the homeserver gave to the events the bot sent and the rooms it created, in journal order.
+
+        The bot receives what it sent through the sync, so they are in the journal after the
+        request that made them.
+        """
+        self.own_user_ids = set(own_user_ids)
+        # (room ID, event type) -> IDs of the events the bot sent
+        self.own_events: Dict[Tuple[str, str], Deque[str]] = defaultdict(deque)
+        self.created_rooms: Deque[str] = deque()
+        # Room ID -> the first context of the room in the journal
+        self.first_contexts: Dict[str, Dict[str, Any]] = {}
+
+    def scan(self, records: Iterable[Dict[str, Any]]):
+        for record in records:
+            if record["type"] == "room":
+                self.first_contexts.setdefault(record["room_id"], record)
+            if record["type"] != "event":
+                continue
+            event = record["event"]
+            if event.get("sender") not in self.own_user_ids or "event_id" not in event:
+                continue
+            if event.get("type") == "m.room.create":
+                self.created_rooms.append(record["room_id"])
+            else:
+                self.own_events[(record["room_id"], event.get("type"))].append(event["event_id"])
+
+    def known_rooms(self) -> List[Dict[str, Any]]:
+        """First contexts of the rooms the bot was in before the journal started, known from its first sync."""
+        created = set(self.created_rooms)
+        return [context for room_id, context in self.first_contexts.items() if room_id not in created]
+
+    def event_id(self, room_id: str, event_type: str) -> Optional[str]:
+        events = self.own_events.get((room_id, event_type))
+        return events.popleft() if events else None
+
+    def room_id(self) -> Optional[str]:
+        return self.created_rooms.popleft() if self.created_rooms else None
+
+
+class LocalResponse(object):
+    """Stands in for the transport response of a request answered by the ReplayClient."""
+    content_type = "application/json"
+    content_disposition = None
+
+    def __init__(self, status: int, body: Any):
+        self.status = status
+        self.body = body
+
+    async def json(self) -> Any:
+        return self.body
+
+    async def text(self) -> str:
+        return json.dumps(self.body)
+
+    async def read(self) -> bytes:
+        return json.dumps(self.body).encode()
+
+
+class ReplayClient(PooledAsyncClient):
+    """Client answering the bot's requests locally, with the rooms rebuilt from the journal."""
+
+    def __init__(self, *args, index: JournalIndex, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.index = index
+        self.server_name = self.user.split(":", 1)[1]
+        self.aliases: Dict[str, str] = {}
+        self.events: OrderedDict = OrderedDict()
+        self.requests: Counter = Counter()
+        self.generated_ids = 0
+
+    def _generated_id(self, sigil: str) -> str:
+        self.generated_ids += 1
+        return f"{sigil}replay-{self.generated_ids}:{self.server_name}"
+
+    def apply_room_context(self, context: Dict[str, Any]) -> MatrixRoom:
+        room_id = context["room_id"]
+        if context["invited_room"]:
+            room = self.invited_rooms.get(room_id) or MatrixInvitedRoom(room_id, self.user)
+            self.invited_rooms[room_id] = room
+        else:
+            room = self.rooms.get(room_id) or MatrixRoom(room_id, self.user)
+            self.rooms[room_id] = room
+            self.invited_rooms.pop(room_id, None)
+
+        room.name = context["name"]
+        room.canonical_alias = context["canonical_alias"]
+        room.creator = context["creator"]
+        room.encrypted = context["encrypted"]
+        room.users = {}
+        room.invited_users = {}
+        room.names = defaultdict(list)
+        invited = set(context["invited"])
+        for user_id in context["members"]:
+            room.add_member(user_id, None, None, invited=user_id in invited)
+        room.members_synced = True
+        if room.canonical_alias:
+            self.aliases[room.canonical_alias] = room_id
+        return room
+
+    def remember_event(self, source: Dict[str, Any]):
+        self.events[source.get("event_id")] = source
+        if len(self.events) > EVENT_CACHE_SIZE:
+            self.events.popitem(last=False)
+
+    def answer(self, method: str, path: str) -> Tuple[int, Any]:
+        path = API_PREFIX.sub("", path.split("?", 1)[0])
+        for name, route_method, pattern in ROUTES:
+            match = pattern.match(path) if method == route_method else None
+            if match:
+                break
+        else:
+            # Invites, kicks, receipts, to-device messages and the like have empty responses
+            self.requests[path.split("/")[1] if "/" in path else path] += 1
+            return 200, {}
+
+        self.requests[name] += 1
+        params = {key: urllib.parse.unquote(value) for key, value in match.groupdict().items() if value}
+        if name in ("send", "put_state", "redact"):
+            event_type = "m.room.redaction" if name == "redact" else params["event_type"]
+            event_id = self.index.event_id(params["room_id"], event_type) or self._generated_id("$")
+            return 200, {"event_id": event_id}
+        if name == "create_room":
+            return 200, {"room_id": self.index.room_id() or self._generated_id("!")}
+        if name == "join":
+            room_id = self.aliases.get(params["room_id"], params["room_id"])
+            return 200, {"room_id": room_id}
+        if name == "resolve_alias":
+            room_id = self.aliases.get(params["alias"])
+            if not room_id:
+                return _not_found("Room alias not found")
+            return 200, {"room_id": room_id, "servers": [self.server_name]}
+        if name == "get_event":
+            source = self.events.get(params["event_id"])
+            if not source:
+                return _not_found("Event not found")
+            return 200, dict(source, room_id=params["room_id"])
+        if name == "joined_members":
+            room = self.rooms.get(params["room_id"])
+            members = [user_id for user_id in room.users if user_id not in room.invited_users] if room else []
+            return 200, {"joined": {user_id: {"display_name": user_id, "avatar_url": None} for user_id in members}}
+        if name == "get_state":
+            return 200, []
+        if name == "keys_query":
+            return 200, {"device_keys": {}, "failures": {}}
+        if name == "keys_claim":
+            return 200, {"one_time_keys": {}, "failures": {}}
+        return 200, {"one_time_key_counts": {}}
+
+    async def send(self, method: str, path: str, *args, **kwargs) -> LocalResponse:
+        return LocalResponse(*self.answer(method, path))
+
+    async def close(self):
+        pass
+
+
+class Replay(object):
+    def __init__(self, args: argparse.Namespace):
+        """The bot set up as main does, with the ReplayClient instead of a synced client."""
+        self.args = args
+        self.config = Config(args.config)
+        if args.database:
+            self.config.database = _database_config(args.database)
+        # Events are handled no matter how long ago they were received
+        self.config.ignore_old_messages = False
+
+        self.store = Storage(self.config.database)
+        self.store.set_repositories(Repositories(self.store))
+        RoomClassifier.load(self.store)
+
+        self.index = JournalIndex([self.config.user_id] + self.config.sender_pool_user_ids)
+        self.index.scan(read_journal(args.journal))
+
+        client_config = AsyncClientConfig(max_limit_exceeded=0, max_timeouts=0, encryption_enabled=False)
+        self.client = ReplayClient(
+            self.config.homeserver_url,
+            self.config.user_id,
+            device_id=self.config.device_id,
+            store_path=self.config.store_path,
+            config=client_config,
+            index=self.index,
+        )
+        self.client.access_token = "replay"
+        self.client.user_id = self.config.user_id
+        for context in self.index.known_rooms():
+            self.client.apply_room_context(context)
+        if self.config.management_room_id is None:
+            self.config.management_room_id = self.client.aliases.get(self.config.management_room)
+
+        self.callbacks = Callbacks(self.client, self.store, self.config)
+        self.callbacks.synced = True
+        register_callbacks(self.client, self.callbacks)
+        self.client.callbacks = self.callbacks
+        self.client.watchdog = None
+        self.client.profiler = Profiler(self.config)
+        self.client.memory_monitor = MemoryMonitor(self.client, self.config)
+        self.client.sender_pool = SenderPool(self.client, self.store, self.config, client_config)
+
+        self.events = 0
+        self.errors = 0
+
+    def _parse(self, record: Dict[str, Any]):
+        if record["type"] == "invite":
+            return InviteEvent.parse_event(record["event"])
+        event = Event.parse_event(record["event"])
+        if isinstance(event, MegolmEvent):
+            event.room_id = record["room_id"]
+        return event
+
+    async def feed(self, record: Dict[str, Any]):
+        if record["type"] == "room":
+            self.client.apply_room_context(record)
+            return
+        if record["type"] not in ("event", "invite"):
+            return
+
+        rooms = self.client.invited_rooms if record["type"] == "invite" else self.client.rooms
+        room = rooms.get(record["room_id"])
+        event = self._parse(record)
+        if room is None or event is None:
+            logger.warning(f"Skipping event of room {record['room_id']} without a room context")
+            return
+        self.client.remember_event(record["event"])
+        self.events += 1
+        for callback in self.client.event_callbacks:
+            try:
+                await callback.execute(event, room)
+            except Exception as e:
+                # A sync would stop here, the replay goes on to show every failure
+                self.errors += 1
+                logger.exception(f"Handling {record['event'].get('event_id')} failed: {e}")
+
+    async def run(self) -> Dict[str, Any]:
+        queries_before = _total_queries()
+        metrics.QUERY_PATHS.reset()
+        start = time.perf_counter()
+        for record in read_journal(self.args.journal):
+            if self.args.limit and self.events >= self.args.limit:
+                break
+            await self.feed(record)
+
+        # Tasks the handlers started, e.g. shared group sessions
+        pending = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        if pending:
+            await asyncio.wait(pending, timeout=self.args.drain_timeout)
+        duration = time.perf_counter() - start
+
+        queries = _total_queries() - queries_before
+        return {
+            "events": self.events,
+            "errors": self.errors,
+            "duration_s": round(duration, 3),
+            "events_per_s": round(self.events / duration, 1) if duration else None,
+            "queries_per_event": round(queries / self.events, 2) if self.events else None,
+            "queries_per_path": metrics.QUERY_PATHS.report(),
+            "requests": dict(self.client.requests.most_common()),
+        }
+
+    def close(self):
+        self.store.conn.close()
+
+
+def _database_config(url: str) -> Dict[str, str]:
+    if url.startswith("sqlite://"):
+        return {"type": "sqlite", "connection_string": url[len("sqlite://"):]}
+    if url.startswith("postgres://"):
+        return {"type": "postgres", "connection_string": url}
+    raise ValueError(f"Invalid database URL '{url}', expected sqlite:// or postgres://")
+
+
+def _total_queries() -> int:
+    return sum(totals[1] for _, totals in metrics.DB_QUERY_LATENCY.values.values())
+
+
+def format_results(results: Dict[str, Any]) -> str:
+    requests = ", ".join(f"{name} {count}" for name, count in results["requests"].items()) or "none"
+    return "\n".join([
+        f"Replayed {results['events']} events in {results['duration_s']:.2f}s, {results['errors']} failed",
+        f"  {results['events_per_s'] or 0:.1f} events/s, {results['queries_per_event'] or 0:.2f} DB queries per event",
+        f"  requests answered: {requests}",
+    ])
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("config", help="Config file of the bot")
+    parser.add_argument("journal", help="Journal file, its rotated backups are replayed first")
+    parser.add_argument(
+        "--database", default=None,
+        help="sqlite://<path> or postgres://<connection string> to replay into instead of the configured database",
+    )
+    parser.add_argument("--limit", type=int, default=0, help="Stop after this many events")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="Seconds to wait for tasks left running")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    return parser.parse_args(argv)
+
+
+async def _main(args: argparse.Namespace) -> Dict[str, Any]:
+    replay = Replay(args)
+    try:
+        return await replay.run()
+    finally:
+        replay.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    args = parse_args(argv)
+    results = asyncio.run(_main(args))
+    print(json.dumps(results) if args.json else format_results(results))
+    sys.exit(1 if results["errors"] else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import os
+from collections import Counter
+from dataclasses import replace
+from typing import Dict, List, Optional
+
+# noinspection PyPackageRequirements
+from aiohttp import ClientConnectionError, ServerDisconnectedError
+# noinspection PyPackageRequirements
+from nio import AsyncClient, AsyncClientConfig, InviteMemberEvent, JoinError, LoginError, MatrixRoom
+# noinspection PyPackageRequirements
+from nio.store import DefaultStore
+
+from feedback_bot.client import PooledAsyncClient
+from feedback_bot.config import Config
+from feedback_bot.storage import Storage
+from feedback_bot.utils import sleep_ms, with_ratelimit
+
+logger = logging.getLogger(__name__)
+
+
+class SenderPool(object):
+    def __init__(self, client: AsyncClient, store: Storage, config: Config, client_config: AsyncClientConfig):
+        """Pool of secondary bot accounts that share the outbound traffic of the main account.
+
+        Every account has its own rate limit budget. A secondary account is invited to each new Ticket
+        and Chat room and kept in the RoomSenders table as the room's sender, which sends messages to the
+        room once it has joined. Until then, and in rooms without one, the main account sends.
+
+        Args:
+            client (nio.AsyncClient): The main bot client, which receives and handles all events
+
+            store (Storage): Bot storage
+
+            config (Config): Bot configuration parameters
+
+            client_config (nio.AsyncClientConfig): Configuration for the secondary clients
+        """
+        self.client = client
+        self.store = store
+        self.config = config
+        self.client_config = client_config
+        self.senders: List[AsyncClient] = []
+        # room_id -> user ID of the secondary account sending to it
+        self.room_senders: Dict[str, str] = {}
+        self.sync_tasks: List[asyncio.Future] = []
+        self.started = False
+
+    async def start(self):
+        """Log in the secondary accounts and keep their room state and encryption keys synced."""
+        self.started = True
+        self.room_senders = self.store.repositories.roomSenderRep.get_room_senders()
+        for account in self.config.sender_pool:
+            sender = await self._login(account)
+            if not sender:
+                continue
+            self.senders.append(sender)
+            self.sync_tasks.append(asyncio.ensure_future(self._sync_forever(sender)))
+            logger.info(f"Sender pool account {sender.user_id} logged in")
+
+    async def _login(self, account: Dict[str, str]) -> Optional[AsyncClient]:
+        store_path = os.path.join(self.config.store_path, account["user_id"].split(":")[0][1:])
+        if not os.path.isdir(store_path):
+            os.mkdir(store_path)
+
+        # nio's crypto tables key Megolm sessions by session ID alone, so accounts in the same rooms
+        # can't share a database crypto store - secondary accounts keep theirs in files
+        client_config = replace(self.client_config, store=DefaultStore)
+
+        sender = PooledAsyncClient(
+            self.config.homeserver_url,
+            account["user_id"],
+            device_id=account["device_id"],
+            store_path=store_path,
+            config=client_config,
+            sync_pool=self.config.sync_pool,
+            outbound_pool=self.config.outbound_pool,
+        )
+
+        if account.get("user_token"):
+            sender.access_token = account["user_token"]
+            sender.user_id = account["user_id"]
+            sender.load_store()
+            if sender.should_upload_keys:
+                await sender.keys_upload()
+        else:
+            response = await with_ratelimit(sender.login)(
+                password=account["user_password"], device_name=account["device_name"],
+            )
+            if isinstance(response, LoginError):
+                logger.error(f"Failed to login sender pool account {account['user_id']}: {response.message}")
+                await sender.close()
+                return None
+
+        async def on_invite(room: MatrixRoom, event: InviteMemberEvent):
+            # Only join rooms the main account invited us to
+            if event.state_key != sender.user_id or event.sender != self.client.user_id:
+                return
+            result = await with_ratelimit(sender.join)(room.room_id)
+            if isinstance(result, JoinError):
+                logger.error(f"Sender pool account {sender.user_id} was unable to join room {room.room_id}")
+            else:
+                logger.info(f"Sender pool account {sender.user_id} joined {room.room_id}")
+
+        # noinspection PyTypeChecker
+        sender.add_event_callback(on_invite, (InviteMemberEvent,))
+        return sender
+
+    @staticmethod
+    async def _sync_forever(sender: AsyncClient):
+        # Keep trying to reconnect on failure (with some time in-between)
+        while True:
+            try:
+                await sender.sync_forever(timeout=30000, full_state=True)
+            except (ClientConnectionError, ServerDisconnectedError):
+                logger.warning(f"Sender pool account {sender.user_id} unable to connect to homeserver, retrying in 15s...")
+                await sleep_ms(15000)
+
+    def get_account(self, user_id: str) -> Optional[AsyncClient]:
+        """Get the main or a logged in secondary account by its user ID."""
+        if user_id == self.client.user_id:
+            return self.client
+        for sender in self.senders:
+            if sender.user_id == user_id:
+                return sender
+        return None
+
+    def get_sender(self, room_id: str) -> AsyncClient:
+        """Get the account that sends to a room, its secondary account once joined, otherwise the main one."""
+        sender_id = self.room_senders.get(room_id)
+        sender = self.get_account(sender_id) if sender_id else None
+        if sender and room_id in sender.rooms:
+            return sender
+        return self.client
+
+    def set_room_sender(self, room_id: str, sender: AsyncClient):
+        """Make a secondary account the sender of a new room it was invited to."""
+        self.room_senders[room_id] = sender.user_id
+        self.store.repositories.roomSenderRep.put_room_sender(room_id, sender.user_id)
+
+    def pick_new_room_sender(self) -> Optional[AsyncClient]:
+        """Get the secondary account to invite to a new room, the one sending to the fewest rooms."""
+        if not self.senders:
+            return None
+        room_counts = Counter(self.room_senders.values())
+        return min(self.senders, key=lambda sender: room_counts[sender.user_id])
+
+    async def close(self):
+        for task in self.sync_tasks:
+            task.cancel()
+        for sender in self.senders:
+            await sender.close()
+        self.sync_tasks = []
+        self.senders = []
+        self.started = False
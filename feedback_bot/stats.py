@@ -0,0 +1,111 @@
+import time
+from typing import List, Optional
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient
+
+from feedback_bot import metrics
+from feedback_bot.models.Chat import Chat
+from feedback_bot.models.RoomClassifier import RoomClassifier
+from feedback_bot.models.Ticket import Ticket
+from feedback_bot.utils import alias_cache
+
+RATE_WINDOWS_S = (60, 5 * 60, 15 * 60)
+# Window for database queries per event
+QUERIES_WINDOW_S = 5 * 60
+# Code paths with the most database queries per event shown
+QUERY_PATHS_SHOWN = 5
+# Repository methods taking the most database time shown
+DB_METHODS_SHOWN = 5
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(seconds)
+    days, seconds = divmod(seconds, 24 * 60 * 60)
+    hours, seconds = divmod(seconds, 60 * 60)
+    minutes, seconds = divmod(seconds, 60)
+    if days:
+        return f"{days}d {hours}h {minutes}m"
+    if hours:
+        return f"{hours}h {minutes}m"
+    return f"{minutes}m {seconds}s"
+
+
+def _format_latency(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.2f}s"
+
+
+def _cache_line(name: str, cache: str, size: Optional[int]) -> str:
+    hits = metrics.CACHE_HITS.get(cache=cache)
+    misses = metrics.CACHE_MISSES.get(cache=cache)
+    lookups = hits + misses
+    if size is None:
+        return f"  - {name}: not cached, {lookups:.0f} lookups"
+    hit_rate = f"{hits / lookups:.1%}" if lookups else "-"
+    return f"  - {name}: {size} entries, hit rate {hit_rate} of {lookups:.0f} lookups"
+
+
+def build_stats_report(client: AsyncClient) -> str:
+    """Compact runtime report for the stats command."""
+    now = time.time()
+    lines: List[str] = [
+        "**Runtime stats**",
+        "",
+        f"- Uptime: {format_duration(now - metrics.PROCESS_START_TIME.get())}",
+    ]
+
+    rates = " / ".join(f"{metrics.EVENT_RATE.rate(window):.2f}" for window in RATE_WINDOWS_S)
+    lines.append(f"- Events/s (1m / 5m / 15m): {rates}")
+
+    p50, p95, p99 = metrics.RECENT_RELAY_LATENCY.quantiles((0.5, 0.95, 0.99))
+    lines.append(
+        f"- Relay latency p50 / p95 / p99: {_format_latency(p50)} / {_format_latency(p95)} / {_format_latency(p99)} "
+        f"(last {len(metrics.RECENT_RELAY_LATENCY.values)} relays)"
+    )
+
+    rooms_pending = client.callbacks.rooms_pending
+    pending_tasks = sum(len(tasks) for tasks in rooms_pending.values())
+    pending_rooms = sum(1 for tasks in rooms_pending.values() if tasks)
+    waiting_for_keys = sum(client.callbacks.encrypted_backlog.user_counts.values())
+    lines.append(
+        f"- Queues: {pending_tasks} events pending in {pending_rooms} rooms, {waiting_for_keys} events waiting for room keys"
+    )
+
+    lines.append("- Caches:")
+    lines.append(_cache_line("Ticket", "ticket", len(Ticket.ticket_cache)))
+    lines.append(_cache_line("Chat", "chat", len(Chat.chat_cache)))
+    lines.append(_cache_line("Room classification", "room_classifier", len(RoomClassifier.room_cache)))
+    lines.append(_cache_line("Room alias", "alias", len(alias_cache)))
+    lines.append(_cache_line("User", "user", None))
+
+    events = metrics.EVENT_RATE.rate(QUERIES_WINDOW_S) * QUERIES_WINDOW_S
+    queries = metrics.DB_QUERY_RATE.rate(QUERIES_WINDOW_S) * QUERIES_WINDOW_S
+    per_event = f"{queries / events:.1f}" if events else "-"
+    lines.append(f"- DB queries per event (5m): {per_event} ({queries:.0f} queries, {events:.0f} events)")
+    paths = sorted(metrics.QUERY_PATHS.report().items(), key=lambda item: -item[1]["mean"])[:QUERY_PATHS_SHOWN]
+    for name, path in paths:
+        lines.append(f"  - `{name}`: {path['mean']:.1f} per event, max {path['max']} ({path['events']} events)")
+
+    methods = sorted(
+        ((key[0], totals) for key, (_, totals) in metrics.DB_QUERY_LATENCY.values.items()), key=lambda item: -item[1][0],
+    )[:DB_METHODS_SHOWN]
+    if methods:
+        slow = sum(metrics.DB_SLOW_QUERIES.values.values())
+        lines.append(f"- DB time per method, {slow:.0f} slow queries:")
+        for method, (seconds, count) in methods:
+            lines.append(f"  - `{method}`: {seconds:.2f}s in {count} queries, {seconds / count * 1000:.2f}ms each")
+
+    accounts = [client] + list(client.sender_pool.senders)
+    backoffs = []
+    for account in accounts:
+        remaining = getattr(account, "rate_limited_until", 0) - time.monotonic()
+        if remaining > 0:
+            backoffs.append(f"{account.user_id} {remaining:.1f}s")
+    lines.append(f"- Rate limit backoff: {', '.join(backoffs) if backoffs else 'none'}")
+
+    if client.watchdog:
+        lines.append("- Event loop blocked most often in:")
+        for location, episodes, longest in client.watchdog.top_locations():
+            lines.append(f"  - `{location}` {episodes} times, longest {longest:.2f}s")
+
+    return "\n".join(lines)
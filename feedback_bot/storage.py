@@ -1,14 +1,20 @@
 from __future__ import annotations
 from typing import TYPE_CHECKING
 
+import functools
 import importlib
 import json
 import logging
-from dataclasses import asdict
-from typing import Optional, List
+import re
+import time
+import zlib
+from typing import Any, Iterator, Optional, List, Sequence
 # noinspection PyPackageRequirements
 from nio import MegolmEvent
 
+from feedback_bot.metrics import DB_SLOW_QUERIES, caller_name, count_rows, observe_query
+from feedback_bot.tracing import span
+
 if TYPE_CHECKING:
     from feedback_bot.models.Repositories.Repositories import Repositories
 
@@ -20,9 +26,98 @@ if TYPE_CHECKING:
 #
 # When a migration is performed, the `migration_version` table should be incremented.
 
-latest_migration_version = 11
+latest_migration_version = 18
+
+# Rows fetched at a time when streaming stored encrypted events
+ENCRYPTED_EVENTS_BATCH_SIZE = 100
+
+# Values bound per IN (...) list, below SQLite's bound parameter limit of 999
+IN_LIST_BATCH_SIZE = 500
 
 logger = logging.getLogger(__name__)
+# Statements slower than storage.slow_query_ms, with their parameters redacted
+slow_query_logger = logger.getChild("slow_queries")
+
+DEFAULT_SLOW_QUERY_MS = 100
+# Characters of a statement shown in the slow query log
+SLOW_QUERY_MAX_LENGTH = 500
+
+_STATEMENT_TABLE = re.compile(
+    r"\b(?:FROM|INTO|UPDATE|TABLE|ON)\s+(?:IF\s+(?:NOT\s+)?EXISTS\s+)?[`\"]?(\w+)", re.IGNORECASE,
+)
+_WHITESPACE = re.compile(r"\s+")
+
+
+@functools.lru_cache(maxsize=1024)
+def statement_name(query: str) -> str:
+    """Short name of a statement for metric labels: its verb and first table, e.g. "SELECT users"."""
+    words = query.split(None, 1)
+    if not words:
+        return ""
+    verb = words[0].upper()
+    table = _STATEMENT_TABLE.search(query)
+    return f"{verb} {table.group(1).lower()}" if table else verb
+
+
+def redact_params(params: Sequence[Any]) -> str:
+    """Parameters of a statement by type and size only, as they hold user IDs and message content."""
+    redacted = []
+    for value in params:
+        if value is None:
+            redacted.append("NULL")
+        elif isinstance(value, (str, bytes)):
+            redacted.append(f"<{type(value).__name__}:{len(value)}>")
+        else:
+            redacted.append(f"<{type(value).__name__}>")
+    return f"({', '.join(redacted)})"
+
+
+def is_database_unavailable(error: BaseException) -> bool:
+    """Whether an error means the database could not be reached or used, rather than a statement failing.
+
+    Covers the bot storage drivers and peewee, which wraps them for the crypto store.
+    """
+    import sqlite3
+    # noinspection PyPackageRequirements
+    import peewee
+
+    errors = (sqlite3.OperationalError, sqlite3.InterfaceError, peewee.OperationalError, peewee.InterfaceError)
+    try:
+        # noinspection PyUnresolvedReferences
+        import psycopg2
+        errors += (psycopg2.OperationalError, psycopg2.InterfaceError)
+    except ImportError:
+        pass
+    return isinstance(error, errors)
+
+
+class RowCountingCursor(object):
+    def __init__(self, cursor):
+        """Cursor counting the rows fetched after each statement towards the method that ran it."""
+        self.cursor = cursor
+        self.labels = ("", "")
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            count_rows(*self.labels, 1)
+        return row
+
+    def fetchmany(self, *args):
+        rows = self.cursor.fetchmany(*args)
+        count_rows(*self.labels, len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        count_rows(*self.labels, len(rows))
+        return rows
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
 
 
 class Storage(object):
@@ -37,12 +132,14 @@ class Storage(object):
                 * type: A string, one of "sqlite" or "postgres"
                 * connection_string: A string, featuring a connection string that
                     be fed to each respective db library's `connect` method
+                * slow_query_ms: Optional, statements taking longer are logged. 0 disables the log
         """
         self.conn = self._get_database_connection(
             database_config["type"], database_config["connection_string"]
         )
-        self.cursor = self.conn.cursor()
+        self.cursor = RowCountingCursor(self.conn.cursor())
         self.db_type = database_config["type"]
+        self.slow_query_s = database_config.get("slow_query_ms", DEFAULT_SLOW_QUERY_MS) / 1000
 
         # Try to check the current migration version
         migration_level = 0
@@ -136,42 +233,84 @@ class Storage(object):
     def _execute(self, *args):
         """A wrapper around cursor.execute that transforms placeholder ?'s to %s for postgres
         """
+        method = caller_name()
+        start = time.perf_counter()
+        with span("db", method=method):
+            if self.db_type == "postgres":
+                self.cursor.execute(args[0].replace("?", "%s"), *args[1:])
+            else:
+                self.cursor.execute(*args)
+        self._observe(method, args[0], args[1] if len(args) > 1 else (), time.perf_counter() - start)
+
+    def _executemany(self, query: str, rows: List[tuple]):
+        """A wrapper around cursor.executemany, the batched counterpart of _execute
+        """
+        method = caller_name()
+        start = time.perf_counter()
+        with span("db", method=method, rows=len(rows)):
+            if self.db_type == "postgres":
+                self.cursor.executemany(query.replace("?", "%s"), rows)
+            else:
+                self.cursor.executemany(query, rows)
+        self._observe(method, query, rows[0] if rows else (), time.perf_counter() - start, len(rows))
+
+    def _observe(self, method: str, query: str, params: Sequence[Any], seconds: float, batch: int = 0):
+        """Record the latency and rows of a statement, logging it if slow."""
+        statement = statement_name(query)
+        observe_query(method, seconds, statement)
+        self.cursor.labels = (method, statement)
+        # Rows written are known now, rows read when fetched. Postgres counts rows read here too.
+        written = self.cursor.rowcount if not statement.startswith(("SELECT", "WITH")) else -1
+        if written > 0:
+            count_rows(method, statement, written)
+
+        if self.slow_query_s and seconds >= self.slow_query_s:
+            DB_SLOW_QUERIES.inc(method=method)
+            text = _WHITESPACE.sub(" ", query).strip()[:SLOW_QUERY_MAX_LENGTH]
+            details = f", {written} rows written" if written >= 0 else ""
+            if batch:
+                details += f", batch of {batch} like {redact_params(params)}"
+            elif params:
+                details += f", params {redact_params(params)}"
+            slow_query_logger.warning(f"Slow query in {method} took {seconds * 1000:.1f}ms{details}: {text}")
+
+    def iter_encrypted_events(self, session_id: str) -> Iterator[MegolmEvent]:
+        """Stream the stored events of a session in server timestamp order, decoding them one at a time.
+        """
+        # A separate cursor, so other queries can run while the events are consumed
+        cursor = self.conn.cursor()
+        query = """
+            select event_id, source from encrypted_events where session_id = ? order by server_timestamp;
+        """
         if self.db_type == "postgres":
-            self.cursor.execute(args[0].replace("?", "%s"), *args[1:])
+            cursor.execute(query.replace("?", "%s"), (session_id,))
         else:
-            self.cursor.execute(*args)
+            cursor.execute(query, (session_id,))
+        try:
+            while True:
+                rows = cursor.fetchmany(ENCRYPTED_EVENTS_BATCH_SIZE)
+                if not rows:
+                    break
+                for event_id, source in rows:
+                    try:
+                        params = json.loads(zlib.decompress(source))
+                        event = MegolmEvent.from_dict(params)
+                        event.room_id = params["room_id"]
+                    except Exception as ex:
+                        logger.warning("Failed to restore MegolmEvent for %s: %s", event_id, ex)
+                        continue
+                    if isinstance(event, MegolmEvent):
+                        yield event
+                    else:
+                        logger.warning("Failed to restore MegolmEvent for %s: %s", event_id, event)
+        finally:
+            cursor.close()
 
-    def get_encrypted_events(self, session_id: str) -> List:
+    def get_encrypted_event_counts(self) -> List:
         self._execute("""
-            select id, device_id, room_id, session_id, event, user_id from encrypted_events where session_id = ?;
-        """, (session_id,))
-        events = self.cursor.fetchall()
-        return [
-            {
-                "id": row[0],
-                "device_id": row[1],
-                "room_id": row[2],
-                "session_id": row[3],
-                "event": row[4],
-                "user_id": row[5],
-            } for row in events
-        ]
-
-    def get_encrypted_events_for_user(self, user_id: str) -> List:
-        self._execute("""
-            select id, device_id, room_id, session_id, event, user_id from encrypted_events where user_id = ?;
-        """, (user_id,))
-        events = self.cursor.fetchall()
-        return [
-            {
-                "id": row[0],
-                "device_id": row[1],
-                "room_id": row[2],
-                "session_id": row[3],
-                "event": row[4],
-                "user_id": row[5],
-            } for row in events
-        ]
+            select user_id, session_id, count(*) from encrypted_events group by user_id, session_id;
+        """)
+        return self.cursor.fetchall()
 
     def get_message_by_management_event_id(self, management_event_id: str) -> Optional[dict]:
         self._execute("SELECT room_id, event_id FROM messages where management_event_id = ?", (management_event_id,))
@@ -182,22 +321,31 @@ class Storage(object):
                 "event_id": row[1],
             }
 
-    def remove_encrypted_event(self, event_id: str):
-        self._execute("""
+    def remove_encrypted_events(self, event_ids: List[str]):
+        self._executemany("""
             delete from encrypted_events where event_id = ?;
-        """, (event_id,))
+        """, [(event_id,) for event_id in event_ids])
+
+    def remove_encrypted_events_of_session(self, session_id: str):
+        self._execute("""
+            delete from encrypted_events where session_id = ?;
+        """, (session_id,))
 
-    def store_encrypted_event(self, event: MegolmEvent):
+    def store_encrypted_event(self, event: MegolmEvent) -> bool:
         try:
-            event_dict = asdict(event)
-            event_json = json.dumps(event_dict)
+            source = dict(event.source, room_id=event.room_id)
             self._execute("""
                 insert into encrypted_events
-                    (device_id, event_id, room_id, session_id, event, user_id) values
-                    (?, ?, ?, ?, ?, ?)
-            """, (event.device_id, event.event_id, event.room_id, event.session_id, event_json, event.sender))
+                    (device_id, event_id, room_id, session_id, user_id, server_timestamp, source) values
+                    (?, ?, ?, ?, ?, ?, ?)
+            """, (
+                event.device_id, event.event_id, event.room_id, event.session_id, event.sender,
+                event.server_timestamp, zlib.compress(json.dumps(source).encode()),
+            ))
+            return True
         except Exception as ex:
             logger.error("Failed to store encrypted event %s: %s" % (event.event_id, ex))
+            return False
 
     def store_message(self, event_id: str, management_event_id: str, room_id: str):
         self._execute("""
@@ -0,0 +1,101 @@
+import asyncio
+import logging
+from typing import List, Optional
+
+# noinspection PyPackageRequirements
+from nio import AsyncClient, RoomCreateResponse, RoomInviteResponse, RoomPutStateError
+
+from feedback_bot.chat_functions import create_room, invite_to_room
+from feedback_bot.config import Config
+from feedback_bot.storage import Storage
+from feedback_bot.utils import sleep_ms, with_ratelimit
+
+logger = logging.getLogger(__name__)
+
+SPARE_ROOM_NAME = "Spare Ticket room"
+
+
+class TicketRoomPool(object):
+    def __init__(self, client: AsyncClient, store: Storage, config: Config):
+        """Pool of pre-created spare rooms, so raising a Ticket does not wait for room creation.
+
+        Spare room IDs are kept in the SpareRooms table and the pool is refilled in the background.
+
+        Args:
+            client (nio.AsyncClient): nio client used to interact with matrix
+
+            store (Storage): Bot storage
+
+            config (Config): Bot configuration parameters
+        """
+        self.client = client
+        self.store = store
+        self.config = config
+        self.refill_needed = asyncio.Event()
+        self.refill_task: Optional[asyncio.Future] = None
+        self.started = False
+
+    def start(self):
+        self.started = True
+        self.refill_needed.set()
+        self.refill_task = asyncio.ensure_future(self._refill_forever())
+
+    async def _refill_forever(self):
+        while True:
+            await self.refill_needed.wait()
+            self.refill_needed.clear()
+            try:
+                await self.refill()
+            except Exception as e:
+                logger.error(f"Failed to refill spare Ticket rooms: {e}")
+                # Try again later
+                await sleep_ms(60000)
+                self.refill_needed.set()
+
+    async def refill(self):
+        spare_rooms = self.store.repositories.spareRoomRep.get_spare_rooms()
+        for _ in range(self.config.ticket_room_pool_size - len(spare_rooms)):
+            response = await create_room(
+                self.client, SPARE_ROOM_NAME, encrypted=self.config.ticket_room_pool_encrypted,
+            )
+            if not isinstance(response, RoomCreateResponse):
+                raise RuntimeError(f"Room creation failed: {response}")
+            self.store.repositories.spareRoomRep.put_spare_room(response.room_id)
+            logger.debug(f"Created spare Ticket room {response.room_id}")
+
+    async def take(self, room_name: str, invite: List[str]) -> Optional[str]:
+        """Take a spare room, rename it and invite users to it.
+
+        Returns the room ID, or None if no spare room is ready.
+        """
+        room_id = None
+        for spare_room_id in self.store.repositories.spareRoomRep.get_spare_rooms():
+            # Rooms created since the last sync are not usable yet
+            if spare_room_id in self.client.rooms:
+                room_id = spare_room_id
+                break
+        if not room_id:
+            logger.info("No spare Ticket room is ready")
+            self.refill_needed.set()
+            return None
+
+        # Claimed before renaming, so a concurrent take can't pick the same room
+        self.store.repositories.spareRoomRep.delete_spare_room(room_id)
+
+        response = await with_ratelimit(self.client.room_put_state)(room_id, "m.room.name", {"name": room_name})
+        if isinstance(response, RoomPutStateError):
+            logger.warning(f"Failed to rename spare Ticket room {room_id}: {response.message}")
+            # Keep the room in the pool rather than leaving it joined and unused
+            self.store.repositories.spareRoomRep.put_spare_room(room_id)
+            return None
+        self.refill_needed.set()
+
+        failed_invites = []
+        for user_id in invite:
+            if not isinstance(await invite_to_room(self.client, user_id, room_id), RoomInviteResponse):
+                failed_invites.append(user_id)
+        if failed_invites:
+            logger.warning(f"Failed to invite {', '.join(failed_invites)} to Ticket room {room_id}")
+
+        logger.debug(f"Took spare Ticket room {room_id} for {room_name}")
+        return room_id
@@ -0,0 +1,263 @@
+import asyncio
+import contextvars
+import functools
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+# noinspection PyPackageRequirements
+from aiohttp import ClientError, ClientSession, ClientTimeout
+
+logger = logging.getLogger(__name__)
+
+# Traces waiting for the OTLP collector, older ones are dropped beyond this
+OTLP_QUEUE_SIZE = 1000
+OTLP_FLUSH_INTERVAL_S = 5
+OTLP_TIMEOUT_S = 10
+
+
+class Trace(object):
+    __slots__ = ("event_id", "trace_id", "spans")
+
+    def __init__(self, event_id: str):
+        self.event_id = event_id
+        # Derived from the event ID, so all spans of an event share a trace across restarts and replays
+        self.trace_id = hashlib.md5(event_id.encode()).hexdigest()
+        self.spans: List["Span"] = []
+
+
+class Span(object):
+    __slots__ = ("trace", "name", "span_id", "parent_id", "attributes", "start_ns", "end_ns", "error", "_token")
+
+    def __init__(self, trace: Trace, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = 0
+        self.end_ns = 0
+        self.error: Optional[str] = None
+        self._token = None
+
+    def __enter__(self):
+        self.start_ns = time.time_ns()
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.end_ns = time.time_ns()
+        current_span.reset(self._token)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.trace.spans.append(self)
+        return False
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.trace.trace_id,
+            "event_id": self.trace.event_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_ns / 1e9,
+            "duration_ms": (self.end_ns - self.start_ns) / 1e6,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class _NoopSpan(object):
+    """Stands in for a span outside of sampled traces, so instrumentation costs a context lookup."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+current_span: contextvars.ContextVar = contextvars.ContextVar("current_span", default=None)
+
+
+def span(name: str, **attributes):
+    """Child span of the current span, or a no-op if the event being handled is not traced.
+
+    Usage: `with span("commonmark"): ...`
+    """
+    parent = current_span.get()
+    if parent is None:
+        return NOOP_SPAN
+    return Span(parent.trace, name, parent.span_id, attributes)
+
+
+def traced(name: str):
+    """Decorator running a function, or coroutine function, in a span."""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+class JsonlExporter(object):
+    def __init__(self, path: str, max_bytes: int, backup_count: int):
+        """Write one JSON object per span to a size-rotated file."""
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self.span_logger = logging.getLogger(f"{__name__}.spans")
+        self.span_logger.propagate = False
+        self.span_logger.setLevel(logging.INFO)
+        self.span_logger.addHandler(handler)
+
+    def export(self, trace: Trace):
+        for finished_span in trace.spans:
+            self.span_logger.info(json.dumps(finished_span.to_dict(), default=str))
+
+
+class OtlpExporter(object):
+    def __init__(self, endpoint: str, service_name: str = "feedback-bot"):
+        """Send traces to an OpenTelemetry collector with OTLP/HTTP JSON, batched in the background."""
+        self.endpoint = endpoint
+        self.service_name = service_name
+        self.queue: List[Trace] = []
+        self.task: Optional[asyncio.Future] = None
+
+    @staticmethod
+    def _attributes(attributes: Dict[str, Any]) -> List[Dict[str, Any]]:
+        values = []
+        for key, value in attributes.items():
+            if isinstance(value, bool):
+                values.append({"key": key, "value": {"boolValue": value}})
+            elif isinstance(value, int):
+                values.append({"key": key, "value": {"intValue": str(value)}})
+            elif isinstance(value, float):
+                values.append({"key": key, "value": {"doubleValue": value}})
+            else:
+                values.append({"key": key, "value": {"stringValue": str(value)}})
+        return values
+
+    def _otlp_span(self, finished_span: Span) -> Dict[str, Any]:
+        otlp_span = {
+            "traceId": finished_span.trace.trace_id,
+            "spanId": finished_span.span_id,
+            "name": finished_span.name,
+            # SPAN_KIND_INTERNAL
+            "kind": 1,
+            "startTimeUnixNano": str(finished_span.start_ns),
+            "endTimeUnixNano": str(finished_span.end_ns),
+            "attributes": self._attributes(dict(finished_span.attributes, event_id=finished_span.trace.event_id)),
+            # STATUS_CODE_OK / STATUS_CODE_ERROR
+            "status": {"code": 2, "message": finished_span.error} if finished_span.error else {"code": 1},
+        }
+        if finished_span.parent_id:
+            otlp_span["parentSpanId"] = finished_span.parent_id
+        return otlp_span
+
+    def export(self, trace: Trace):
+        self.queue.append(trace)
+        if len(self.queue) > OTLP_QUEUE_SIZE:
+            del self.queue[:len(self.queue) - OTLP_QUEUE_SIZE]
+        if not self.task:
+            self.task = asyncio.ensure_future(self._flush_forever())
+
+    async def _flush_forever(self):
+        async with ClientSession(timeout=ClientTimeout(total=OTLP_TIMEOUT_S)) as session:
+            while True:
+                await asyncio.sleep(OTLP_FLUSH_INTERVAL_S)
+                if not self.queue:
+                    continue
+                traces, self.queue = self.queue, []
+                body = {
+                    "resourceSpans": [{
+                        "resource": {"attributes": self._attributes({"service.name": self.service_name})},
+                        "scopeSpans": [{
+                            "scope": {"name": "feedback_bot"},
+                            "spans": [self._otlp_span(s) for trace in traces for s in trace.spans],
+                        }],
+                    }],
+                }
+                try:
+                    async with session.post(self.endpoint, json=body) as response:
+                        if response.status >= 400:
+                            logger.warning(f"OTLP collector rejected {len(traces)} traces: {response.status}")
+                except (ClientError, asyncio.TimeoutError) as e:
+                    logger.warning(f"Failed to send {len(traces)} traces to the OTLP collector: {e}")
+
+
+class Tracer(object):
+    def __init__(self, sample_rate: float, exporter):
+        """Head-sampled tracing of events, from the Callbacks entry points to the responses sent."""
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+
+    def start_trace(self, event_id: str, name: str, **attributes) -> Optional[Span]:
+        if random.random() >= self.sample_rate:
+            return None
+        return Span(Trace(event_id), name, None, attributes)
+
+    def finish_trace(self, root: Span):
+        try:
+            self.exporter.export(root.trace)
+        except Exception as e:
+            logger.warning(f"Failed to export trace of {root.trace.event_id}: {e}")
+
+
+tracer: Optional[Tracer] = None
+
+
+def configure_tracing(config):
+    """Set up the tracer from Config, tracing is off unless tracing.enabled is set."""
+    global tracer
+    if not config.tracing_enabled:
+        tracer = None
+        return
+
+    if config.tracing_exporter == "otlp":
+        exporter = OtlpExporter(config.tracing_otlp_endpoint)
+    else:
+        exporter = JsonlExporter(
+            config.tracing_jsonl_path, config.tracing_jsonl_max_bytes, config.tracing_jsonl_backup_count,
+        )
+    tracer = Tracer(config.tracing_sample_rate, exporter)
+    logger.info(f"Tracing {config.tracing_sample_rate:.1%} of events to {config.tracing_exporter}")
+
+
+def trace_event(func):
+    """Decorator for Callbacks entry points, starting the trace of a sampled event."""
+    @functools.wraps(func)
+    async def wrapper(self, room, event):
+        event_tracer = tracer
+        root = event_tracer.start_trace(event.event_id, func.__qualname__, room_id=room.room_id) if event_tracer else None
+        if root is None:
+            return await func(self, room, event)
+        try:
+            with root:
+                return await func(self, room, event)
+        finally:
+            event_tracer.finish_trace(root)
+
+    return wrapper
@@ -3,17 +3,33 @@ import logging
 import re
 import time
 
-from typing import Optional, List
+from typing import Dict, Optional, List, Tuple
 
 # noinspection PyPackageRequirements
 import nio
+
+from feedback_bot.metrics import RATELIMIT_BACKOFF, RATELIMIT_HITS, count_cache
+from feedback_bot.tracing import span
+
 logger = logging.getLogger(__name__)
 
+# Resolved room aliases are reused for this long
+ALIAS_CACHE_TTL_S = 60 * 60
+
+# alias -> (room ID, time resolved)
+alias_cache: Dict[str, Tuple[str, float]] = {}
+
 # Domain part from https://stackoverflow.com/a/106223/1489738
 USER_ID_REGEX = r"@[a-z0-9_=\/\-\.]*:(([a-zA-Z0-9]|[a-zA-Z0-9][a-zA-Z0-9\-]*[a-zA-Z0-9])\.)*([A-Za-z0-9]|[A-Za-z0-9]" \
                 r"[A-Za-z0-9\-]*[A-Za-z0-9])*"
 
-reply_regex = re.compile(r"<mx-reply><blockquote>.*</blockquote></mx-reply>(.*)", flags=re.RegexFlag.DOTALL)
+user_id_pattern = re.compile(USER_ID_REGEX, re.MULTILINE)
+# The quoted sender and first word of the first line of a plain text reply fallback,
+# e.g. "> <@bot:server> anon-id (`!room`): ..."
+reply_quote_pattern = re.compile(r"> <@([^:>]+):([^>]+)> ([^\s]+)")
+
+REPLY_OPEN = "<mx-reply>"
+REPLY_CLOSE = "</mx-reply>"
 
 
 def make_pill(user_id: str, displayname: str = None) -> str:
@@ -43,68 +59,131 @@ def get_username(user_id: str)-> str:
     match = username_pattern.match(user_id)
     if match:
         return match[1]
-def get_in_reply_to(event: nio.Event) -> Optional[str]:
-    """
-    Pulls an in reply to event ID from an event, if any.
-    """
-    return event.source.get("content", {}).get("m.relates_to", {}).get("m.in_reply_to", {}).get("event_id")
-
-
-def get_mentions(text: str) -> List[str]:
-    """
-    Get mentions in a message.
-    """
-    matches = re.finditer(USER_ID_REGEX, text, re.MULTILINE)
-    return list({match.group() for match in matches})
-
-
-def get_replaces(event: nio.Event) -> Optional[str]:
-    """
-    Get the replaces relation, if any.
-    """
-    rel_type = event.source.get("content", {}).get("m.relates_to", {}).get("rel_type")
-    if rel_type == "m.replace":
-        return event.source.get("content").get("m.relates_to").get("event_id")
-
-
-def _get_reply_msg(event: nio.Event) -> Optional[str]:
-    # first check if this is edit
-    if get_replaces(event):
-        msg_plain = event.source.get("content", {}).get("m.new_content", {}).get("body")
-        msg_formatted = event.source.get("content", {}).get("m.new_content", {}).get("formatted_body")
-    else:
-        msg_plain = event.source.get("content", {}).get("body")
-        msg_formatted = event.source.get("content", {}).get("formatted_body")
-
-    if msg_formatted and (reply_msg := reply_regex.findall(msg_formatted)):
-        return reply_msg[0]
-    elif msg_formatted:
-        return msg_formatted
-    else:
-        #revert to old method
-        message_parts = msg_plain.split('\n\n', 1)
-        if len(message_parts) > 1:
-            return '\n\n'.join(message_parts[1:])
-        return msg_plain
 
 
-def get_reply_msg(event: nio.Event, reply_to: Optional[str], replaces: Optional[str]) -> Optional[str]:
-    if reply_to or replaces:
-        if reply_section := _get_reply_msg(event):
-            if any([reply_section.startswith(x) for x in ("!reply ", "<p>!reply ")]):
-                return reply_section
-def get_raise_msg(event: nio.Event, reply_to: Optional[str], replaces: Optional[str]) -> Optional[str]:
-    if reply_to or replaces:
-        if reply_section := _get_reply_msg(event):
-            if any([reply_section.startswith(x) for x in ("!raise ", "<p>!raise ")]):
-                return reply_section
+class MessageContent(object):
+    __slots__ = (
+        "in_reply_to", "replaces", "body", "mentioned_user_ids", "reply_msg", "reply_section", "raise_section",
+        "_mentions",
+    )
+
+    def __init__(self, source: Dict):
+        """The fields of a message event the handlers read, extracted in one pass over its content.
+
+        Relations are read from m.relates_to and mentions from m.mentions, falling back to the body
+        for clients without intentional mentions. The reply fallback is stripped by its structure,
+        the leading mx-reply element or quoted lines, and only from replies and edits.
+
+        Args:
+            source (dict): The source of the event
+        """
+        content = source.get("content") or {}
+        relates_to = content.get("m.relates_to") or {}
+        self.in_reply_to: Optional[str] = (relates_to.get("m.in_reply_to") or {}).get("event_id")
+        self.replaces: Optional[str] = relates_to.get("event_id") if relates_to.get("rel_type") == "m.replace" else None
+        self.body: str = content.get("body") or ""
+        # None when the sender's client does not support intentional mentions
+        mentions = content.get("m.mentions")
+        self.mentioned_user_ids: Optional[List[str]] = \
+            list(mentions.get("user_ids") or []) if isinstance(mentions, dict) else None
+        self._mentions: Optional[List[str]] = None
+
+        self.reply_msg: Optional[str] = None
+        self.reply_section: Optional[str] = None
+        self.raise_section: Optional[str] = None
+        if not (self.in_reply_to or self.replaces):
+            return
+
+        # An edit carries the new text in m.new_content
+        text_content = (content.get("m.new_content") or {}) if self.replaces else content
+        formatted = text_content.get("formatted_body")
+        if formatted:
+            self.reply_msg = strip_formatted_reply_fallback(formatted)
+        elif text_content.get("body") is not None:
+            self.reply_msg = strip_plain_reply_fallback(text_content["body"])
+        if self.reply_msg:
+            if self.reply_msg.startswith(("!reply ", "<p>!reply ")):
+                self.reply_section = self.reply_msg
+            elif self.reply_msg.startswith(("!raise ", "<p>!raise ")):
+                self.raise_section = self.reply_msg
+
+    @property
+    def mentions(self) -> List[str]:
+        """User IDs mentioned, searched for in the body only if the message has no m.mentions."""
+        if self._mentions is None:
+            if self.mentioned_user_ids is not None:
+                self._mentions = self.mentioned_user_ids
+            elif "@" in self.body:
+                self._mentions = list({match.group() for match in user_id_pattern.finditer(self.body)})
+            else:
+                self._mentions = []
+        return self._mentions
+
+    def mentions_user(self, user_id: str) -> bool:
+        """Whether the message mentions the user.
+
+        Without m.mentions, whether the body names the user by user ID or localpart, case insensitively.
+        A user ID matched in the body contains the localpart, so searching for the localpart is enough.
+        """
+        if self.mentioned_user_ids is not None:
+            return user_id in self.mentioned_user_ids
+        return user_id.split(":")[0][1:].lower() in self.body.lower()
+
+    def reply_quote_word(self) -> Optional[str]:
+        """First word of the quoted message in the plain text reply fallback of a reply, if any."""
+        if not self.in_reply_to or not self.body.startswith("> <@"):
+            return None
+        end = self.body.find("\n")
+        match = reply_quote_pattern.match(self.body, 0, end if end > -1 else len(self.body))
+        return match[3] if match else None
+
+
+def strip_formatted_reply_fallback(formatted: str) -> str:
+    """The HTML of a reply without the mx-reply element it starts with, if any."""
+    if not formatted.startswith(REPLY_OPEN):
+        return formatted
+    # mx-reply is only used for the fallback, so it ends at the last closing tag, also when older
+    # clients nested the fallbacks of earlier replies in it. Searched from the end, the short reply.
+    end = formatted.rfind(REPLY_CLOSE)
+    if end == -1:
+        # Never closed, so not a fallback
+        return formatted
+    return formatted[end + len(REPLY_CLOSE):]
+
+
+def strip_plain_reply_fallback(body: str) -> str:
+    """The text of a reply without the quoted lines it starts with and the empty line after them, if any."""
+    position = 0
+    while body.startswith(">", position):
+        end = body.find("\n", position)
+        if end == -1:
+            return ""
+        position = end + 1
+    if position and body.startswith("\n", position):
+        position += 1
+    return body[position:]
+
+
+def message_content(event: nio.Event) -> MessageContent:
+    """The parsed content of an event, parsed on first use and kept with the event for the other handlers."""
+    content = getattr(event, "_message_content", None)
+    if content is None:
+        content = event._message_content = MessageContent(event.source)
+    return content
 
 
 async def get_room_id(client: nio.AsyncClient, room: str, logger: logging.Logger) -> str:
     if room.startswith("#"):
+        cached = alias_cache.get(room)
+        is_fresh = cached is not None and time.monotonic() - cached[1] < ALIAS_CACHE_TTL_S
+        count_cache("alias", is_fresh)
+        if is_fresh:
+            return cached[0]
+
         response = await client.room_resolve_alias(room)
         if getattr(response, "room_id", None):
             logger.debug(f"Room '{room}' resolved to {response.room_id}")
+            alias_cache[room] = (response.room_id, time.monotonic())
             return response.room_id
         else:
             logger.warning(f"Could not resolve '{room}' to a room ID")
@@ -126,14 +205,33 @@ def with_ratelimit(func):
     """
     Decorator for calling client methods with backoff, specified in server response if rate limited.
     """
+    # Rate limits are tracked per account, on the client the method belongs to
+    client = getattr(func, "__self__", None)
+    account = getattr(client, "user_id", None) or ""
+    name = getattr(func, "__name__", "request")
+
     async def wrapper(*args, **kwargs):
         while True:
+            # Wait out a rate limit already reported for this account instead of hitting it again
+            delay_s = getattr(client, "rate_limited_until", 0) - time.monotonic()
+            if delay_s > 0:
+                RATELIMIT_BACKOFF.inc(delay_s, account=account)
+                with span("ratelimit_sleep", account=account):
+                    await asyncio.sleep(delay_s)
+
             logger.debug(f"waiting for response")
-            response = await func(*args, **kwargs)
+            with span(name):
+                response = await func(*args, **kwargs)
             logger.debug(f"Response: {response}")
             if isinstance(response, nio.ErrorResponse):
                 if response.status_code == "M_LIMIT_EXCEEDED":
-                    await sleep_ms(response.retry_after_ms)
+                    retry_after_ms = response.retry_after_ms or 5000
+                    RATELIMIT_HITS.inc(account=account)
+                    RATELIMIT_BACKOFF.inc(retry_after_ms / 1000, account=account)
+                    if client is not None:
+                        client.rate_limited_until = time.monotonic() + retry_after_ms / 1000
+                    with span("ratelimit_sleep", account=account):
+                        await sleep_ms(retry_after_ms)
                 else:
                     return response
             else:
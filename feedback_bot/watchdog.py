@@ -0,0 +1,133 @@
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+
+from feedback_bot.config import Config
+from feedback_bot.metrics import REGISTRY
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+# Frames skipped when attributing a blocking call, the caller is reported instead
+INSTRUMENTATION_MODULES = ("metrics.py", "tracing.py", "watchdog.py")
+WRAPPER_FUNCTIONS = ("_execute", "_executemany", "wrapper", "async_wrapper")
+
+LOOP_LAG = REGISTRY.histogram(
+    "feedback_bot_event_loop_lag_seconds", "Delay of the event loop in running a scheduled callback",
+)
+BLOCKING_EPISODES = REGISTRY.counter(
+    "feedback_bot_blocking_episodes_total", "Times the event loop was blocked beyond the threshold, per code location",
+    ("location",),
+)
+
+
+def _location(frame) -> str:
+    filename = os.path.abspath(frame.f_code.co_filename)
+    if filename.startswith(PACKAGE_DIR):
+        filename = os.path.relpath(filename, os.path.dirname(PACKAGE_DIR))
+    return f"{filename}:{frame.f_lineno} ({frame.f_code.co_name})"
+
+
+def blocking_location(frame) -> Tuple[str, str]:
+    """The innermost frame of the bot's own code on the stack, and the innermost frame overall.
+
+    The bot's frame is the call to move off the loop, the innermost one what it was blocked in,
+    e.g. sqlite3, Faker or commonmark.
+    """
+    innermost = _location(frame)
+    while frame is not None:
+        filename = os.path.abspath(frame.f_code.co_filename)
+        is_own = filename.startswith(PACKAGE_DIR) and os.path.basename(filename) not in INSTRUMENTATION_MODULES
+        if is_own and frame.f_code.co_name not in WRAPPER_FUNCTIONS:
+            return _location(frame), innermost
+        frame = frame.f_back
+    return innermost, innermost
+
+
+class LoopWatchdog(object):
+    def __init__(self, config: Config):
+        """Measure event loop lag and catch the calls blocking the loop.
+
+        A coroutine ticks on the loop, and a thread checks the ticks. When the loop has not ticked
+        for longer than the threshold, the thread takes the stack of the loop thread, logs it once per
+        code location and counts the episode for that location.
+
+        Args:
+            config (Config): Bot configuration parameters
+        """
+        self.interval_s = config.watchdog_interval_ms / 1000
+        self.threshold_s = config.watchdog_threshold_ms / 1000
+        self.loop_thread_id: Optional[int] = None
+        self.last_tick = time.monotonic()
+        self.episodes: Counter = Counter()
+        self.longest: Dict[str, float] = {}
+        self.lock = threading.Lock()
+        self.task: Optional[asyncio.Future] = None
+        self.thread: Optional[threading.Thread] = None
+        self.started = False
+
+    def start(self):
+        self.started = True
+        self.loop_thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.task = asyncio.ensure_future(self._tick_forever())
+        self.thread = threading.Thread(target=self._watch, name="feedback-bot-watchdog", daemon=True)
+        self.thread.start()
+
+    async def _tick_forever(self):
+        while True:
+            scheduled = time.monotonic() + self.interval_s
+            await asyncio.sleep(self.interval_s)
+            self.last_tick = time.monotonic()
+            LOOP_LAG.observe(max(self.last_tick - scheduled, 0))
+
+    def _watch(self):
+        episode_location: Optional[str] = None
+        episode_start = 0.0
+        while True:
+            time.sleep(self.interval_s)
+            last_tick = self.last_tick
+            blocked_s = time.monotonic() - last_tick - self.interval_s
+
+            if blocked_s <= self.threshold_s:
+                if episode_location is not None:
+                    self._end_episode(episode_location, last_tick - episode_start)
+                    episode_location = None
+                continue
+            if episode_location is not None:
+                continue
+
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            episode_location, innermost = blocking_location(frame)
+            episode_start = last_tick + self.interval_s
+            BLOCKING_EPISODES.inc(location=episode_location)
+            with self.lock:
+                self.episodes[episode_location] += 1
+                first = self.episodes[episode_location] == 1
+            if first:
+                logger.warning(
+                    f"Event loop blocked for over {self.threshold_s * 1000:.0f}ms in {episode_location}, "
+                    f"at {innermost}:\n{''.join(traceback.format_stack(frame))}"
+                )
+            else:
+                logger.debug(f"Event loop blocked in {episode_location}")
+
+    def _end_episode(self, location: str, duration_s: float):
+        with self.lock:
+            self.longest[location] = max(self.longest.get(location, 0), duration_s)
+
+    def top_locations(self, n: int = 5) -> List[Tuple[str, int, float]]:
+        """(location, episodes, longest episode in seconds) of the locations blocking most often."""
+        with self.lock:
+            return [
+                (location, count, self.longest.get(location, 0))
+                for location, count in self.episodes.most_common(n)
+            ]